@@ -0,0 +1,151 @@
+from collections import namedtuple
+import numpy as np
+from .statHelper import seed_description, array_digest
+
+# the outcome of liquidating an auction round
+#   price      the price paid by every winner (0 if nobody won)
+#   winners    the indices of the winning bidders
+#   minted     the block reward minted to the winners
+#   burnt      the tokens burnt, the payment of the winners and the penalty of late reveals
+#   fee        the transaction fee shared by the winners
+#   carried    the transaction fee carried over to the next round
+#   seasonable the number of bids revealed in time
+AuctionOutcome = namedtuple("AuctionOutcome", ("price", "winners", "minted", "burnt", "fee", "carried", "seasonable"))
+
+
+# agent-level auction following the clearing rules of aucMint.liquidation
+# Every bidder is an entry of a few arrays. In a round each bidder draws a mining cost (geometric, with a mean
+# of its own cost factor times the mining expense) and bids the value of a winner's share of block reward
+# and transaction fee minus that cost, discounted by the expected yield rate, as Simulation does for its
+# average bidder. Bidders with a positive bid commit; they reveal in time with probability reveal_probability,
+# otherwise the reveal is late and half of their escrow is burnt.
+# The seasonable bids are liquidated as in the contract:
+#   no seasonable bid:   nothing is minted, and the transaction fee is carried over to the next round
+#   at most k bids:      every bidder wins a 1/n share, and everyone pays the highest seasonable bid
+#                        (the contract's "minimumBid" loop keeps the maximum)
+#   more than k bids:    the k highest bids win a 1/k share, and pay the bid of the first loser
+# Winners are selected with argpartition instead of the contract's quickSort, ties are resolved arbitrarily.
+# Unlike the contract, which does not mark a round with more than k bids as liquidated (so that a later
+# recursive liquidation would pay it out again), every round is liquidated exactly once here.
+class AuctionEngine:
+
+    def __init__(self, bidders, bid_winner, cost_factors=None, cost_spread=0.0, reveal_probability=1.0,
+                 escrow_margin=1.0, yield_rate=1.05, carried_fee=0.0, seed=None):
+
+        # the bidder population, cost factors are drawn log-normal with mean 1 if not given
+        self.seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.generator = np.random.default_rng(self.seedSequence)
+        self.bidders = int(bidders)
+        drawn = cost_factors is None
+        if drawn:
+            cost_factors = np.exp(cost_spread * self.generator.standard_normal(self.bidders) - cost_spread ** 2 / 2)
+        self.costFactors = np.asarray(cost_factors, dtype=np.float64)
+        if len(self.costFactors) != self.bidders:
+            raise ValueError("cost_factors must have one entry for each bidder")
+
+        # the maximum number of winners in each round (bidWinnerNumber)
+        self.bidWinner = int(bid_winner)
+        self.revealProbability = reveal_probability
+        # the escrow of a bid as a multiple of its value, half of it is burnt on a late reveal
+        self.escrowMargin = escrow_margin
+        self.yieldRate = yield_rate
+
+        # the transaction fee carried over to the next round, e.g. from the mint-only round 0
+        self.carriedFee = carried_fee
+
+        # the inverse rates of the geometric mining costs, cached for the last mining expense
+        self.costExpense = None
+        self.costScales = None
+
+        # True once a round was liquidated, the random stream has advanced from its seed from then on
+        self.used = False
+
+        # the parameters of this engine, recorded with the parameters of a simulation and part of cache keys,
+        # so the seed and the cost factors are included; cost_spread only describes drawn cost factors
+        self.parameters = dict(bidders=self.bidders, bid_winner=self.bidWinner,
+                               cost_spread=cost_spread if drawn else None,
+                               cost_factors=array_digest(self.costFactors),
+                               reveal_probability=reveal_probability, escrow_margin=escrow_margin,
+                               yield_rate=yield_rate, carried_fee=carried_fee,
+                               seed=seed_description(self.seedSequence))
+
+    def spawn(self, n):
+
+        # n engines with the same bidders and independent random streams, e.g. for forked simulations
+        engines = []
+        for seed in self.seedSequence.spawn(n):
+            engines.append(AuctionEngine(self.bidders, self.bidWinner, self.costFactors, 0.0, self.revealProbability,
+                                         self.escrowMargin, self.yieldRate, self.carriedFee, seed))
+        return engines
+
+    def sample_costs(self, mining_expense):
+
+        # the mining cost of every bidder in this round, geometric with mean mining_expense * cost factor,
+        # drawn by inversion from exponential variates
+        if mining_expense != self.costExpense:
+            self.costExpense = mining_expense
+            self.costScales = -1.0 / np.log1p(-1.0 / (mining_expense * self.costFactors))
+        costs = self.generator.standard_exponential(self.bidders)
+        costs *= self.costScales
+        np.floor(costs, out=costs)
+        costs += 1
+        return costs
+
+    def bid_from_cost(self, costs, block_reward, transaction_fee):
+
+        # the bid of a bidder, the value of a winner's share minus its mining cost, discounted by the yield rate
+        return ((block_reward + transaction_fee) / self.bidWinner - costs) / self.yieldRate
+
+    def liquidate(self, block_reward, transaction_fee, mining_expense):
+
+        # run the commit, reveal and liquidation of a round
+        # bids fall with the mining cost, so the highest bids are found among the lowest costs
+        # @:param transaction_fee the fee collected in this round, fees carried over from former rounds are added
+        # @:return an AuctionOutcome
+        self.used = True
+        fee = transaction_fee + self.carriedFee
+        costs = self.sample_costs(mining_expense)
+
+        # only bidders with a positive bid commit, i.e. a mining cost below the value of a share
+        share = (block_reward + fee) / self.bidWinner
+
+        # some bidders reveal too late, their bids are not seasonable and half of their escrow is burnt
+        # the late bidders are a uniform subset of binomial size, the same as an independent draw per bidder
+        penalty = 0.0
+        if self.revealProbability < 1:
+            late_count = self.generator.binomial(self.bidders, 1 - self.revealProbability)
+            late = self.generator.choice(self.bidders, late_count, replace=False)
+            late = late[costs[late] < share]
+            penalty = (self.bid_from_cost(costs[late], block_reward, fee) * self.escrowMargin / 2).sum()
+            costs[late] = np.inf
+
+        k = self.bidWinner
+        if self.bidders > k:
+            lowest = np.argpartition(costs, k)[:k + 1]
+        else:
+            lowest = np.arange(self.bidders)
+        lowest = lowest[costs[lowest] < share]
+        seasonable = len(lowest) if len(lowest) <= k else int(np.count_nonzero(costs < share))
+
+        # case 1: no seasonable bid, the fee piles up
+        if seasonable == 0:
+            self.carriedFee = fee
+            return AuctionOutcome(0.0, lowest, 0.0, penalty, 0.0, fee, 0)
+
+        self.carriedFee = 0.0
+
+        # case 2: not more seasonable bids than winners, everyone pays the highest bid
+        if seasonable <= k:
+            price = self.bid_from_cost(costs[lowest].min(), block_reward, fee)
+            return AuctionOutcome(price, lowest, block_reward, seasonable * price + penalty, fee, 0.0, seasonable)
+
+        # case 3: the k highest bids win, at the price of the highest losing bid
+        order = np.argsort(costs[lowest], kind="stable")
+        winners = lowest[order[:k]]
+        price = self.bid_from_cost(costs[lowest[order[k]]], block_reward, fee)
+        return AuctionOutcome(price, winners, block_reward, k * price + penalty, fee, 0.0, seasonable)
+
+    def __call__(self, simulation):
+
+        # the bid model interface of Simulation, liquidate a round in the state of the simulation
+        return self.liquidate(simulation.blockReward, simulation.transactionFeePredict, simulation.miningExpense)
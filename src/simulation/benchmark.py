@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+from .simulation import Simulation
+from .statHelper import RandomSampler, sample_from_geometric_distribution
+from .resultBuffer import ResultBuffer
+
+
+'''
+build a Simulation with the default parameters of the paper
+'''
+def default_simulation(seed=2020, cprop=False, rprop=False, pt=0, negbin=False, horizon=None):
+
+    total_balance = 1000000000000
+    return Simulation(total_balance, 0.000035 * total_balance, 0.000006 * total_balance, 10,
+                      0.00006 * total_balance, False, cprop, rprop, pt, horizon=horizon, seed=seed, negbin=negbin)
+
+
+'''
+the best wall time of repeated calls of function, which is the least noisy estimate of its cost
+'''
+def best_time(function, repeat=3):
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+'''
+rounds per second of Simulation.single_round and Simulation.run for every C/R mode and perturbation type
+the simulations start shortly before round 150000, so that the perturbations happen during the measurement
+'''
+def benchmark_rounds(total_round, repeat):
+
+    results = {}
+    for cprop in (False, True):
+        for rprop in (False, True):
+            for pt in (0, 1, 2):
+                mode = "%s-%s-pt%d" % ("C-prop" if cprop else "C-const", "R-prop" if rprop else "R-const", pt)
+
+                def single_round():
+                    simulation = default_simulation(cprop=cprop, rprop=rprop, pt=pt, horizon=total_round)
+                    simulation.round = 150000 - total_round // 2
+                    for _ in range(total_round):
+                        simulation.single_round()
+
+                def run():
+                    simulation = default_simulation(cprop=cprop, rprop=rprop, pt=pt, horizon=total_round)
+                    simulation.round = 150000 - total_round // 2
+                    simulation.run(total_round)
+
+                results["single_round/" + mode] = rate(total_round / best_time(single_round, repeat), "rounds/s")
+                results["run/" + mode] = rate(total_round / best_time(run, repeat), "rounds/s")
+    return results
+
+
+'''
+calls per second of sample_from_geometric_distribution as the number of samples N grows
+'''
+def benchmark_geometric(sizes, calls, repeat):
+
+    results = {}
+    for N in sizes:
+        sampler = RandomSampler(2020)
+        results["geometric/sampler/N=%d" % N] = rate(calls / best_time(
+            lambda: [sample_from_geometric_distribution(6000000, N, sampler) for _ in range(calls)], repeat),
+            "calls/s")
+        results["geometric/negbin/N=%d" % N] = rate(calls / best_time(
+            lambda: [sample_from_geometric_distribution(6000000, N, sampler, True) for _ in range(calls)], repeat),
+            "calls/s")
+        scipy_calls = max(calls // 10, 1)
+        results["geometric/scipy/N=%d" % N] = rate(scipy_calls / best_time(
+            lambda: [sample_from_geometric_distribution(6000000, N) for _ in range(scipy_calls)], repeat),
+            "calls/s")
+    return results
+
+
+'''
+the cost of accumulating a result row by row, with ResultBuffer and with the former per-round np.concatenate
+'''
+def benchmark_accumulation(horizons, concatenate_limit, repeat):
+
+    row = np.array([1.0, 2.0, 3.0, 4.0])
+    results = {}
+    for horizon in horizons:
+
+        def buffer():
+            result = ResultBuffer(4)
+            for _ in range(horizon):
+                result.append(row)
+
+        results["accumulate/buffer/%d" % horizon] = cost(best_time(buffer, repeat), "s")
+
+        # the concatenation is quadratic, only small horizons are measured
+        if horizon <= concatenate_limit:
+
+            def concatenate():
+                result = np.zeros((1, 4))
+                for _ in range(horizon):
+                    result = np.concatenate((result, row[np.newaxis]), axis=0)
+
+            results["accumulate/concatenate/%d" % horizon] = cost(best_time(concatenate, repeat), "s")
+    return results
+
+
+'''
+the time to render draw_average_as_light to a PNG file with the Agg backend
+'''
+def benchmark_drawing(sizes, repeat):
+
+    from . import draw
+    directory = tempfile.mkdtemp()
+    draw.set_output(directory)
+    results = {}
+    try:
+        # a first figure pays for importing matplotlib and loading fonts, which is not measured
+        draw.draw_plain(np.arange(10.0), np.arange(10.0), name="warm_up")
+        for size in sizes:
+            axis_x = np.arange(size, dtype=np.float64)
+            axis_y = 3e6 + np.cumsum(np.random.default_rng(2020).standard_normal(size))
+            results["draw_average_as_light/%d" % size] = cost(best_time(
+                lambda: draw.draw_average_as_light(axis_x, axis_y, "Round Number", "Bid Price"), repeat), "s")
+    finally:
+        draw.set_output(None)
+    return results
+
+
+'''
+a measurement where larger values are better
+'''
+def rate(value, unit):
+
+    return dict(value=value, unit=unit, higherIsBetter=True)
+
+
+'''
+a measurement where smaller values are better
+'''
+def cost(value, unit):
+
+    return dict(value=value, unit=unit, higherIsBetter=False)
+
+
+'''
+run the whole benchmark suite
+@:param quick True for a short run with smaller sizes, e.g. in a pre-commit check
+@:return a json-compatible dict of the environment and all measurements
+'''
+def run_suite(quick=False):
+
+    sizes = dict(repeat=3, rounds=2000, geometricSizes=[10, 200, 2000], geometricCalls=200,
+                 horizons=[1000, 10000], concatenateLimit=10000, drawingSizes=[10 ** 5]) if quick else \
+        dict(repeat=5, rounds=20000, geometricSizes=[10, 200, 2000, 20000], geometricCalls=2000,
+             horizons=[1000, 10000, 100000, 1000000], concatenateLimit=20000, drawingSizes=[10 ** 5, 10 ** 6, 10 ** 7])
+    repeat = sizes["repeat"]
+    results = {}
+    results.update(benchmark_rounds(sizes["rounds"], repeat))
+    results.update(benchmark_geometric(sizes["geometricSizes"], sizes["geometricCalls"], repeat))
+    results.update(benchmark_accumulation(sizes["horizons"], sizes["concatenateLimit"], repeat))
+    results.update(benchmark_drawing(sizes["drawingSizes"], repeat))
+    return dict(
+        environment=dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+                         processor=platform.processor(), time=time.strftime("%Y-%m-%dT%H:%M:%S")),
+        quick=quick,
+        sizes=sizes,
+        results=results,
+    )
+
+
+'''
+compare measurements with a baseline
+@:param tolerance the relative slowdown tolerated before a measurement counts as a regression
+@:return a list of (name, baseline value, current value, relative slowdown) of all regressions
+@:raise ValueError if the measurements were taken with other sizes than the baseline, e.g. a quick run
+'''
+def compare(current, baseline, tolerance=0.2):
+
+    # the rates depend on the sizes, e.g. the rounds per measurement, so only runs of the same sizes compare
+    if current.get("quick") != baseline.get("quick") or current.get("sizes") != baseline.get("sizes"):
+        raise ValueError("the baseline was measured with %s sizes %s, the current run with %s sizes %s"
+                         % ("quick" if baseline.get("quick") else "full", baseline.get("sizes"),
+                            "quick" if current.get("quick") else "full", current.get("sizes")))
+    regressions = []
+    for name, measurement in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]["value"]
+        new = measurement["value"]
+        slowdown = old / new - 1 if measurement["higherIsBetter"] else new / old - 1
+        if slowdown > tolerance:
+            regressions.append((name, old, new, slowdown))
+    return regressions
+
+
+# the main function to benchmark
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="benchmark the simulation hot paths")
+    parser.add_argument("--quick", action="store_true", help="short run with smaller sizes")
+    parser.add_argument("--output", help="write the measurements to this JSON file")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="the stored baseline to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the measurements as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="tolerated relative slowdown")
+    arguments = parser.parse_args()
+
+    current = run_suite(arguments.quick)
+    for name, measurement in current["results"].items():
+        print("%-50s %14.6g %s" % (name, measurement["value"], measurement["unit"]))
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w") as f:
+            json.dump(current, f, indent=2)
+        print("baseline saved to", arguments.baseline)
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare(current, baseline, arguments.tolerance)
+        except ValueError as error:
+            print("cannot compare with %s: %s" % (arguments.baseline, error))
+            sys.exit(2)
+        for name, old, new, slowdown in regressions:
+            print("REGRESSION %s: %.6g -> %.6g (%.0f%% slower)" % (name, old, new, 100 * slowdown))
+        if regressions:
+            sys.exit(1)
+        print("no regression against", arguments.baseline)
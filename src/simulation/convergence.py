@@ -0,0 +1,133 @@
+import numpy as np
+
+# the decision of a ConvergenceDetector for a member, by status code
+STOP_REASONS = (None, "stationary", "diverged")
+
+
+# incremental stationarity and divergence test of many series observed in lockstep, e.g. the total balance
+# of the members of an ensemble. The series are cut into windows of consecutive rounds, and at the end of
+# every window its mean is compared with the means of the windows before:
+#   stationary  the last patience + 1 window means lie within tolerance of each other (relative to the last),
+#               and at least min_rounds rounds have passed
+#   diverged    a value is not finite or not positive, or a window mean left the band
+#               [first mean / divergence_factor, first mean * divergence_factor]
+# The spread over several windows catches a slow drift that consecutive windows hide in their noise. The supply
+# relaxes over about 1 / ur rounds (ur the update rate of the exchange coefficient), so by default min_rounds is
+# relaxations / ur of every member, set by the Simulation or SimulationEnsemble run the detector observes.
+# With the paper's parameters (ur = 1/15000) a run is decided stationary after ~45k-55k rounds, within ~0.1% of
+# its long-run supply, instead of running the full 500k rounds.
+# A member is decided once, at the end of the window (or for a non-positive value, the round) that decides it.
+class ConvergenceDetector:
+
+    def __init__(self, members=1, window=5000, tolerance=1e-3, patience=3, divergence_factor=10.0, min_rounds=None,
+                 relaxations=3.0):
+
+        self.members = members
+        self.window = int(window)
+        self.tolerance = tolerance
+        self.patience = patience
+        self.divergenceFactor = divergence_factor
+
+        # the first round a member can be decided stationary, relaxations / ur of its simulation if None
+        self.relaxations = relaxations
+        self.autoMinRounds = min_rounds is None
+        self.minRounds = np.array(np.broadcast_to(0.0 if min_rounds is None else min_rounds, (members,)),
+                                  dtype=np.float64)
+
+        # the sums of the current window and the number of rounds in it, shared by all members
+        self.windowSum = np.zeros(members)
+        self.filled = 0
+
+        # the first window mean, and the last patience + 1 window means (NaN while fewer were seen)
+        self.reference = np.full(members, np.nan)
+        self.recent = np.full((patience + 1, members), np.nan)
+
+        # the status (an index of STOP_REASONS) and the deciding round of every member, -1 while running
+        self.status = np.zeros(members, dtype=np.int8)
+        self.stopRound = np.full(members, -1, dtype=np.int64)
+
+    def relax(self, update_rate, members=None):
+
+        # set the first round a member can be decided stationary from the update rate ur of its simulation,
+        # unless min_rounds was given; members are the indices of the members the update rates belong to
+        if self.autoMinRounds:
+            members = np.arange(self.members) if members is None else np.asarray(members)
+            self.minRounds[members] = self.relaxations / np.asarray(update_rate, dtype=np.float64)
+
+    def rounds_to_window_end(self):
+
+        # the number of rounds until the next decision can be made
+        return self.window - self.filled
+
+    def running(self):
+
+        # the indices of the members not decided yet
+        return np.flatnonzero(self.status == 0)
+
+    def reason(self, i):
+
+        return STOP_REASONS[self.status[i]]
+
+    def update(self, rnd, values, members=None):
+
+        # observe the values of one round, of all members or of the members with the given indices
+        # @:return the indices of the members decided by this round
+        return self.update_many(np.asarray([rnd]), np.asarray(values, dtype=np.float64)[np.newaxis], members)
+
+    def update_many(self, rounds, values, members=None):
+
+        # observe many rounds at once, values with shape (rounds, members)
+        # @:return the indices of the members decided by these rounds
+        members = np.arange(self.members) if members is None else np.asarray(members)
+        values = np.asarray(values, dtype=np.float64).reshape(len(rounds), len(members))
+        decided = []
+
+        # a value that is not finite or not positive decides divergence at once
+        invalid = ~(values > 0).all(axis=0) & (self.status[members] == 0)
+        if invalid.any():
+            first = np.argmax(~(values[:, invalid] > 0), axis=0)
+            self.__decide(members[invalid], 2, np.asarray(rounds)[first])
+            decided.append(members[invalid])
+
+        start = 0
+        while start < len(rounds):
+            end = min(len(rounds), start + self.rounds_to_window_end())
+            self.windowSum[members] += values[start:end].sum(axis=0)
+            self.filled += end - start
+            if self.filled == self.window:
+                decided.append(self.__evaluate(int(rounds[end - 1]), members))
+            start = end
+        return np.concatenate(decided) if decided else np.empty(0, dtype=np.int64)
+
+    def __evaluate(self, rnd, members):
+
+        # test the window ending at round rnd
+        mean = self.windowSum[members] / self.window
+        self.windowSum[members] = 0
+        self.filled = 0
+
+        reference = self.reference[members]
+        reference = np.where(np.isnan(reference), mean, reference)
+        self.reference[members] = reference
+        recent = self.recent[:, members]
+        recent[:-1] = recent[1:]
+        recent[-1] = mean
+        self.recent[:, members] = recent
+        with np.errstate(divide="ignore", invalid="ignore"):
+            diverged = ~np.isfinite(mean) | (mean <= 0) | (np.abs(np.log(mean / reference))
+                                                          > np.log(self.divergenceFactor))
+            spread = (recent.max(axis=0) - recent.min(axis=0)) / np.abs(mean)
+        stationary = (spread < self.tolerance) & (rnd >= self.minRounds[members])
+
+        running = self.status[members] == 0
+        decided = []
+        for status, mask in ((2, diverged & running), (1, stationary & ~diverged & running)):
+            if mask.any():
+                self.__decide(members[mask], status, rnd)
+                decided.append(members[mask])
+        return np.concatenate(decided) if decided else np.empty(0, dtype=np.int64)
+
+    def __decide(self, members, status, rounds):
+
+        self.status[members] = status
+        self.stopRound[members] = rounds
@@ -1,43 +1,280 @@
-import matplotlib.pyplot as plt
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.ticker as mticker
+from .resultSink import ResultReader, load_result
+
+# matplotlib is imported lazily by load_pyplot, so that importing this module (or Simulation) stays cheap
+plt = None
+mticker = None
+
+# the batch output of figures, None to show figures interactively
+# when set, figures are rendered with the Agg backend and saved as files instead of being shown
+batch_output = None
+
+# the number of points read at a time from a series, so that a memory-mapped result is never loaded at once
+CHUNK_ROWS = 1 << 18
+
+
+'''
+import matplotlib on first use, with the Agg backend in batch mode so that no display is needed
+@:return the pyplot and ticker modules
+'''
+def load_pyplot():
+
+    global plt, mticker
+    if plt is None:
+        import matplotlib
+        if batch_output is not None:
+            matplotlib.use("Agg")
+        import matplotlib.pyplot
+        import matplotlib.ticker
+        plt = matplotlib.pyplot
+        mticker = matplotlib.ticker
+    return plt, mticker
+
+
+'''
+enable batch mode: figures are written to directory in every format instead of being shown
+@:param directory the output directory, None to show figures interactively again
+@:param formats the file formats, e.g. ("png", "pdf", "svg")
+@:param dpi the resolution of raster formats, the matplotlib default if None
+'''
+def set_output(directory, formats=("png",), dpi=None):
+
+    global batch_output
+    if directory is None:
+        batch_output = None
+        return
+    os.makedirs(directory, exist_ok=True)
+    batch_output = dict(directory=directory, formats=tuple(formats), dpi=dpi)
+    if plt is not None:
+        plt.switch_backend("Agg")
+
+
+'''
+show a finished figure, or save it in batch mode
+@:param name the file name of the figure without extension
+@:return the paths of the saved files, empty if the figure is shown
+'''
+def finish(fig, name):
+
+    if batch_output is None:
+        plt.show()
+        return []
+
+    name = re.sub(r"[^0-9A-Za-z]+", "_", name).strip("_").lower() or "figure"
+    paths = [os.path.join(batch_output["directory"], name + "." + fmt) for fmt in batch_output["formats"]]
+    for path in paths:
+        fig.savefig(path, dpi=batch_output["dpi"], bbox_inches="tight")
+    plt.close(fig)
+    return paths
+
+
+'''
+render one figure of a batch in a worker process
+@:param figure (name of a draw function of this module, keyword arguments)
+'''
+def render_figure(figure):
+
+    function, kwargs = figure
+    return globals()[function](**kwargs)
+
+
+'''
+render many figures without a display, concurrently in worker processes
+@:param figures a list of (name of a draw function, keyword arguments), e.g. ("draw_plain", dict(axis_x=..., axis_y=...))
+@:param directory the output directory
+@:param formats the file formats, e.g. ("png", "pdf", "svg")
+@:param max_workers the maximum number of worker processes, all cores if None
+@:return the paths of all written files
+'''
+def render_batch(figures, directory, formats=("png",), dpi=None, max_workers=None):
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=set_output,
+                             initargs=(directory, formats, dpi)) as executor:
+        return [path for paths in executor.map(render_figure, figures) for path in paths]
+
+
+'''
+moving average of axis_y over window points, computed from a cumulative sum in O(n), one chunk at a time
+the i-th value is the average of axis_y[i:i+window], and the last window is dropped as in the original loop
+'''
+def moving_average(axis_y, window, chunk_rows=CHUNK_ROWS):
+
+    n = len(axis_y)
+    if n <= window:
+        return np.empty(0)
+
+    average = np.empty(n - window)
+    for start in range(0, n - window, chunk_rows):
+        stop = min(start + chunk_rows, n - window)
+        part = np.asarray(axis_y[start:stop + window], dtype=np.float64)
+
+        # subtract the mean first, which keeps the cumulative sum small and precise
+        offset = part.mean()
+        cumulative = np.concatenate(([0.0], np.cumsum(part - offset)))
+        average[start:stop] = (cumulative[window:window + stop - start] - cumulative[:stop - start]) / window + offset
+    return average
+
+
+# the moving average of a series over window points as a lazy series, see moving_average
+# a slice is computed from the points it needs only, so a decimated plot of the average of a long (memory-mapped)
+# series never holds the whole average
+class MovingAverage:
+
+    def __init__(self, axis_y, window):
+
+        self.series = axis_y
+        self.window = window
+
+    def __len__(self):
+
+        return max(len(self.series) - self.window, 0)
+
+    def __getitem__(self, key):
+
+        start, stop, _ = key.indices(len(self))
+        return moving_average(self.series[start:max(stop, start) + self.window], self.window)
+
+
+'''
+min/max decimation of a time series for plotting
+the series is cut into buckets of consecutive points, and only the minimum and maximum point of every bucket is kept
+in their original order, so the drawn envelope is the same while the number of points scales with the pixel width;
+whole buckets are read a chunk at a time, so axis_y can be any series that can be sliced, e.g. a MovingAverage
+@:param buckets the number of buckets, usually the width of the plot in pixels
+'''
+def decimate(axis_x, axis_y, buckets, chunk_rows=CHUNK_ROWS):
+
+    n = len(axis_y)
+    if n <= 2 * buckets:
+        return np.asarray(axis_x), np.asarray(axis_y[:n])
+
+    size = n // buckets
+    step = max(chunk_rows // size, 1) * size
+    indices, values = [], []
+    for start in range(0, size * buckets, step):
+        body = np.asarray(axis_y[start:min(start + step, size * buckets)]).reshape(-1, size)
+        pairs = np.sort(np.stack([body.argmin(axis=1), body.argmax(axis=1)], axis=1), axis=1)
+        indices.append(start + np.arange(len(body))[:, np.newaxis] * size + pairs)
+        values.append(np.take_along_axis(body, pairs, axis=1))
+
+    # the remaining points form a last, shorter bucket
+    if size * buckets < n:
+        tail = np.asarray(axis_y[size * buckets:n])
+        pairs = np.sort([tail.argmin(), tail.argmax()])
+        indices.append(size * buckets + pairs[np.newaxis])
+        values.append(tail[pairs][np.newaxis])
+
+    return np.asarray(axis_x)[np.concatenate(indices).ravel()], np.concatenate(values).ravel()
+
+
+'''
+decimation of one edge of a band, every bucket of consecutive points is reduced to its extreme point
+@:param reduce np.minimum for the lower edge, np.maximum for the upper edge, so that the band is never narrowed
+@:return the first x of every bucket, and the reduced y
+'''
+def envelope(axis_x, axis_y, buckets, reduce, chunk_rows=CHUNK_ROWS):
+
+    n = len(axis_y)
+    if n <= 2 * buckets:
+        return np.asarray(axis_x), np.asarray(axis_y)
+    width = -(-n // buckets)
+    step = max(chunk_rows // width, 1) * width
+    reduced = [reduce.reduceat(np.asarray(axis_y[start:start + step]), np.arange(0, min(step, n - start), width))
+               for start in range(0, n, step)]
+    return np.asarray(axis_x)[np.arange(0, n, width)], np.concatenate(reduced)
+
+
+'''
+draw a band between lower and upper, decimated to the width of the figure
+'''
+def draw_band(fig, ax, axis_x, lower, upper, color, alpha=0.2):
+
+    lower_x, lower = envelope(axis_x, lower, plot_width(fig), np.minimum)
+    _, upper = envelope(axis_x, upper, plot_width(fig), np.maximum)
+    ax.fill_between(lower_x, lower, upper, color=color, alpha=alpha, linewidth=0)
+
+
+'''
+the width of the axes of a figure in pixels, used as the number of buckets for decimation
+'''
+def plot_width(fig):
+
+    return max(int(fig.get_figwidth() * fig.dpi), 1)
+
+'''
+a column of a result to draw, with an optional (lower, upper) band
+a decimated ResultSink output gives the mean of every window of rows and the band from its minimum to its maximum,
+so that the full range of the series is drawn from the small window files without reading any raw row
+@:return (values, band), band is None for a result without window statistics
+'''
+def result_series(result, i):
+
+    if isinstance(result, ResultReader) and result.decimation > 1 and i > 0:
+        column = result.columns[i]
+        return result.column(column, "mean"), (result.column(column, "min"), result.column(column, "max"))
+    return result[:, i], None
+
 
 '''
 draw all time series graph
-@:param result the result calculated from simulation
+@:param result the result calculated from simulation, or the output directory of a ResultSink (read lazily,
+               from its window statistics if the sink decimated its rows)
+@:param name the prefix of the file names in batch mode
 '''
-def draw_all(result):
+def draw_all(result, name=""):
+
+    if isinstance(result, str):
+        result = load_result(result)
+
+    # a moving average over 400 rounds is one over 400 / k windows of k rows
+    decimation = result.decimation if isinstance(result, ResultReader) else 1
+    average_round = max(400 // decimation, 1)
 
-    rounds = result[:, 0]
-    total_balance = result[:, 1]
-    draw_plain(axis_x=rounds, axis_y=total_balance, label_x="Round Number", label_y="Total Supply")
+    rounds, _ = result_series(result, 0)
+    total_balance, band = result_series(result, 1)
+    paths = draw_plain(axis_x=rounds, axis_y=total_balance, label_x="Round Number", label_y="Total Supply",
+                       name=name + "total_supply", band=band)
 
-    bid_price = result[:, 2]
-    draw_average_as_light(axis_x=rounds, axis_y=bid_price, label_x="Round Number", label_y="Bid Price")
+    bid_price, band = result_series(result, 2)
+    paths += draw_average_as_light(axis_x=rounds, axis_y=bid_price, label_x="Round Number", label_y="Bid Price",
+                                   name=name + "bid_price", band=band, average_round=average_round)
 
-    transaction_fee = result[:, 3]
-    draw_average_as_light(axis_x=rounds, axis_y=transaction_fee, label_x="Round Number", label_y="Transaction Fees")
+    transaction_fee, band = result_series(result, 3)
+    paths += draw_average_as_light(axis_x=rounds, axis_y=transaction_fee, label_x="Round Number",
+                                   label_y="Transaction Fees", name=name + "transaction_fees", band=band,
+                                   average_round=average_round)
+    return paths
 
 
 '''
 draw time series of color pink from axis_x and axis_y
 with an additional average line of color firebrick 
+@:param name the file name in batch mode, label_y if None
+@:param band an optional (lower, upper) pair, drawn in pink instead of the data, e.g. the window min/max of a sink
+@:param average_round the number of points of the moving average
 '''
-def draw_average_as_light(axis_x, axis_y, label_x="label_x", label_y="label_y"):
+def draw_average_as_light(axis_x, axis_y, label_x="label_x", label_y="label_y", name=None, band=None,
+                          average_round=400):
 
+    plt, mticker = load_pyplot()
     fig, ax = plt.subplots(1)
+    buckets = plot_width(fig)
 
-    # draw the original data
-    ax.plot(axis_x[1:], axis_y[1:], color="pink")
+    # draw the original data, or the band of its range
+    if band is None:
+        ax.plot(*decimate(axis_x[1:], axis_y[1:], buckets), color="pink")
+    else:
+        draw_band(fig, ax, axis_x[1:], band[0][1:], band[1][1:], "pink", alpha=1.0)
 
-    # the round number to calculate average
-    average_round = 400
-    # calculate average for original data
-    aver_axis_y = np.array([sum(axis_y[i-average_round//2:i+average_round//2])/average_round
-                 for i in range(average_round//2, len(axis_y)-average_round//2)])
+    # calculate average for original data, lazily while it is decimated
+    aver_axis_y = MovingAverage(axis_y, average_round)
 
     # draw the averaged data
-    ax.plot(axis_x[average_round//2: len(axis_y)-average_round//2], aver_axis_y, color="firebrick")
+    ax.plot(*decimate(axis_x[average_round//2: average_round//2 + len(aver_axis_y)], aver_axis_y, buckets),
+            color="firebrick")
     ax.set_xlabel(label_x)
     ax.set_ylabel(label_y)
     formatter = mticker.ScalarFormatter(useMathText=True)
@@ -48,18 +285,23 @@ def draw_average_as_light(axis_x, axis_y, label_x="label_x", label_y="label_y"):
     formatter2.set_scientific(True)
     formatter2.set_powerlimits((-1, 1))
     ax.xaxis.set_major_formatter(formatter2)
-    plt.show()
+    return finish(fig, name or label_y)
 
 
 '''
 draw time series of color firebrick from axis_x and axis_y
+@:param name the file name in batch mode, label_y if None
+@:param band an optional (lower, upper) pair, drawn as a shaded band around the series
 '''
-def draw_plain(axis_x, axis_y, label_x="label_x", label_y="label_y"):
+def draw_plain(axis_x, axis_y, label_x="label_x", label_y="label_y", name=None, band=None):
 
     # draw the original data
+    plt, mticker = load_pyplot()
     fig, ax = plt.subplots(1)
 
-    ax.plot(axis_x, axis_y, color="firebrick")
+    ax.plot(*decimate(axis_x, axis_y, plot_width(fig)), color="firebrick")
+    if band is not None:
+        draw_band(fig, ax, axis_x, band[0], band[1], "firebrick")
     ax.set_xlabel(label_x)
     ax.set_ylabel(label_y)
 
@@ -71,22 +313,31 @@ def draw_plain(axis_x, axis_y, label_x="label_x", label_y="label_y"):
     formatter2.set_scientific(True)
     formatter2.set_powerlimits((-1, 1))
     ax.xaxis.set_major_formatter(formatter2)
-    plt.show()
+    return finish(fig, name or label_y)
 
 
 '''
 draw multiple lines with the same axis_x
+@:param name the file name in batch mode, label_y if None
+@:param bands an optional (lower, upper) pair for every line (or None), drawn as a shaded band around it
 '''
-def draw_multiple(axis_x, axis_y, labels, colors, line_styles, label_x="label_x", label_y="label_y"):
+def draw_multiple(axis_x, axis_y, labels, colors, line_styles, label_x="label_x", label_y="label_y", name=None,
+                  bands=None):
 
     if len(axis_y) != len(colors) or len(axis_y) != len(labels) or len(axis_y) != len(line_styles):
-        return
+        return []
 
     # draw the original data
+    plt, mticker = load_pyplot()
     fig, ax = plt.subplots(1)
 
     for i in range(len(axis_y)):
-        ax.plot(axis_x, axis_y[i], color=colors[i], linestyle=line_styles[i], label=labels[i])
+        ax.plot(*decimate(axis_x, axis_y[i], plot_width(fig)), color=colors[i], linestyle=line_styles[i],
+                label=labels[i])
+
+        # a shaded band around the series, e.g. mean ± std or a quantile range of replications
+        if bands is not None and bands[i] is not None:
+            draw_band(fig, ax, axis_x, bands[i][0], bands[i][1], colors[i])
 
     ax.set_xlabel(label_x)
     ax.set_ylabel(label_y)
@@ -100,4 +351,42 @@ def draw_multiple(axis_x, axis_y, labels, colors, line_styles, label_x="label_x"
     formatter2.set_powerlimits((-1, 1))
     ax.xaxis.set_major_formatter(formatter2)
     plt.legend(loc='best', labelspacing=0)
-    plt.show()
\ No newline at end of file
+    return finish(fig, name or label_y)
+
+if __name__ == '__main__':
+
+    import shutil
+    import tempfile
+    import tracemalloc
+    from .resultSink import ResultSink
+
+    # a long streamed result is drawn chunk by chunk, with much less memory than a single column of it,
+    # and a decimated one from its window statistics
+    directory = tempfile.mkdtemp()
+    try:
+        set_output(os.path.join(directory, "figures"))
+        # matplotlib allocates its caches with the first figure, which is not part of the measure
+        plt, _ = load_pyplot()
+        finish(plt.subplots(1)[0], "warm_up")
+        rows = 1 << 21
+        generator = np.random.default_rng(2020)
+        for decimation in (1, 100):
+            output = os.path.join(directory, "result_%d" % decimation)
+            sink = ResultSink(output, decimation=decimation, capacity=rows, chunk_rows=1 << 16)
+            for start in range(0, rows, 1 << 16):
+                chunk = np.empty((1 << 16, 4))
+                chunk[:, 0] = np.arange(start, start + (1 << 16))
+                chunk[:, 1:] = 1e12 + generator.standard_normal((1 << 16, 3)).cumsum(axis=0)
+                sink.extend(chunk)
+            sink.close()
+
+            tracemalloc.start()
+            paths = draw_all(output, name="decimation_%d_" % decimation)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert len(paths) == 3 and all(os.path.exists(path) for path in paths)
+            assert peak < rows * 8, peak
+            print("draw_all of %d rows, decimation %d: peak %.1f MB" % (rows, decimation, peak / 1e6))
+        assert result_series(load_result(os.path.join(directory, "result_100")), 1)[1] is not None
+    finally:
+        shutil.rmtree(directory)
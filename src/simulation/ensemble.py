@@ -0,0 +1,251 @@
+import numpy as np
+from .statHelper import VariateStream, RandomSampler
+from .resultSink import RESULT_COLUMNS
+from .resultBuffer import ResultBuffer
+from .perturbation import PerturbationSchedule, EnsembleTimeline
+
+
+# class for stepping many aucMint simulation configurations in lockstep
+# every state field of Simulation becomes a vector over members, and C-prop/R-prop flags and
+# perturbation types become per-member masks, so that one round is a handful of array operations.
+# Each member follows the same recurrence as a scalar Simulation with negbin=True,
+# i.e. the mean mining cost is drawn from the sum of bw * 20 geometric variates as a single variate.
+# Every constructor argument can be a scalar shared by all members or a sequence with one value per member;
+# pt is a perturbation type or a PerturbationSchedule, or a sequence of them.
+# With crn=True all members consume common random numbers: in every round they share the exponential variates
+# of their geometric mining costs (drawn by inversion, as Simulation with negbin=False) and the normal variate
+# of their fee noise, so that differences between members are the effect of their parameters, not of their noise.
+# A member of a CRN ensemble with bw bid winners then follows the same draws as Simulation(seed=seed),
+# if no member has more bid winners.
+class SimulationEnsemble:
+
+    # the vector state of the members still running, members stopped early are removed from them
+    memberFields = ("totalBalance", "blockReward", "blockRewardRate", "miningExpense", "miningExpenseRate",
+                    "bidWinner", "transactionFeePredict", "exchangeCoefficient", "updateRate", "gamma",
+                    "exCoeffConstant", "update_mining_cost_mask", "update_block_reward_mask")
+
+    def __init__(self, tb, br, me, bw, tf, cprop=False, rprop=False, pt=0, gamma=0.5, ur=1/15000,
+                 horizon=None, seed=None, sink=None, crn=False):
+
+        # the number of members is given by the longest sequence argument
+        schedules = pt if isinstance(pt, (list, tuple)) else [pt]
+        members = np.broadcast(*[np.asarray(arg) for arg in (tb, br, me, bw, tf, cprop, rprop, gamma, ur)],
+                               np.empty(len(schedules))).size
+        self.members = members
+
+        def vector(arg, dtype=np.float64):
+            return np.array(np.broadcast_to(np.asarray(arg, dtype=dtype), (members,)))
+
+        # system total balance
+        self.totalBalance = vector(tb)
+
+        # block reward for a single round (for bid winners altogether)
+        self.blockReward = vector(br)
+        self.blockRewardRate = self.blockReward / self.totalBalance
+
+        # average mining expense for a single miner
+        self.miningExpense = vector(me)
+        self.miningExpenseRate = self.miningExpense / self.totalBalance
+
+        # the number of bid winners
+        self.bidWinner = vector(bw, np.int64)
+
+        # the transaction fee predicted from total balance
+        self.transactionFeePredict = vector(tf)
+
+        # the fluctuating exchange coefficient, its update rate and the exchange coefficient constant
+        self.exchangeCoefficient = self.transactionFeePredict / self.totalBalance
+        self.updateRate = vector(ur)
+        self.gamma = vector(gamma)
+        self.exCoeffConstant = self.exchangeCoefficient / np.power(self.totalBalance, self.gamma)
+
+        # the random generator of this ensemble, normal variates are drawn in blocks
+        # common random numbers come from the exponential and normal streams of a RandomSampler
+        self.crn = crn
+        self.generator = np.random.default_rng(seed)
+        if crn:
+            sampler = RandomSampler(seed)
+            self.exponentialStream = sampler.exponentialStream
+            self.normalStream = sampler.normalStream
+        else:
+            self.normalStream = VariateStream(self.generator, lambda g, size: g.standard_normal(size),
+                                              max(65536, members))
+
+        # simulation round
+        # initialized as 1
+        self.round = 1
+
+        # masks of members using C-prop and R-prop
+        self.update_mining_cost_mask = vector(cprop, bool)
+        self.update_block_reward_mask = vector(rprop, bool)
+        self.anyMiningCostUpdate = bool(self.update_mining_cost_mask.any())
+        self.anyBlockRewardUpdate = bool(self.update_block_reward_mask.any())
+
+        # the indices of the members still running, and why and at which round the others stopped
+        self.active = np.arange(members)
+        self.stopReason = [None] * members
+        self.stopRound = np.full(members, -1, dtype=np.int64)
+
+        # the perturbations of every member, merged into a single timeline
+        schedules = [PerturbationSchedule.build(schedule) for schedule in schedules]
+        self.perturbation_schedules = schedules * members if len(schedules) == 1 else schedules
+        self.timeline = EnsembleTimeline(self.perturbation_schedules)
+
+        # simulation result, one [round, totalBalance, bidPrice. txFee] row for every member in each round
+        # with a ResultSink of member_shape (members,) as sink, rows are streamed to disk
+        if sink is None:
+            self.resultBuffer = ResultBuffer((members, 4), 1024 if horizon is None else horizon + 1)
+        else:
+            self.resultBuffer = sink
+        self.resultBuffer.append(np.stack([np.zeros(members), self.totalBalance,
+                                           np.zeros(members), self.transactionFeePredict], axis=1))
+
+    @property
+    def result(self):
+
+        # all rows recorded so far, with shape (rounds, members, 4)
+        return self.resultBuffer.view()
+
+    def close(self):
+
+        # finish the result, a sink writes its remaining rows to disk
+        self.resultBuffer.close()
+
+    def member_result(self, i):
+
+        # the result of member i, the same array layout as Simulation.result
+        return self.resultBuffer.view()[:, i, :]
+
+    def paired_differences(self, reference=0, column="totalBalance"):
+
+        # the difference between every member and the reference member in every round, e.g. of a CRN ensemble
+        # @:param column a name of RESULT_COLUMNS
+        # @:return an array of shape (rounds, members), the column of the reference member is 0
+        values = np.asarray(self.resultBuffer.view()[:, :, RESULT_COLUMNS.index(column)])
+        return values - values[:, [reference]]
+
+    def single_round(self):
+
+        # the bid price of this round
+        bid_price = self.__calculate_bid()
+
+        # append info of this round to self.result, written in place
+        # the rows of members stopped early are NaN
+        row = self.resultBuffer.next_row()
+        if len(self.active) == self.members:
+            row[:, 0] = self.round
+            row[:, 1] = self.totalBalance
+            row[:, 2] = bid_price
+            row[:, 3] = self.transactionFeePredict
+        else:
+            row[:] = np.nan
+            row[self.active, 0] = self.round
+            row[self.active, 1] = self.totalBalance
+            row[self.active, 2] = bid_price
+            row[self.active, 3] = self.transactionFeePredict
+
+        # update totalBalance, blockReward, miningCost and exchangeCoefficient for the next round
+        self.totalBalance += self.blockReward
+        self.totalBalance -= self.bidWinner * bid_price
+        if self.anyBlockRewardUpdate:
+            np.copyto(self.blockReward, self.blockRewardRate * self.totalBalance,
+                      where=self.update_block_reward_mask)
+        if self.anyMiningCostUpdate:
+            np.copyto(self.miningExpense, self.miningExpenseRate * self.totalBalance,
+                      where=self.update_mining_cost_mask)
+        self.exchangeCoefficient += (self.exCoeffConstant * np.power(self.totalBalance, self.gamma)
+                                     - self.exchangeCoefficient) * self.updateRate
+
+        # update transaction fee for the next round
+        expected_fee = self.totalBalance * self.exchangeCoefficient
+        noise = self.normalStream.take_one() if self.crn else self.normalStream.take(len(self.active))
+        self.transactionFeePredict = expected_fee + expected_fee / 40 * noise
+
+        # make perturbations
+        self.__make_perturbations()
+
+        # update round number
+        self.round += 1
+
+    def run(self, n_rounds, detector=None):
+
+        # simulate n_rounds rounds for all members
+        # @:param detector an optional ConvergenceDetector of all members observing their total balance,
+        #                  a member stops as soon as it is decided, and the run ends when all have stopped
+        self.resultBuffer.reserve(len(self.resultBuffer) + n_rounds)
+        if detector is not None:
+            detector.relax(self.updateRate, self.active)
+        for _ in range(n_rounds):
+            if len(self.active) == 0:
+                return
+            if detector is None:
+                self.single_round()
+                continue
+            rnd, total_balance = self.round, self.totalBalance.copy()
+            self.single_round()
+            decided = detector.update(rnd, total_balance, self.active)
+            if len(decided):
+                self.stop_members(decided, [detector.reason(i) for i in decided], detector.stopRound[decided])
+
+    def stop_members(self, members, reasons, rounds):
+
+        # stop members early, they are removed from the vector state so that later rounds skip them
+        # @:param members the indices of the members, with the reason and the round of each stop
+        for i, reason, rnd in zip(members, reasons, rounds):
+            self.stopReason[i] = reason
+            self.stopRound[i] = rnd
+        keep = ~np.isin(self.active, members)
+        for name in self.memberFields:
+            setattr(self, name, getattr(self, name)[keep])
+        self.active = self.active[keep]
+        self.anyMiningCostUpdate = bool(self.update_mining_cost_mask.any())
+        self.anyBlockRewardUpdate = bool(self.update_block_reward_mask.any())
+        if len(self.active):
+            self.timeline = EnsembleTimeline([self.perturbation_schedules[i] for i in self.active])
+        self.resultBuffer.annotations.update(stopReason=list(self.stopReason), stopRound=self.stopRound.tolist())
+
+    def __calculate_bid(self):
+
+        # sample the mean mining cost of bidWinner * 20 bidders for every member
+        mining_cost = self.__sample_mining_cost(self.bidWinner * 20)
+
+        # the expected yield rate of bidders
+        yield_rate = 1.05
+
+        # bid price for a single bidder
+        return ((self.blockReward + self.transactionFeePredict) / self.bidWinner - mining_cost) / yield_rate
+
+    def __sample_mining_cost(self, sample_times):
+
+        if self.crn:
+            return self.__sample_common_mining_cost(sample_times)
+
+        # the sum of sample_times geometric variates is sample_times + NegativeBinomial(sample_times, p)
+        p = 1.0 / self.miningExpense
+        feedback = np.floor((sample_times + self.generator.negative_binomial(sample_times, p)) / sample_times)
+
+        # ensure that feedback is positive, or sample feedback again for those members
+        while feedback.min() <= 0:
+            retry = feedback <= 0
+            feedback[retry] = np.floor((sample_times[retry] + self.generator.negative_binomial(
+                sample_times[retry], p[retry])) / sample_times[retry])
+
+        return feedback
+
+    def __sample_common_mining_cost(self, sample_times):
+
+        # the mean of sample_times geometric variates for every member, from exponential variates shared by all
+        # members (a member with fewer samples uses the first ones); a geometric variate is at least 1,
+        # so the feedback is always positive
+        exponentials = self.exponentialStream.take(int(sample_times.max()))
+        scale = -np.log1p(-1.0 / self.miningExpense)
+        costs = np.floor(exponentials / scale[:, np.newaxis]) + 1
+        if sample_times.min() == len(exponentials):
+            return np.floor(costs.mean(axis=1))
+        costs[np.arange(len(exponentials)) >= sample_times[:, np.newaxis]] = 0
+        return np.floor(costs.sum(axis=1) / sample_times)
+
+    def __make_perturbations(self):
+
+        # apply the perturbations of all members due at the end of this round, if any
+        self.timeline.apply(self, self.round)
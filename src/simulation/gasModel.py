@@ -0,0 +1,512 @@
+import argparse
+from collections import Counter
+import numpy as np
+
+# gas schedules of the storage, hashing and logging operations used by aucMint
+#   istanbul: EIP-2200 net gas metering, the schedule when the contract was written
+#   london:   EIP-2929 cold/warm access and EIP-3529 reduced refunds
+# loop and call are rough costs of the stack operations of a loop iteration and an internal call,
+# calldata is charged as if all bytes were non-zero
+GAS_SCHEDULES = {
+    "istanbul": dict(transaction=21000, calldata=16, sload=800, cold=0, sstore_set=20000, sstore_reset=5000,
+                     clear_refund=15000, refund_quotient=2, keccak=30, keccak_word=6, log=375, log_topic=375,
+                     log_byte=8, loop=50, call=60, block_gas_limit=12500000),
+    "london": dict(transaction=21000, calldata=16, sload=100, cold=2100, sstore_set=20000, sstore_reset=2900,
+                   clear_refund=4800, refund_quotient=5, keccak=30, keccak_word=6, log=375, log_topic=375,
+                   log_byte=8, loop=50, call=60, block_gas_limit=30000000),
+}
+
+# the flags of the packed bool slot of a Bid
+ALREADY_REVEALED = 1
+SEASONABLE = 2
+
+
+# raised when a transaction uses more gas than the cap of its meter
+class OutOfGas(Exception):
+    pass
+
+
+# gas meter of a single transaction
+# storage accesses are priced with EIP-2200 net gas metering, and EIP-2929 cold surcharges if the schedule has them;
+# every operation is counted, so that a transaction can be broken down by operation
+class GasMeter:
+
+    def __init__(self, storage, schedule, gas_cap=None):
+
+        self.storage = storage
+        self.schedule = schedule
+        self.gasCap = gas_cap
+        self.gas = 0
+        self.refund = 0
+        self.counts = Counter()
+        # the values of the accessed slots at the start of the transaction, and the warm slots
+        self.original = {}
+
+    def charge(self, operation, gas, count=1):
+
+        self.counts[operation] += count
+        self.gas += gas
+        if self.gasCap is not None and self.gas > self.gasCap:
+            raise OutOfGas()
+
+    def __touch(self, key):
+
+        # the first access of a slot makes it warm, and is cold under EIP-2929
+        if key not in self.original:
+            self.original[key] = self.storage.get(key, 0)
+            if self.schedule["cold"]:
+                self.charge("cold", self.schedule["cold"])
+
+    def keccak(self, words=2, count=1):
+
+        # hashes of mapping keys and array locations, 64 bytes by default
+        self.charge("keccak", count * (self.schedule["keccak"] + self.schedule["keccak_word"] * words), count)
+
+    def sload(self, key, hashes=0):
+
+        if hashes:
+            self.keccak(count=hashes)
+        self.__touch(key)
+        self.charge("sload", self.schedule["sload"])
+        return self.storage.get(key, 0)
+
+    def sstore(self, key, value, hashes=0):
+
+        if hashes:
+            self.keccak(count=hashes)
+        self.__touch(key)
+        schedule = self.schedule
+        original = self.original[key]
+        current = self.storage.get(key, 0)
+
+        # EIP-2200
+        if current == value:
+            self.charge("sstore_noop", schedule["sload"])
+        elif original == current:
+            if original == 0:
+                self.charge("sstore_set", schedule["sstore_set"])
+            else:
+                self.charge("sstore_reset", schedule["sstore_reset"])
+                if value == 0:
+                    self.refund += schedule["clear_refund"]
+        else:
+            self.charge("sstore_dirty", schedule["sload"])
+            if original != 0:
+                if current == 0:
+                    self.refund -= schedule["clear_refund"]
+                elif value == 0:
+                    self.refund += schedule["clear_refund"]
+            if original == value:
+                self.refund += (schedule["sstore_set"] if original == 0 else schedule["sstore_reset"]) \
+                    - schedule["sload"]
+
+        if value == 0:
+            self.storage.pop(key, None)
+        else:
+            self.storage[key] = value
+
+    def log(self, data_bytes, topics=1):
+
+        schedule = self.schedule
+        self.charge("log", schedule["log"] + topics * schedule["log_topic"] + data_bytes * schedule["log_byte"])
+
+    def loop(self, count=1):
+
+        self.charge("loop", count * self.schedule["loop"], count)
+
+    def call(self):
+
+        self.charge("call", self.schedule["call"])
+
+    def used(self):
+
+        # the gas used by the transaction after refunds, which are capped by the refund quotient
+        return self.gas - min(max(self.refund, 0), self.gas // self.schedule["refund_quotient"])
+
+
+# storage-level model of aucMint and the ERC20Modified functions it calls
+# The functions follow the contract statement by statement, including the recursive liquidation of
+# earlier rounds, the re-reading of array lengths in loop conditions, the quickSort directly on storage
+# (quadratic on equal bids), and the missing liquidated flag of rounds with more than bidWinnerNumber bids,
+# which makes every later liquidation liquidate them again.
+# Time is not modelled, the caller tells the current auction round.
+class AucMintGasModel:
+
+    def __init__(self, schedule="london", bid_winner=4, block_reward=10000000000000000000, gas_cap=None):
+
+        self.schedule = GAS_SCHEDULES[schedule] if isinstance(schedule, str) else schedule
+        self.gasCap = gas_cap
+
+        # the storage of the contract, slots are keyed by tuples
+        self.storage = {("bidWinnerNumber",): bid_winner, ("blockReward",): block_reward,
+                        ("blindAuctionTime",): 1, ("commitDuration",): 1, ("revealDuration",): 1,
+                        ("roundInfo", 0, "liquidated"): 1}
+
+    def fund(self, account, value):
+
+        # give an account a balance, outside of any transaction
+        self.storage[("balance", account)] = self.storage.get(("balance", account), 0) + value
+        self.storage[("totalSupply",)] = self.storage.get(("totalSupply",), 0) + value
+
+    def __transaction(self, calldata_bytes):
+
+        meter = GasMeter(self.storage, self.schedule, self.gasCap)
+        meter.charge("transaction", self.schedule["transaction"] + calldata_bytes * self.schedule["calldata"])
+        return meter
+
+    def __auction_round(self, meter):
+
+        # auctionRound() and the period modifiers read the timing parameters
+        meter.call()
+        meter.sload(("blindAuctionTime",))
+        meter.sload(("commitDuration",))
+        meter.sload(("revealDuration",))
+
+    def __period(self, meter):
+
+        # inCommitPeriod and inRevealPeriod
+        meter.sload(("blindAuctionTime",))
+        self.__auction_round(meter)
+
+    def __balance(self, meter, account, change):
+
+        meter.call()
+        key = ("balance", account)
+        meter.sstore(key, meter.sload(key, 1) + change, 1)
+
+    def __supply(self, meter, change):
+
+        key = ("totalSupply",)
+        meter.sstore(key, meter.sload(key) + change)
+
+    def __freeze(self, meter, account, value):
+
+        self.__balance(meter, account, -value)
+        meter.log(64)
+
+    def __unfreeze(self, meter, account, value):
+
+        self.__balance(meter, account, value)
+        meter.log(64)
+
+    def __mint(self, meter, account, value):
+
+        self.__supply(meter, value)
+        self.__balance(meter, account, value)
+        meter.log(96)
+
+    def __burn(self, meter, account, value):
+
+        self.__supply(meter, -value)
+        self.__balance(meter, account, -value)
+        meter.log(96)
+
+    def bid(self, bidder, rnd, escrow):
+
+        # aucMint.bid of bidder in round rnd
+        # @:return the meter of the transaction
+        meter = self.__transaction(4 + 64)
+        self.__period(meter)
+        self.__auction_round(meter)
+
+        # roundInfo[round].biddersThisRound.push(msg.sender)
+        length_key = ("roundInfo", rnd, "bidders")
+        length = meter.sload(length_key, 1)
+        meter.sstore(length_key, length + 1)
+        meter.sstore(("roundInfo", rnd, "bidders", length), bidder, 1)
+
+        # roundAddressToBid[msg.sender][round] = Bid(...), the two bools share a slot
+        meter.keccak(count=2)
+        meter.sstore(("bid", bidder, rnd, "blindedBid"), 1)
+        meter.sstore(("bid", bidder, rnd, "escrow"), escrow)
+        meter.sstore(("bid", bidder, rnd, "trueValue"), 0)
+        meter.sstore(("bid", bidder, rnd, "flags"), 0)
+
+        self.__freeze(meter, bidder, escrow)
+        meter.log(64)
+        return meter
+
+    def reveal(self, bidder, rnd, value, current_round=None):
+
+        # aucMint.reveal of bidder for round rnd, in current_round (rnd if None: a seasonable reveal)
+        # @:return the meter of the transaction
+        current_round = rnd if current_round is None else current_round
+        meter = self.__transaction(4 + 96)
+        self.__period(meter)
+
+        # Bid storage bidtoCheck = roundAddressToBid[msg.sender][_round]
+        meter.keccak(count=2)
+        escrow = meter.sload(("bid", bidder, rnd, "escrow"))
+        meter.sload(("bid", bidder, rnd, "flags"))
+        meter.sload(("bid", bidder, rnd, "escrow"))
+        self.__auction_round(meter)
+
+        # the commitment
+        meter.sload(("bid", bidder, rnd, "blindedBid"))
+        meter.keccak()
+        meter.sstore(("bid", bidder, rnd, "trueValue"), value)
+        flags_key = ("bid", bidder, rnd, "flags")
+        meter.sstore(flags_key, meter.sload(flags_key) | ALREADY_REVEALED)
+        if current_round == rnd:
+            meter.sstore(flags_key, meter.sload(flags_key) | SEASONABLE)
+            meter.sload(("bid", bidder, rnd, "escrow"))
+            meter.sload(("bid", bidder, rnd, "trueValue"))
+            self.__unfreeze(meter, bidder, escrow - value)
+        else:
+            meter.sstore(flags_key, meter.sload(flags_key) & ~SEASONABLE)
+            meter.sload(("bid", bidder, rnd, "escrow"))
+            self.__unfreeze(meter, bidder, escrow)
+            meter.sload(("bid", bidder, rnd, "escrow"))
+            self.__burn(meter, bidder, escrow // 2)
+        meter.log(128)
+        return meter
+
+    def liquidation(self, rnd):
+
+        # aucMint.liquidation of round rnd, with all unliquidated rounds before it
+        # @:return the meter of the transaction
+        meter = self.__transaction(4 + 32)
+
+        # the recursion down to the last liquidated round, which then liquidates from the oldest round on
+        chain = []
+        r = rnd
+        while True:
+            meter.call()
+            self.__auction_round(meter)
+            if meter.sload(("roundInfo", r, "liquidated"), 1):
+                break
+            chain.append(r)
+            if r == 0 or meter.sload(("roundInfo", r - 1, "liquidated"), 1):
+                break
+            r -= 1
+
+        for r in reversed(chain):
+            self.__liquidate_round(meter, r)
+        return meter
+
+    def __liquidate_round(self, meter, rnd):
+
+        fee_key = ("roundInfo", rnd, "fee")
+        next_fee_key = ("roundInfo", rnd + 1, "fee")
+        liquidated_key = ("roundInfo", rnd, "liquidated")
+
+        # the mint-only round 0 hands its fee to round 1
+        if rnd == 0:
+            meter.sstore(next_fee_key, meter.sload(next_fee_key, 1) + meter.sload(fee_key, 1), 1)
+            meter.sstore(fee_key, 0, 1)
+            meter.sstore(liquidated_key, 1, 1)
+            return
+
+        # delete seasonableAddresses, which clears every element
+        length = meter.sload(("seasonable",))
+        for i in range(length):
+            meter.loop()
+            meter.sstore(("seasonable", i), 0, 1)
+        meter.sstore(("seasonable",), 0)
+
+        # collect the seasonable bidders, the loop condition reads the array length in every iteration
+        i = 0
+        while True:
+            meter.loop()
+            if i >= meter.sload(("roundInfo", rnd, "bidders"), 1):
+                break
+            bidder = meter.sload(("roundInfo", rnd, "bidders", i), 2)
+            if meter.sload(("bid", bidder, rnd, "flags"), 2) & SEASONABLE:
+                bidder = meter.sload(("roundInfo", rnd, "bidders", i), 2)
+                length = meter.sload(("seasonable",))
+                meter.sstore(("seasonable",), length + 1)
+                meter.sstore(("seasonable", length), bidder, 1)
+            i += 1
+
+        # case 1: no seasonable bidders, the fee piles up
+        n = meter.sload(("seasonable",))
+        if n == 0:
+            meter.sstore(next_fee_key, meter.sload(next_fee_key, 1) + meter.sload(fee_key, 1), 1)
+            meter.sstore(fee_key, 0, 1)
+            meter.sstore(liquidated_key, 1, 1)
+            return
+
+        k = meter.sload(("bidWinnerNumber",))
+        block_reward = meter.sload(("blockReward",))
+
+        # case 2: not more seasonable bidders than winners, everyone pays the highest bid
+        if meter.sload(("seasonable",)) <= k:
+            highest = meter.sload(("bid", meter.sload(("seasonable", 0), 1), rnd, "trueValue"), 2)
+            for i in range(n):
+                meter.loop()
+                meter.sload(("seasonable",))
+                value = meter.sload(("bid", meter.sload(("seasonable", i), 1), rnd, "trueValue"), 2)
+                if value > highest:
+                    highest = meter.sload(("bid", meter.sload(("seasonable", i), 1), rnd, "trueValue"), 2)
+            for i in range(n):
+                meter.loop()
+                meter.sload(("seasonable",))
+                bidder = meter.sload(("seasonable", i), 1)
+                fee = meter.sload(fee_key, 1)
+                self.__unfreeze(meter, bidder, fee // n)
+                self.__mint(meter, meter.sload(("seasonable", i), 1), block_reward // n)
+                bidder = meter.sload(("seasonable", i), 1)
+                self.__unfreeze(meter, bidder, meter.sload(("bid", bidder, rnd, "trueValue"), 2))
+                self.__burn(meter, meter.sload(("seasonable", i), 1), highest)
+            meter.sstore(liquidated_key, 1, 1)
+            return
+
+        # case 3: the bid winners pay the bid of the first loser, the round is not marked as liquidated
+        meter.sload(("seasonable",))
+        meter.sload(("bidWinnerNumber",))
+        self.__quick_sort(meter, n, rnd)
+        meter.sload(("bidWinnerNumber",))
+        price = meter.sload(("bid", meter.sload(("seasonable", k), 1), rnd, "trueValue"), 2)
+        for i in range(k):
+            meter.loop()
+            meter.sload(("bidWinnerNumber",))
+            bidder = meter.sload(("seasonable", i), 1)
+            fee = meter.sload(fee_key, 1)
+            self.__unfreeze(meter, bidder, fee // k)
+            self.__mint(meter, meter.sload(("seasonable", i), 1), block_reward // k)
+            bidder = meter.sload(("seasonable", i), 1)
+            self.__unfreeze(meter, bidder, meter.sload(("bid", bidder, rnd, "trueValue"), 2))
+            self.__burn(meter, meter.sload(("seasonable", i), 1), price)
+        for i in range(k, n):
+            meter.loop()
+            meter.sload(("seasonable",))
+            bidder = meter.sload(("seasonable", i), 1)
+            self.__unfreeze(meter, bidder, meter.sload(("bid", bidder, rnd, "trueValue"), 2))
+
+    def __value(self, meter, index, rnd):
+
+        # roundAddressToBid[seasonableAddresses[index]][round].trueValue
+        return meter.sload(("bid", meter.sload(("seasonable", index), 1), rnd, "trueValue"), 2)
+
+    def __quick_sort(self, meter, n, rnd):
+
+        # the contract's recursive quickSort in descending order, run with an explicit stack in the same order
+        stack = [(0, n - 1)]
+        while stack:
+            left, right = stack.pop()
+            meter.call()
+            if left >= right:
+                continue
+            key = self.__value(meter, left, rnd)
+            i, j = left, right
+            while i < j:
+                meter.loop()
+                while i < j and self.__value(meter, j, rnd) <= key:
+                    meter.loop()
+                    j -= 1
+                while i < j and self.__value(meter, i, rnd) >= key:
+                    meter.loop()
+                    i += 1
+                self.__swap(meter, i, j)
+            self.__swap(meter, left, i)
+
+            # quickSort(left, i - 1) runs before quickSort(i + 1, right)
+            if i != meter.sload(("seasonable",)) - 1:
+                stack.append((i + 1, right))
+            if i != 0:
+                stack.append((left, i - 1))
+
+    def __swap(self, meter, i, j):
+
+        temp = meter.sload(("seasonable", i), 1)
+        meter.sstore(("seasonable", i), meter.sload(("seasonable", j), 1), 1)
+        meter.sstore(("seasonable", j), temp, 1)
+
+
+'''
+the gas of a liquidation after rounds of bids, all transactions with the same schedule
+@:param bidders the number of bidders in every round
+@:param backlog the number of rounds liquidated by the liquidation, the rounds since the last liquidated one
+@:param equal_bids True for bids of the same value, the worst case of quickSort
+@:param seasonable_fraction the fraction of bidders revealing in time
+@:param gas_cap stop the liquidation when it uses more gas than this, None for no cap
+@:return a dict with the gas of every bid, every reveal and the liquidation (None if it hit the cap),
+         and the operation counts of the liquidation
+'''
+def profile_liquidation(bidders, backlog=1, schedule="london", bid_winner=4, equal_bids=False,
+                        seasonable_fraction=1.0, gas_cap=None, seed=None):
+
+    generator = np.random.default_rng(seed)
+    model = AucMintGasModel(schedule, bid_winner)
+    bid_gas = []
+    reveal_gas = []
+    for rnd in range(1, backlog + 1):
+        values = np.full(bidders, 10 ** 12) if equal_bids else generator.integers(10 ** 11, 10 ** 13, bidders)
+        in_time = generator.random(bidders) < seasonable_fraction
+        for bidder in range(bidders):
+            model.fund(bidder, 10 ** 15)
+            escrow = int(values[bidder]) * 2
+            bid_gas.append(model.bid(bidder, rnd, escrow).used())
+            reveal_gas.append(model.reveal(bidder, rnd, int(values[bidder]),
+                                           rnd if in_time[bidder] else rnd + 1).used())
+
+    model.gasCap = gas_cap
+    try:
+        meter = model.liquidation(backlog)
+        liquidation_gas, counts = meter.used(), dict(meter.counts)
+    except OutOfGas:
+        liquidation_gas, counts = None, {}
+    return dict(bidders=bidders, backlog=backlog, bid=float(np.mean(bid_gas)) if bid_gas else 0.0,
+                reveal=float(np.mean(reveal_gas)) if reveal_gas else 0.0, liquidation=liquidation_gas,
+                counts=counts)
+
+
+'''
+sweep bidder counts and backlog depths, and report where a liquidation exceeds the block gas limit
+@:return a list of profile_liquidation results, each with "fits" telling if the liquidation fits into a block
+'''
+def sweep_liquidation(bidder_counts, backlogs=(1,), schedule="london", block_gas_limit=None, **kwargs):
+
+    limit = block_gas_limit or GAS_SCHEDULES[schedule]["block_gas_limit"]
+    rows = []
+    for backlog in backlogs:
+        for bidders in bidder_counts:
+            row = profile_liquidation(bidders, backlog, schedule, gas_cap=limit, **kwargs)
+            row["fits"] = row["liquidation"] is not None
+            rows.append(row)
+    return rows
+
+
+'''
+the largest number of bidders per round whose liquidation fits into a block, found by bisection
+@:param upper a number of bidders known not to fit, doubled until it does not fit if it does
+'''
+def max_bidders(backlog=1, schedule="london", block_gas_limit=None, upper=64, **kwargs):
+
+    limit = block_gas_limit or GAS_SCHEDULES[schedule]["block_gas_limit"]
+
+    def fits(bidders):
+        return profile_liquidation(bidders, backlog, schedule, gas_cap=limit, **kwargs)["liquidation"] is not None
+
+    lower = 0
+    while fits(upper):
+        lower, upper = upper, 2 * upper
+    while upper - lower > 1:
+        middle = (lower + upper) // 2
+        if fits(middle):
+            lower = middle
+        else:
+            upper = middle
+    return lower
+
+
+# the main function to profile the gas of liquidation
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="model the gas cost of aucMint liquidation")
+    parser.add_argument("--schedule", default="london", choices=sorted(GAS_SCHEDULES))
+    parser.add_argument("--bidders", type=int, nargs="+", default=[5, 10, 20, 50, 100, 200, 500])
+    parser.add_argument("--backlogs", type=int, nargs="+", default=[1, 2, 5, 10])
+    parser.add_argument("--equal-bids", action="store_true", help="bids of the same value, quickSort's worst case")
+    parser.add_argument("--block-gas-limit", type=int, help="the default of the schedule if not given")
+    arguments = parser.parse_args()
+
+    print("%8s %8s %10s %10s %14s" % ("backlog", "bidders", "bid", "reveal", "liquidation"))
+    for row in sweep_liquidation(arguments.bidders, arguments.backlogs, arguments.schedule,
+                                 arguments.block_gas_limit, equal_bids=arguments.equal_bids, seed=2020):
+        print("%8d %8d %10.0f %10.0f %14s" % (row["backlog"], row["bidders"], row["bid"], row["reveal"],
+                                             row["liquidation"] if row["fits"] else "> block limit"))
+    for backlog in arguments.backlogs:
+        print("backlog %d: at most %d bidders per round" % (
+            backlog, max_bidders(backlog, arguments.schedule, arguments.block_gas_limit,
+                                 equal_bids=arguments.equal_bids, seed=2020)))
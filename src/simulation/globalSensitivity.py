@@ -0,0 +1,323 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .simulation import Simulation
+from .convergence import ConvergenceDetector
+
+# the summaries of a run, the outputs of a sensitivity analysis
+#   final_supply     the mean total balance over the last window of the run
+#   window_variance  the variance of the total balance over the last window, relative to its squared mean
+#   settle_round     the first round after which the total balance stays within settle_tolerance of final_supply
+SUMMARY_NAMES = ("final_supply", "window_variance", "settle_round")
+
+# Sobol indices of every output (rows) and factor (columns), estimated from n row groups of a Saltelli design
+# first and total are the first-order (Saltelli 2010) and total (Jansen 1999) indices, with bootstrap standard
+# errors if requested (NaN otherwise); runs is the number of simulations evaluated
+SobolIndices = namedtuple("SobolIndices", ("factors", "outputs", "first", "total", "first_error", "total_error",
+                                           "groups", "runs"))
+
+# Morris elementary effect statistics of every output (rows) and factor (columns), in units of the factor range
+# mu is the mean effect, mu_star the mean absolute effect and sigma the standard deviation of the effects
+MorrisIndices = namedtuple("MorrisIndices", ("factors", "outputs", "mu", "mu_star", "sigma", "trajectories", "runs"))
+
+
+'''
+the value of a factor for a unit coordinate u in [0, 1]
+@:param spec (low, high) for a uniform range, (low, high, "log") for a log-uniform range,
+             (low, high, "int") for integers from low to high, or a list of choices, e.g. [False, True]
+'''
+def factor_value(spec, u):
+
+    if isinstance(spec, list):
+        return spec[min(int(u * len(spec)), len(spec) - 1)]
+    low, high = spec[:2]
+    kind = spec[2] if len(spec) > 2 else "linear"
+    if kind == "log":
+        return float(low * (high / low) ** u)
+    if kind == "int":
+        return int(min(low + int(u * (high - low + 1)), high))
+    if kind == "linear":
+        return float(low + u * (high - low))
+    raise ValueError("unknown factor kind %r, expected 'linear', 'log' or 'int'" % (kind,))
+
+
+'''
+the Simulation keyword arguments of a design point
+factors are Simulation keyword arguments, or kex0 (the initial exchange coefficient tf / tb) and
+reward_ratio (br / me), which set tf and br from the base values of tb and me
+@:param base the Simulation keyword arguments shared by all runs
+@:param point a dict of factor values
+'''
+def point_arguments(base, point):
+
+    arguments = dict(base)
+    for name, value in point.items():
+        if name == "kex0":
+            arguments["tf"] = value * arguments["tb"]
+        elif name == "reward_ratio":
+            arguments["br"] = value * arguments["me"]
+        else:
+            arguments[name] = value
+    return arguments
+
+
+'''
+the summaries of a simulation result, see SUMMARY_NAMES
+a result with a value that is not finite or not positive has NaN summaries
+'''
+def summarize(result, window, settle_tolerance):
+
+    balance = np.asarray(result)[:, 1]
+    if not (np.isfinite(balance).all() and (balance > 0).all()):
+        return np.full(len(SUMMARY_NAMES), np.nan)
+    last = balance[-min(window, len(balance)):]
+    final = last.mean()
+    unsettled = np.flatnonzero(np.abs(balance - final) > settle_tolerance * final)
+    settle_round = 0 if len(unsettled) == 0 else unsettled[-1] + 1
+    return np.array([final, last.var() / final ** 2, settle_round], dtype=np.float64)
+
+
+'''
+run the simulations of some design points in a worker process
+@:return an array with the summaries of every point
+'''
+def evaluate_points(base, points, seeds, rounds, window, settle_tolerance, convergence=None):
+
+    summaries = np.empty((len(points), len(SUMMARY_NAMES)))
+    with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+        for i, (point, seed) in enumerate(zip(points, seeds)):
+            simulation = Simulation(**dict(point_arguments(base, point), tt=False, horizon=rounds, seed=seed))
+            simulation.run(rounds, None if convergence is None else ConvergenceDetector(**convergence))
+            summaries[i] = summarize(simulation.result, window, settle_tolerance)
+    return summaries
+
+
+# global sensitivity analysis of Simulation over ranges of many factors at once
+# A design of points in the unit hypercube is mapped to the factor ranges (see factor_value), every point is
+# simulated for `rounds` rounds on all cores, and every run is reduced to its summaries (see SUMMARY_NAMES).
+#   latin_hypercube  a space-filling design and its summaries, e.g. for scatter plots or a surrogate model
+#   sobol            first-order and total Sobol indices from a Saltelli design of n (k + 2) runs for k factors
+#   morris           elementary effect screening from r trajectories of k + 1 runs, far cheaper than sobol
+# The runs of a Sobol row group or a Morris trajectory share their seed, so that the differences the indices are
+# computed from are the effects of the factors, not of the noise. A budget of rounds fixes the size of a design
+# in advance, and a time budget stops the evaluation after the groups finished within it; indices are computed
+# from the complete groups, groups with a diverged run (NaN summaries) are left out.
+class SensitivityAnalysis:
+
+    def __init__(self, base, factors, rounds, window=5000, settle_tolerance=0.01, convergence=None, seed=None,
+                 max_workers=None, progress=None):
+
+        # the Simulation keyword arguments shared by all runs, and the ranges of the factors
+        self.base = dict(base)
+        self.factors = dict(factors)
+        self.factorNames = list(self.factors)
+        self.rounds = int(rounds)
+
+        # the summaries, and an optional early stop of every run (ConvergenceDetector keyword arguments)
+        self.window = int(window)
+        self.settleTolerance = settle_tolerance
+        self.convergence = convergence
+
+        self.seedSequence = np.random.SeedSequence(seed)
+        self.maxWorkers = max_workers or os.cpu_count() or 1
+        self.progress = progress
+
+    def points(self, unit):
+
+        # the factor values of the rows of a unit design
+        return [{name: factor_value(self.factors[name], u) for name, u in zip(self.factorNames, row)}
+                for row in np.asarray(unit)]
+
+    def __design_size(self, size, budget_rounds, runs_per_group, minimum):
+
+        # the number of groups of a design, given directly or by a budget of rounds
+        if size is None:
+            if budget_rounds is None:
+                raise ValueError("either the design size or budget_rounds must be given")
+            size = int(budget_rounds // (self.rounds * runs_per_group))
+        if size < minimum:
+            raise ValueError("the budget allows %d groups of %d runs, at least %d are needed"
+                             % (size, runs_per_group, minimum))
+        return size
+
+    def evaluate(self, points, groups, time_budget=None):
+
+        # simulate the points on all cores, in groups of consecutive points sharing a seed
+        # @:param groups the number of points of every group
+        # @:param time_budget seconds after which no further group is started, None for no limit
+        # @:return the summaries of every point, and the number of complete groups (from the first on)
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        group_count = len(points) // groups
+        seeds = self.seedSequence.spawn(group_count)
+        summaries = np.full((len(points), len(SUMMARY_NAMES)), np.nan)
+        arguments = (self.rounds, self.window, self.settleTolerance, self.convergence)
+
+        # a chunk is a few consecutive groups, at most two chunks per worker are in flight
+        # with a time budget, single groups are started one worker at a time, so the budget is not overrun
+        chunk_groups = 1 if deadline is not None else max(1, min(64, group_count // (4 * self.maxWorkers)))
+        in_flight = self.maxWorkers if deadline is not None else 2 * self.maxWorkers
+        chunks = [range(start, min(start + chunk_groups, group_count))
+                  for start in range(0, group_count, chunk_groups)]
+        done = 0
+
+        def collect(chunk, future_summaries):
+            nonlocal done
+            summaries[chunk.start * groups:chunk.stop * groups] = future_summaries
+            done = chunk.stop
+            if self.progress is not None:
+                self.progress(done, group_count)
+
+        # every run of a group gets its own copy of the group seed, a sampler spawns from (and changes) its seed
+        def job(chunk):
+            return (self.base, points[chunk.start * groups:chunk.stop * groups],
+                    [np.random.SeedSequence(seeds[g].entropy, spawn_key=seeds[g].spawn_key)
+                     for g in chunk for _ in range(groups)]) + arguments
+
+        if self.maxWorkers == 1:
+            for chunk in chunks:
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                collect(chunk, evaluate_points(*job(chunk)))
+            return summaries, done
+
+        with ProcessPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = []
+            for chunk in chunks:
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                futures.append((chunk, executor.submit(evaluate_points, *job(chunk))))
+                if len(futures) >= in_flight:
+                    chunk, future = futures.pop(0)
+                    collect(chunk, future.result())
+            for chunk, future in futures:
+                collect(chunk, future.result())
+        return summaries, done
+
+    def latin_hypercube(self, n=None, budget_rounds=None, time_budget=None):
+
+        # @:return (points, summaries) of the evaluated points of a Latin hypercube design
+        from scipy.stats import qmc
+        n = self.__design_size(n, budget_rounds, 1, 1)
+        unit = qmc.LatinHypercube(len(self.factorNames), seed=self.__generator()).random(n)
+        points = self.points(unit)
+        summaries, done = self.evaluate(points, 1, time_budget)
+        return points[:done], summaries[:done]
+
+    def sobol(self, n=None, budget_rounds=None, time_budget=None, bootstrap=0):
+
+        # Sobol indices from a Saltelli design with n row groups, n is rounded down to a power of two
+        # every row group is the rows of the matrices A, B and the k matrices AB_i (A with column i of B)
+        # @:param bootstrap the number of bootstrap resamples of the row groups for the standard errors
+        # @:return a SobolIndices
+        from scipy.stats import qmc
+        k = len(self.factorNames)
+        n = self.__design_size(n, budget_rounds, k + 2, 2)
+        n = 1 << (n.bit_length() - 1)
+        unit = qmc.Sobol(2 * k, seed=self.__generator()).random_base2(int(np.log2(n)))
+        a, b = unit[:, :k], unit[:, k:]
+        rows = [a, b]
+        for i in range(k):
+            ab = a.copy()
+            ab[:, i] = b[:, i]
+            rows.append(ab)
+
+        # the runs of a row group are consecutive, so that a time budget leaves complete groups
+        design = np.stack(rows, axis=1).reshape(n * (k + 2), k)
+        summaries, done = self.evaluate(self.points(design), k + 2, time_budget)
+        values = summaries[:done * (k + 2)].reshape(done, k + 2, len(SUMMARY_NAMES))
+        values = values[np.isfinite(values).all(axis=(1, 2))]
+
+        first, total = sobol_indices(values)
+        first_error = np.full_like(first, np.nan)
+        total_error = np.full_like(total, np.nan)
+        if bootstrap and len(values) > 1:
+            generator = self.__generator()
+            samples = [sobol_indices(values[generator.integers(0, len(values), len(values))])
+                       for _ in range(bootstrap)]
+            first_error = np.std([sample[0] for sample in samples], axis=0, ddof=1)
+            total_error = np.std([sample[1] for sample in samples], axis=0, ddof=1)
+        return SobolIndices(list(self.factorNames), SUMMARY_NAMES, first, total, first_error, total_error,
+                            len(values), done * (k + 2))
+
+    def morris(self, trajectories=None, levels=4, budget_rounds=None, time_budget=None):
+
+        # Morris elementary effects from trajectories on a grid of levels values per factor
+        # every trajectory starts at a random grid point and moves every factor once, in random order,
+        # by delta = levels / (2 (levels - 1)) up or down
+        # @:return a MorrisIndices
+        k = len(self.factorNames)
+        r = self.__design_size(trajectories, budget_rounds, k + 1, 1)
+        generator = self.__generator()
+        delta = levels / (2 * (levels - 1))
+        design = np.empty((r, k + 1, k))
+        order = np.empty((r, k), dtype=np.int64)
+        steps = np.empty((r, k))
+        for t in range(r):
+            x = generator.integers(0, levels, k) / (levels - 1)
+            design[t, 0] = x
+            order[t] = generator.permutation(k)
+            for j, i in enumerate(order[t]):
+                steps[t, j] = delta if x[i] + delta <= 1 else -delta
+                x = x.copy()
+                x[i] += steps[t, j]
+                design[t, j + 1] = x
+
+        summaries, done = self.evaluate(self.points(design.reshape(r * (k + 1), k)), k + 1, time_budget)
+        values = summaries[:done * (k + 1)].reshape(done, k + 1, len(SUMMARY_NAMES))
+        complete = np.isfinite(values).all(axis=(1, 2))
+        values, order, steps = values[complete], order[:done][complete], steps[:done][complete]
+
+        # the elementary effect of every trajectory, output and factor
+        effects = np.empty((len(values), len(SUMMARY_NAMES), k))
+        differences = (values[:, 1:] - values[:, :-1]) / steps[:, :, np.newaxis]
+        for t in range(len(values)):
+            effects[t][:, order[t]] = differences[t].T
+        with np.errstate(invalid="ignore"):
+            return MorrisIndices(list(self.factorNames), SUMMARY_NAMES, effects.mean(axis=0),
+                                 np.abs(effects).mean(axis=0), effects.std(axis=0, ddof=1) if len(effects) > 1
+                                 else np.full(effects.shape[1:], np.nan), len(values), done * (k + 1))
+
+    def __generator(self):
+
+        # a generator for the design, independent of the seeds of the runs
+        return np.random.default_rng(self.seedSequence.spawn(1)[0])
+
+
+'''
+first-order and total Sobol indices from the outputs of Saltelli row groups
+@:param values an array of shape (groups, k + 2, outputs), the outputs of A, B and AB_1 ... AB_k in every group
+@:return (first, total), arrays of shape (outputs, k)
+'''
+def sobol_indices(values):
+
+    # the estimators take differences of products of outputs, which lose all precision for an output with a large
+    # mean (e.g. a total supply of 1e12) unless the outputs are centered first
+    values = values - np.concatenate([values[:, 0], values[:, 1]]).mean(axis=0)
+    f_a, f_b, f_ab = values[:, 0], values[:, 1], values[:, 2:]
+    variance = np.concatenate([f_a, f_b]).var(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        first = (f_b[:, np.newaxis] * (f_ab - f_a[:, np.newaxis])).mean(axis=0) / variance
+        total = ((f_a[:, np.newaxis] - f_ab) ** 2).mean(axis=0) / 2 / variance
+    return first.T, total.T
+
+
+if __name__ == '__main__':
+
+    from scipy.stats import qmc
+
+    # an additive function x1 + 2 * x2 of uniform factors has S1 = ST = (1, 4) / 5, with or without an offset
+    groups, k = 4096, 2
+    samples = qmc.Sobol(2 * k, seed=1).random(groups)
+    a, b = samples[:, :k], samples[:, k:]
+    design = np.empty((groups, k + 2, k))
+    design[:, 0], design[:, 1] = a, b
+    for i in range(k):
+        design[:, i + 2] = a
+        design[:, i + 2, i] = b[:, i]
+    outputs = design @ np.array([1.0, 2.0])
+    for offset in (0.0, 1e12):
+        first, total = sobol_indices((outputs + offset)[:, :, np.newaxis])
+        assert np.allclose(first[0], [0.2, 0.8], atol=0.02), (offset, first)
+        assert np.allclose(total[0], [0.2, 0.8], atol=0.02), (offset, total)
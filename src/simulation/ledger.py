@@ -0,0 +1,318 @@
+import copy
+import numpy as np
+from .statHelper import seed_description, array_digest
+
+# the transaction fee of aucMint, calculateTxFee keeps value / 10000 (rounded down) of every transaction
+FEE_DIVISOR = 10000
+
+# the kinds of ledger transactions, by code
+#   transfer  transfer(to, value): the sender pays value, the receiver gets value - fee
+#   mint      mintTo(to): value tokens are minted, the receiver gets value - fee
+#   withdraw  withdrawEther(value): the sender pays value, value - fee is burnt for ether
+#   freeze    an auction escrow (bid), value is moved from the balance into the escrow, without a fee
+# the fee of a transaction is frozen into the fee pool of the current round
+TRANSACTION_KINDS = ("transfer", "mint", "withdraw", "freeze")
+TRANSFER, MINT, WITHDRAW, FREEZE = range(len(TRANSACTION_KINDS))
+
+
+# token ledger following the accounting of ERC20Modified and aucMint
+# Balances and frozen escrows are int64 arrays indexed by account id, amounts are integers in the smallest
+# token unit (int64 holds supplies up to 9.2e18 units). Transactions are replayed in vectorized batches with
+# the semantics of executing them one by one: a transaction that would overdraw its sender is reverted.
+# A batch is applied at once when every sender can pay all of its transactions in it from its balance. Otherwise
+# only the accounts that cannot (short accounts) need care: the transactions that neither pay from nor to a short
+# account are valid in any order and do not change the balance of a short account, so those are applied in bulk,
+# and the transactions involving short accounts are replayed one by one, in order.
+# The fees of a round are pooled and paid out by close_round as aucMint.liquidation does: the pool of round 0
+# (the mint-only round) and of a round without winners is carried over to the next round, otherwise every
+# winner gets pool // winners, and the rounding remainder stays frozen in the contract for good.
+class TokenLedger:
+
+    def __init__(self, accounts, balances=None):
+
+        self.accounts = int(accounts)
+        self.balances = np.zeros(self.accounts, dtype=np.int64) if balances is None \
+            else np.array(balances, dtype=np.int64)
+        self.frozen = np.zeros(self.accounts, dtype=np.int64)
+        self.totalSupply = int(self.balances.sum())
+
+        # the auction round, and the fee pool of every round, grown on demand
+        self.round = 0
+        self.fees = np.zeros(1024, dtype=np.int64)
+
+        # fees left frozen by the integer division of a pool, and tokens burnt for ether
+        self.lockedFees = 0
+        self.withdrawn = 0
+
+        # the number of replayed and of reverted transactions
+        self.transactions = 0
+        self.reverted = 0
+
+    @classmethod
+    def from_supply(cls, accounts, total_supply, concentration=1.0, seed=None):
+
+        # a ledger whose supply is minted in round 0 to accounts with log-normal weights,
+        # so that the mint fees of round 0 are pooled and carried over to round 1 as in the contract
+        # @:param concentration the sigma of the log-normal weights, 0 for equal balances
+        generator = np.random.default_rng(seed)
+        weights = np.exp(concentration * generator.standard_normal(int(accounts)))
+        values = np.floor(weights / weights.sum() * total_supply).astype(np.int64)
+        ledger = cls(accounts)
+        ledger.mint(np.arange(ledger.accounts), values)
+        return ledger
+
+    def pool(self, rnd=None):
+
+        # the fee pool of a round (the current round by default), with the fees carried over to it
+        rnd = self.round if rnd is None else rnd
+        return int(self.fees[rnd]) if rnd < len(self.fees) else 0
+
+    def __grow(self, rnd):
+
+        if rnd >= len(self.fees):
+            fees = np.zeros(max(2 * len(self.fees), rnd + 1), dtype=np.int64)
+            fees[:len(self.fees)] = self.fees
+            self.fees = fees
+
+    def replay(self, kinds, sources, targets, values):
+
+        # replay a batch of transactions in order
+        # @:param kinds the code of every transaction, see TRANSACTION_KINDS
+        # @:param sources the paying account of every transaction, ignored for a mint
+        # @:param targets the receiving account of every transaction, ignored for a withdraw and a freeze
+        # @:param values the amount of every transaction, non-negative integers
+        # @:return a boolean array, False for the transactions that were reverted
+        kinds = np.asarray(kinds, dtype=np.int8)
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+        if len(values) and values.min() < 0:
+            raise ValueError("transaction values must not be negative")
+
+        accepted = np.ones(len(values), dtype=bool)
+        short = self.__short(kinds, sources, values)
+        if short is None:
+            self.__apply(kinds, sources, targets, values)
+        else:
+            # the transactions paying from or to a short account
+            paying = kinds != MINT
+            receiving = (kinds == TRANSFER) | (kinds == MINT)
+            involved = (paying & short[sources]) | (receiving & short[targets])
+            bulk = ~involved
+            self.__apply(kinds[bulk], sources[bulk], targets[bulk], values[bulk])
+            for i in np.flatnonzero(involved).tolist():
+                accepted[i] = self.__apply_one(int(kinds[i]), int(sources[i]), int(targets[i]), int(values[i]))
+
+        self.transactions += len(values)
+        self.reverted += int(np.count_nonzero(~accepted))
+        return accepted
+
+    def __short(self, kinds, sources, values):
+
+        # a mask of the accounts that cannot pay all of their transactions in the batch from their balance,
+        # None if there is none
+        paying = kinds != MINT
+        totals = np.zeros(self.accounts, dtype=np.int64)
+        np.add.at(totals, sources[paying], values[paying])
+        short = totals > self.balances
+        return short if short.any() else None
+
+    def __apply(self, kinds, sources, targets, values):
+
+        fees = np.where(kinds == FREEZE, 0, values // FEE_DIVISOR)
+        paying = kinds != MINT
+        receiving = (kinds == TRANSFER) | (kinds == MINT)
+        minting, withdrawing, freezing = kinds == MINT, kinds == WITHDRAW, kinds == FREEZE
+
+        np.subtract.at(self.balances, sources[paying], values[paying])
+        np.add.at(self.balances, targets[receiving], values[receiving] - fees[receiving])
+        if freezing.any():
+            np.add.at(self.frozen, sources[freezing], values[freezing])
+
+        burnt = int((values[withdrawing] - fees[withdrawing]).sum())
+        self.totalSupply += int(values[minting].sum()) - burnt
+        self.withdrawn += burnt
+        self.fees[self.round] += int(fees.sum())
+
+    def __apply_one(self, kind, source, target, value):
+
+        # a single transaction, reverted if it overdraws its sender
+        # @:return True if it was applied
+        if kind != MINT and self.balances[source] < value:
+            return False
+        fee = 0 if kind == FREEZE else value // FEE_DIVISOR
+        if kind != MINT:
+            self.balances[source] -= value
+        if kind == TRANSFER or kind == MINT:
+            self.balances[target] += value - fee
+        elif kind == FREEZE:
+            self.frozen[source] += value
+        if kind == MINT:
+            self.totalSupply += value
+        elif kind == WITHDRAW:
+            self.totalSupply -= value - fee
+            self.withdrawn += value - fee
+        self.fees[self.round] += fee
+        return True
+
+    def transfer(self, senders, receivers, values):
+
+        return self.replay(np.full(len(values), TRANSFER), senders, receivers, values)
+
+    def mint(self, receivers, values):
+
+        return self.replay(np.full(len(values), MINT), receivers, receivers, values)
+
+    def withdraw(self, senders, values):
+
+        return self.replay(np.full(len(values), WITHDRAW), senders, senders, values)
+
+    def freeze(self, accounts, values):
+
+        return self.replay(np.full(len(values), FREEZE), accounts, accounts, values)
+
+    def unfreeze(self, accounts, values, burn=None):
+
+        # return escrows to their accounts, and burn a part of them (e.g. half of the escrow of a late reveal)
+        # @:raise ValueError if an account has less frozen than is unfrozen
+        accounts = np.asarray(accounts, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+        frozen = np.zeros(self.accounts, dtype=np.int64)
+        np.add.at(frozen, accounts, values)
+        if (frozen > self.frozen).any():
+            raise ValueError("cannot unfreeze more than is frozen")
+        self.frozen -= frozen
+        np.add.at(self.balances, accounts, values)
+        if burn is not None:
+            burn = np.asarray(burn, dtype=np.int64)
+            np.subtract.at(self.balances, accounts, burn)
+            self.totalSupply -= int(burn.sum())
+
+    def close_round(self, winners):
+
+        # liquidate the fee pool of the current round and start the next round
+        # @:param winners the accounts of the bid winners of the round, they share the pool
+        # @:return the fee paid to every winner, 0 if the pool was carried over
+        self.__grow(self.round + 1)
+        pool = int(self.fees[self.round])
+        winners = np.asarray(winners, dtype=np.int64)
+        share = 0
+        if self.round == 0 or len(winners) == 0:
+            self.fees[self.round + 1] += pool
+        else:
+            share = pool // len(winners)
+            np.add.at(self.balances, winners, share)
+            self.lockedFees += pool - share * len(winners)
+        self.fees[self.round] = 0
+        self.round += 1
+        return share
+
+    def digest(self):
+
+        # a digest of the state of the ledger that decides its future, its balances, escrows, fee pools and round
+        scalars = np.array([self.round, self.totalSupply, self.lockedFees, self.withdrawn], dtype=np.int64)
+        return array_digest(self.balances, self.frozen, np.trim_zeros(self.fees, "b"), scalars)
+
+    def check_supply(self):
+
+        # True if every token of the supply is on a balance, in an escrow, in a fee pool or locked
+        return self.totalSupply == int(self.balances.sum()) + int(self.frozen.sum()) \
+            + int(self.fees[self.round:].sum()) + self.lockedFees
+
+
+# synthetic transaction stream for a ledger
+# Every round has a fixed number of transactions of a target volume. Senders are drawn in proportion to their
+# balance, receivers uniformly, and values are log-normal with the mean volume / transactions, but not more
+# than the balance of the sender. Optionally a share of the transactions are mints to random holders and
+# withdrawals, which change the supply of the ledger; by default all are transfers.
+class SyntheticTraffic:
+
+    def __init__(self, transactions=10000, value_sigma=1.0, mint_share=0.0, withdraw_share=0.0, seed=None):
+
+        self.seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.generator = np.random.default_rng(self.seedSequence)
+        self.transactionsPerRound = int(transactions)
+        self.valueSigma = value_sigma
+        self.kindProbabilities = np.array([1 - mint_share - withdraw_share, mint_share, withdraw_share])
+
+        # True once a batch was drawn, the random stream has advanced from its seed from then on
+        self.used = False
+
+        # the parameters of this stream, recorded with the parameters of a simulation and part of cache keys
+        self.parameters = dict(transactions=self.transactionsPerRound, value_sigma=value_sigma,
+                               mint_share=mint_share, withdraw_share=withdraw_share,
+                               seed=seed_description(self.seedSequence))
+
+    def spawn(self, n):
+
+        # n streams with the same parameters and independent random numbers
+        streams = []
+        for seed in self.seedSequence.spawn(n):
+            stream = SyntheticTraffic(self.transactionsPerRound, self.valueSigma, self.kindProbabilities[1],
+                                      self.kindProbabilities[2], seed)
+            streams.append(stream)
+        return streams
+
+    def batch(self, ledger, volume):
+
+        # the transactions of a round with the expected total value volume
+        # @:return (kinds, sources, targets, values) for TokenLedger.replay
+        self.used = True
+        n = self.transactionsPerRound
+        g = self.generator
+        kinds = g.choice(3, n, p=self.kindProbabilities).astype(np.int8)
+        balances = np.cumsum(ledger.balances, dtype=np.float64)
+        sources = np.searchsorted(balances, g.random(n) * balances[-1], side="right")
+        sources = np.minimum(sources, ledger.accounts - 1)
+        targets = g.integers(0, ledger.accounts, n)
+        mean = volume / n
+        values = np.floor(mean * np.exp(self.valueSigma * g.standard_normal(n) - self.valueSigma ** 2 / 2))
+        values = np.where(kinds == MINT, values, np.minimum(values, ledger.balances[sources]))
+        return kinds, sources, targets, values.astype(np.int64)
+
+
+# fee model of a Simulation driven by a ledger replaying synthetic traffic
+# The ledger is one round behind the simulation: the pool of its round r is the fee of simulation round r + 1,
+# so the fees of the mint-only round 0 (e.g. of TokenLedger.from_supply) reach simulation round 2, as the
+# initial fee tf of a simulation is given. At the end of every round the ledger pays its current pool to
+# bidWinner random accounts (round 0 is carried over), replays the traffic of the next round, whose volume is
+# FEE_DIVISOR times the expected fee of the simulation, and returns the new pool as the fee, with the fees
+# carried over to it. The fee follows the expected fee of the macro model, with the noise of discrete
+# transactions, reverted overdrafts, integer fees and carry-overs instead of a normal variate.
+class LedgerFeeModel:
+
+    def __init__(self, ledger, traffic):
+
+        self.ledger = ledger
+        self.traffic = traffic
+
+    @property
+    def parameters(self):
+
+        # the parameters of this model, recorded with the parameters of a simulation and part of cache keys,
+        # with the current state of the ledger, which changes as the model runs
+        return dict(ledger_accounts=self.ledger.accounts, ledger=self.ledger.digest(),
+                    traffic=self.traffic.parameters)
+
+    @property
+    def used(self):
+
+        return self.traffic.used
+
+    def spawn(self, n):
+
+        # n fee models with copies of the ledger and independent traffic, e.g. for forked simulations
+        models = []
+        for traffic in self.traffic.spawn(n):
+            models.append(LedgerFeeModel(copy.deepcopy(self.ledger), traffic))
+        return models
+
+    def __call__(self, simulation, expected_fee):
+
+        # the fee model interface of Simulation, the transaction fee of the round after simulation.round
+        ledger = self.ledger
+        while ledger.round < simulation.round:
+            winners = self.traffic.generator.integers(0, ledger.accounts, int(simulation.bidWinner))
+            ledger.close_round(winners)
+        ledger.replay(*self.traffic.batch(ledger, expected_fee * FEE_DIVISOR))
+        return float(ledger.pool())
@@ -0,0 +1,220 @@
+import os
+import queue
+import threading
+import multiprocessing
+import time
+import numpy as np
+from .draw import decimate
+
+# the series of a live view, (telemetry field, axis label)
+LIVE_SERIES = (("totalBalance", "Total Supply"), ("bidPrice", "Bid Price"), ("transactionFee", "Transaction Fees"))
+
+
+# a time series of bounded size for live plotting
+# points are appended as they come, and when the capacity is reached the series is reduced to its min/max
+# envelope at half the capacity (see draw.decimate), so a refresh costs the same however long the run is
+class LiveSeries:
+
+    def __init__(self, capacity=4096):
+
+        self.capacity = max(int(capacity), 16)
+        self.x = np.empty(self.capacity)
+        self.y = np.empty(self.capacity)
+        self.size = 0
+
+    def extend(self, x, y):
+
+        for start in range(0, len(x), self.capacity // 2):
+            x_part, y_part = x[start:start + self.capacity // 2], y[start:start + self.capacity // 2]
+            if self.size + len(x_part) > self.capacity:
+                kept_x, kept_y = decimate(self.x[:self.size], self.y[:self.size], self.capacity // 4)
+                self.size = len(kept_x)
+                self.x[:self.size], self.y[:self.size] = kept_x, kept_y
+            self.x[self.size:self.size + len(x_part)] = x_part
+            self.y[self.size:self.size + len(y_part)] = y_part
+            self.size += len(x_part)
+
+    def data(self):
+
+        return self.x[:self.size], self.y[:self.size]
+
+
+# the figure of a live view, one axes for every series of LIVE_SERIES over the round number
+# The lines are animated: a refresh restores the cached background, draws the lines and blits them, and only
+# when a point leaves the axis limits are the limits grown (geometrically, so this happens O(log n) times)
+# and the whole figure redrawn. Without a display (headless) the figure is only drawn for snapshots.
+class LivePlot:
+
+    def __init__(self, capacity=4096, headless=False, title=None):
+
+        self.headless = headless
+        if headless:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.figure = Figure(figsize=(8, 8))
+            FigureCanvasAgg(self.figure)
+        else:
+            import matplotlib.pyplot as plt
+            plt.ion()
+            self.figure = plt.figure(figsize=(8, 8))
+        self.axes = self.figure.subplots(len(LIVE_SERIES), 1, sharex=True)
+        self.lines = []
+        for ax, (_, label) in zip(self.axes, LIVE_SERIES):
+            self.lines.append(ax.plot([], [], color="firebrick", animated=not headless)[0])
+            ax.set_ylabel(label)
+            ax.ticklabel_format(axis="both", style="sci", scilimits=(-1, 1), useMathText=True)
+        self.axes[-1].set_xlabel("Round Number")
+        if title is not None:
+            self.figure.suptitle(title)
+
+        self.series = [LiveSeries(capacity) for _ in LIVE_SERIES]
+        self.round = 0
+        self.background = None
+        if not headless:
+            # a resized window invalidates the cached background
+            self.figure.canvas.mpl_connect("resize_event", lambda event: setattr(self, "background", None))
+            self.figure.show()
+
+    def extend(self, rows):
+
+        # append rows of (round, totalBalance, bidPrice, transactionFee)
+        rows = np.asarray(rows, dtype=np.float64)
+        for i, series in enumerate(self.series):
+            series.extend(rows[:, 0], rows[:, i + 1])
+        self.round = int(rows[-1, 0])
+
+    def __rescale(self):
+
+        # set the limits of every axes that does not contain its data any more, with room to grow
+        # @:return True if a limit changed
+        changed = False
+        for ax, series in zip(self.axes, self.series):
+            x, y = series.data()
+            y = y[np.isfinite(y)]
+            if len(y) == 0:
+                continue
+            if self.background is None or x[-1] > ax.get_xlim()[1]:
+                ax.set_xlim(x[0], max(2 * x[-1], x[0] + 1000))
+                changed = True
+            y_low, y_high = ax.get_ylim()
+            low, high = y.min(), y.max()
+            if self.background is None or low < y_low or high > y_high:
+                margin = (high - low) / 4 or abs(high) / 100 or 1.0
+                ax.set_ylim(low - margin, high + margin)
+                changed = True
+        return changed
+
+    def refresh(self):
+
+        # redraw the lines, blitting over the cached background unless the limits changed
+        for line, series in zip(self.lines, self.series):
+            line.set_data(*series.data())
+        if self.headless:
+            return
+        canvas = self.figure.canvas
+        if self.__rescale() or self.background is None:
+            canvas.draw()
+            self.background = canvas.copy_from_bbox(self.figure.bbox)
+        else:
+            canvas.restore_region(self.background)
+        for ax, line in zip(self.axes, self.lines):
+            ax.draw_artist(line)
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+
+    def snapshot(self, path):
+
+        # write the whole figure to path, replacing it at once so that a viewer never sees a partial image
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view()
+        partial = path + ".partial." + path.rsplit(".", 1)[-1]
+        self.figure.savefig(partial)
+        os.replace(partial, path)
+        return path
+
+
+'''
+the rendering loop of a live view, in its own process or thread
+rows are drained from the queue and the figure is refreshed every refresh seconds, until None is received
+@:param snapshots a directory to write snapshot images to every snapshot_interval seconds, None to show a window
+'''
+def render_live(rows, refresh, capacity, snapshots, snapshot_interval, name, title):
+
+    plot = LivePlot(capacity, headless=snapshots is not None, title=title)
+    next_snapshot = time.monotonic() + snapshot_interval
+    done = False
+    while not done:
+
+        # collect the rows of one refresh period, waiting no longer than the period
+        deadline = time.monotonic() + refresh
+        batch = []
+        while True:
+            try:
+                row = rows.get(timeout=max(deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                break
+            if row is None:
+                done = True
+                break
+            batch.append(row)
+
+        if batch:
+            plot.extend(batch)
+            plot.refresh()
+        elif snapshots is None:
+            plot.figure.canvas.flush_events()
+        if snapshots is not None and plot.round and (done or time.monotonic() >= next_snapshot):
+            plot.snapshot(os.path.join(snapshots, "%s_%09d.png" % (name, plot.round)))
+            next_snapshot = time.monotonic() + snapshot_interval
+
+
+# telemetry sink plotting the supply, the bid price and the transaction fee while a simulation runs
+# Every record emitted by Telemetry (one every interval rounds) is put on a bounded queue without waiting, and a
+# renderer in another process (or thread, only without a display) draws it; when the renderer falls behind and
+# the queue is full, records are dropped and counted in dropped instead of slowing down the simulation.
+# With snapshots set, no window is opened and an image of the figure is written to that directory every
+# snapshot_interval seconds, and once more when the view is closed.
+#   Simulation(tb, br, me, bw, tf, tt=Telemetry([LiveView()], interval=100))
+class LiveView:
+
+    def __init__(self, snapshots=None, snapshot_interval=10.0, refresh=0.2, capacity=4096, queue_size=4096,
+                 worker="process", name="live", title=None):
+
+        if worker not in ("process", "thread"):
+            raise ValueError("worker must be 'process' or 'thread'")
+        if worker == "thread" and snapshots is None:
+            raise ValueError("a window needs the main thread of its process, use worker='process' or snapshots")
+        if snapshots is not None:
+            os.makedirs(snapshots, exist_ok=True)
+        self.snapshots = snapshots
+        self.dropped = 0
+
+        # a spawned process does not inherit the state of the simulation process, e.g. its matplotlib backend
+        arguments = (refresh, capacity, snapshots, snapshot_interval, name, title)
+        if worker == "process":
+            context = multiprocessing.get_context("spawn")
+            self.queue = context.Queue(queue_size)
+            self.worker = context.Process(target=render_live, args=(self.queue,) + arguments, daemon=True)
+        else:
+            self.queue = queue.Queue(queue_size)
+            self.worker = threading.Thread(target=render_live, args=(self.queue,) + arguments, daemon=True)
+        self.worker.start()
+
+    def emit(self, record):
+
+        try:
+            self.queue.put_nowait((record["round"],) + tuple(record[field] for field, _ in LIVE_SERIES))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=60.0):
+
+        # let the renderer draw the remaining rows (and write the last snapshot) and stop
+        # a renderer that failed does not drain the queue any more
+        if self.worker.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self.worker.join(timeout)
@@ -1,6 +1,17 @@
+import os
+import tempfile
 from src.simulation.simulation import Simulation
+from src.simulation.ensemble import SimulationEnsemble
+from src.simulation.sweep import run_sweep, print_progress
+from src.simulation.replication import run_replications
+from src.simulation.stabilitySearch import find_stability_boundaries
+from src.simulation.globalSensitivity import SensitivityAnalysis
+from src.simulation.resultStore import ResultStore
 from src.simulation.draw import *
 
+# the store the scenarios archive their runs in for later comparison, e.g. ResultStore("results"), None to keep none
+result_store = None
+
 def perturbation_simulation():
 
     # the main function for perturbation simulation
@@ -34,18 +45,52 @@ def perturbation_simulation():
     # else for doing nothing
     perturbation_type = 1
 
+    # total round number
+    total_round = 500000
+
     # the simulation object
     simulation = Simulation(total_balance, block_reward, mining_expense, bid_winner,
                             transaction_fees, trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type)
+                            update_block_reward_tag, perturbation_type, horizon=total_round)
 
     # simulate round by round
-    total_round = 500000
-    for i in range(total_round):
-        simulation.single_round()
+    simulation.run(total_round)
+    if result_store is not None:
+        result_store.add(simulation, annotations=dict(scenario="perturbation"))
 
     simulation.draw_time_series()
 
+def perturbation_branch_simulation():
+
+    # the main function for comparing perturbation types after a shared warm-up
+    # the warm-up is simulated once and checkpointed, then forked into one branch for every perturbation type
+
+    # initial parameters
+    total_balance = 1000000000000
+    simulation = Simulation(total_balance, 0.000035 * total_balance, 0.000006 * total_balance, 10,
+                            0.00006 * total_balance, False, horizon=500000, seed=2020)
+
+    # the warm-up before the first perturbation at round 150000
+    simulation.run(149000)
+
+    # one branch for every perturbation type, continuing from the checkpoint, which is removed once loaded
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = os.path.join(directory, "perturbation_warm_up.npz")
+        simulation.save_checkpoint(checkpoint)
+        branches = Simulation.load_checkpoint(checkpoint).fork(3)
+    for perturbation_type, branch in enumerate(branches):
+        branch.perturbation_type = perturbation_type
+        branch.run(500000 - 149000)
+
+    # legend labels
+    labels = ["No perturbation", "Total supply perturbation", "Exchange coefficient perturbation"]
+    # colors and line styles for drawing
+    colors = ["firebrick", "goldenrod", "dodgerblue"]
+    line_styles = ["-", "-", "-"]
+    draw_multiple(branches[0].result[:, 0], [branch.result[:, 1] for branch in branches],
+                  labels, colors, line_styles, "Round Number", "Total Supply")
+
+
 def ablation_simulation():
 
     # the main function for ablation simulation
@@ -66,59 +111,41 @@ def ablation_simulation():
     # the number of bid winners
     bid_winner = 10
 
-    # if simulation needs to be traced in console
-    trace_tag = True
-
     # perturbation type decides which kind of perturbation will be deployed
     # 1 indicates instant increase/decrease in total supply
     # 2 indicates instant increase/decrease in fisher coefficient
     # else for doing nothing
     perturbation_type = 0
 
-    # True if use C-prop, False to use C-const
-    update_mining_cost_tag = False
-    # True if use R-prop, False to use R-const
-    update_block_reward_tag = False
-
-    # the simulation objects
-    simulation_constC_constR = Simulation(total_balance, block_reward, mining_expense, bid_winner,
-                            transaction_fees, trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type)
+    # True if use C-prop, False to use C-const, for every ensemble member
+    update_mining_cost_tags = [False, True, False, True]
+    # True if use R-prop, False to use R-const, for every ensemble member
+    update_block_reward_tags = [False, False, True, True]
 
-    update_mining_cost_tag = True
-    update_block_reward_tag = False
-    simulation_propC_constR = Simulation(total_balance, block_reward, mining_expense, bid_winner,
-                            transaction_fees, trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type)
+    # total round number
+    total_round = 100000
 
-    update_mining_cost_tag = False
-    update_block_reward_tag = True
-    simulation_constC_propR = Simulation(total_balance, block_reward, mining_expense, bid_winner,
-                            transaction_fees, trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type)
+    # the simulation ensemble, with members constC_constR, propC_constR, constC_propR and propC_propR
+    ensemble = SimulationEnsemble(total_balance, block_reward, mining_expense, bid_winner,
+                                  transaction_fees, update_mining_cost_tags, update_block_reward_tags,
+                                  perturbation_type, horizon=total_round)
 
-    update_mining_cost_tag = True
-    update_block_reward_tag = True
-    simulation_propC_propR = Simulation(total_balance, block_reward, mining_expense, bid_winner,
-                            transaction_fees, trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type)
-
-    # simulate round by round
-    total_round = 100000
-    for i in range(total_round):
-        simulation_constC_constR.single_round()
-        simulation_constC_propR.single_round()
-        simulation_propC_constR.single_round()
-        simulation_propC_propR.single_round()
+    # simulate all members round by round
+    ensemble.run(total_round)
+    if result_store is not None:
+        result_store.add_members(ensemble.result, dict(tb=total_balance, br=block_reward, me=mining_expense,
+                                                       bw=bid_winner, tf=transaction_fees,
+                                                       cprop=update_mining_cost_tags,
+                                                       rprop=update_block_reward_tags, pt=perturbation_type),
+                                 dict(scenario="ablation"))
 
     # legend labels
     labels = ["R-const, C-const", "R-const, C-prop", "R-prop, C-const", "R-prop, C-prop"]
     # colors and line styles for drawing
     colors = ["firebrick", "goldenrod", "dodgerblue", "forestgreen"]
     line_styles = ["-", "-", "-", "-"]
-    draw_multiple(simulation_propC_propR.result[:, 0],
-                  [simulation_constC_constR.result[:, 1], simulation_propC_constR.result[:, 1],
-                   simulation_constC_propR.result[:, 1], simulation_propC_propR.result[:, 1]],
+    draw_multiple(ensemble.result[:, 0, 0],
+                  [ensemble.result[:, i, 1] for i in range(ensemble.members)],
                   labels, colors, line_styles, "Round Number", "Total Supply")
 
 
@@ -138,9 +165,6 @@ def sensitivity_simulation_for_kxe0():
     # the number of bid winners
     bid_winner = 10
 
-    # if simulation needs to be traced in console
-    trace_tag = True
-
     # perturbation type decides which kind of perturbation will be deployed
     # 1 indicates instant increase/decrease in total supply
     # 2 indicates instant increase/decrease in fisher coefficient
@@ -156,19 +180,16 @@ def sensitivity_simulation_for_kxe0():
     transaction_fees = [0.00004 * total_balance, 0.00005 * total_balance,
                         0.00006 * total_balance, 0.00007 * total_balance, 0.00008 * total_balance]
 
-    # construct simulation objects with different transaction fees
-    simulations = []
-    for i in range(len(transaction_fees)):
-        simulations.append(Simulation(total_balance, block_reward, mining_expense, bid_winner,
-                            transaction_fees[i], trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type))
-
     # total round number
     round_number = 100000
+
+    # construct a simulation ensemble with different transaction fees
+    ensemble = SimulationEnsemble(total_balance, block_reward, mining_expense, bid_winner,
+                                  transaction_fees, update_mining_cost_tag, update_block_reward_tag,
+                                  perturbation_type, horizon=round_number)
+
     # simulation process
-    for j in range(round_number):
-        for i in range(len(transaction_fees)):
-            simulations[i].single_round()
+    ensemble.run(round_number)
 
     # legend labels
     labels = [r"$k^{ex}_{0} = 4 \times 10^{-5}$", r"$k^{ex}_{0} = 5 \times 10^{-5}$",
@@ -176,8 +197,8 @@ def sensitivity_simulation_for_kxe0():
     # colors and line styles for drawing
     colors = ['#FFB5C5', "#FF3030", "#EE2C2C", "#CD2626", "#8B1A1A"]
     line_styles = ["-", "-", "-", "-", "-"]
-    simulation_results = [simulations[i].result[:, 1] for i in range(len(transaction_fees))]
-    draw_multiple(simulations[0].result[:, 0],
+    simulation_results = [ensemble.result[:, i, 1] for i in range(ensemble.members)]
+    draw_multiple(ensemble.result[:, 0, 0],
                   simulation_results,
                   labels, colors, line_styles, "Round Number", "Total Supply")
 
@@ -201,9 +222,6 @@ def sensitivity_simulation_for_gamma():
     # the number of bid winners
     bid_winner = 10
 
-    # if simulation needs to be traced in console
-    trace_tag = True
-
     # perturbation type decides which kind of perturbation will be deployed
     # 1 indicates instant increase/decrease in total supply
     # 2 indicates instant increase/decrease in fisher coefficient
@@ -218,19 +236,16 @@ def sensitivity_simulation_for_gamma():
     # the gammas
     gammas = [0.25, 0.5, 0.75, 1, 2]
 
-    # construct simulation objects with different gammas
-    simulations = []
-    for i in range(len(gammas)):
-        simulations.append(Simulation(total_balance, block_reward, mining_expense, bid_winner,
-                            transaction_fees, trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type, gammas[i]))
-
     # total round number
     round_number = 150000
+
+    # construct a simulation ensemble with different gammas
+    ensemble = SimulationEnsemble(total_balance, block_reward, mining_expense, bid_winner,
+                                  transaction_fees, update_mining_cost_tag, update_block_reward_tag,
+                                  perturbation_type, gammas, horizon=round_number)
+
     # simulation process
-    for j in range(round_number):
-        for i in range(len(gammas)):
-            simulations[i].single_round()
+    ensemble.run(round_number)
 
     # legend labels
     labels = [r"$\gamma = 0.25$", r"$\gamma = 0.5$",
@@ -238,8 +253,8 @@ def sensitivity_simulation_for_gamma():
     # colors and line styles for drawing
     colors = ['#FFB5C5', "#FF3030", "#EE2C2C", "#CD2626", "#8B1A1A"]
     line_styles = ["-", "-", "-", "-", "-"]
-    simulation_results = [simulations[i].result[:, 1] for i in range(len(gammas))]
-    draw_multiple(simulations[0].result[:, 0],
+    simulation_results = [ensemble.result[:, i, 1] for i in range(ensemble.members)]
+    draw_multiple(ensemble.result[:, 0, 0],
                   simulation_results,
                   labels, colors, line_styles, "Round Number", "Total Supply")
 
@@ -263,9 +278,6 @@ def sensitivity_simulation_for_update_rate():
     # the number of bid winners
     bid_winner = 10
 
-    # if simulation needs to be traced in console
-    trace_tag = True
-
     # perturbation type decides which kind of perturbation will be deployed
     # 1 indicates instant increase/decrease in total supply
     # 2 indicates instant increase/decrease in fisher coefficient
@@ -283,19 +295,16 @@ def sensitivity_simulation_for_update_rate():
     # the update rates for exchange coefficient
     update_rates = [1/100, 1/1000, 1/5000, 1/15000, 1/50000]
 
-    # construct simulation objects with different transaction fees
-    simulations = []
-    for i in range(len(update_rates)):
-        simulations.append(Simulation(total_balance, block_reward, mining_expense, bid_winner,
-                            transaction_fees, trace_tag, update_mining_cost_tag,
-                            update_block_reward_tag, perturbation_type, gamma, update_rates[i]))
-
     # total round number
     round_number = 150000
+
+    # construct a simulation ensemble with different update rates
+    ensemble = SimulationEnsemble(total_balance, block_reward, mining_expense, bid_winner,
+                                  transaction_fees, update_mining_cost_tag, update_block_reward_tag,
+                                  perturbation_type, gamma, update_rates, horizon=round_number)
+
     # simulation process
-    for j in range(round_number):
-        for i in range(len(update_rates)):
-            simulations[i].single_round()
+    ensemble.run(round_number)
 
     # legend labels
     labels = [r"$ur = 1/100$", r"$ur = 1/1000$",
@@ -303,15 +312,119 @@ def sensitivity_simulation_for_update_rate():
     # colors and line styles for drawing
     colors = ['#FFB5C5', "#FF3030", "#EE2C2C", "#CD2626", "#8B1A1A"]
     line_styles = ["-", "-", "-", "-", "-"]
-    simulation_results = [simulations[i].result[:, 1] for i in range(len(update_rates))]
-    draw_multiple(simulations[0].result[:, 0],
+    simulation_results = [ensemble.result[:, i, 1] for i in range(ensemble.members)]
+    draw_multiple(ensemble.result[:, 0, 0],
                   simulation_results,
                   labels, colors, line_styles, "Round Number", "Total Supply")
 
 
+def parameter_sweep_simulation():
+    # the main function for a parameter sweep over gamma and the C-prop/R-prop modes, run on all cores
+
+    # initial parameters shared by all runs
+    total_balance = 1000000000000
+    base = dict(tb=total_balance, br=0.000035 * total_balance, me=0.000006 * total_balance,
+                bw=10, tf=0.00006 * total_balance)
+
+    # the varying parameters, every combination is a run
+    grid = dict(gamma=[0.5, 1], cprop=[False, True], rprop=[False, True])
+
+    # total round number
+    round_number = 100000
+
+    # run all combinations in a process pool, with a seed derived for every run
+    points, results, _ = run_sweep(base, grid, round_number, seed=2020, progress=print_progress)
+
+    # legend labels
+    labels = [r"$\gamma = %s$, %s, %s" % (point["gamma"], "C-prop" if point["cprop"] else "C-const",
+                                           "R-prop" if point["rprop"] else "R-const") for point in points]
+    # colors and line styles for drawing
+    colors = ["firebrick", "goldenrod", "dodgerblue", "forestgreen"] * 2
+    line_styles = ["-"] * 4 + ["--"] * 4
+    draw_multiple(results[0, :, 0], [results[i, :, 1] for i in range(len(points))],
+                  labels, colors, line_styles, "Round Number", "Total Supply")
+
+
+def replication_simulation():
+    # the main function for replicated ablation runs, drawn as the mean total supply with a 90% band
+
+    # initial parameters shared by all runs
+    total_balance = 1000000000000
+    base = dict(tb=total_balance, br=0.000035 * total_balance, me=0.000006 * total_balance,
+                bw=10, tf=0.00006 * total_balance)
+
+    # total round number and the number of replications of every configuration
+    round_number = 100000
+    replications = 32
+
+    # R-const and R-prop, each replicated with independent seeds on all cores
+    statistics = [run_replications(dict(base, rprop=rprop), round_number, replications, seed=2020,
+                                   progress=print_progress) for rprop in (False, True)]
+
+    # legend labels
+    labels = ["R-const, C-const", "R-prop, C-const"]
+    # colors and line styles for drawing
+    colors = ["firebrick", "dodgerblue"]
+    line_styles = ["-", "-"]
+    draw_multiple(statistics[0].rounds,
+                  [statistic.mean[:, statistic.column("totalBalance")] for statistic in statistics],
+                  labels, colors, line_styles, "Round Number", "Total Supply",
+                  bands=[statistic.band("totalBalance", quantiles=(0.05, 0.95)) for statistic in statistics])
+
+
+def stability_boundary_simulation():
+    # the main function for locating the parameter values where the total supply stops converging
+
+    # initial parameters shared by all probes
+    total_balance = 1000000000000
+    base = dict(tb=total_balance, br=0.000035 * total_balance, me=0.000006 * total_balance,
+                bw=10, tf=0.00006 * total_balance)
+
+    # the brackets to search, each one must contain a change of stability
+    # with an initial exchange coefficient (tf / tb) far below the paper's 4e-5..8e-5, the transaction fees
+    # burn too little, and the supply inflates beyond ten times its initial value before the exchange
+    # coefficient can catch up; gamma (0.25..20), ur (1/50000..1) and br / me (0.25..20) stay stable throughout
+    brackets = dict(kex0=(1e-7, 6e-5, "log"))
+
+    boundaries = find_stability_boundaries(base, brackets, seed=2020)
+    for parameter, boundary in boundaries.items():
+        print("%s: stable at %g, unstable at %g (%d probes, %d rounds)"
+              % (parameter, boundary.stable, boundary.unstable, boundary.probes, boundary.rounds))
+
+
+def global_sensitivity_simulation():
+    # the main function for ranking the influence of all parameters at once, within a fixed compute budget
+
+    # initial parameters shared by all runs
+    total_balance = 1000000000000
+    base = dict(tb=total_balance, br=0.000035 * total_balance, me=0.000006 * total_balance,
+                bw=10, tf=0.00006 * total_balance)
+
+    # the ranges of the factors, C-prop and R-prop are switched on or off
+    factors = dict(gamma=(0.25, 2.0), ur=(1 / 50000, 1 / 5000, "log"), bw=(5, 20, "int"),
+                   reward_ratio=(3.0, 9.0), cprop=[False, True], rprop=[False, True])
+
+    analysis = SensitivityAnalysis(base, factors, rounds=50000, window=5000, seed=2020, progress=print_progress)
+
+    # a cheap screening first, then Sobol indices within one hour
+    morris = analysis.morris(trajectories=20)
+    indices = analysis.sobol(n=256, time_budget=3600, bootstrap=200)
+    for i, output in enumerate(indices.outputs):
+        print(output)
+        for j, factor in enumerate(indices.factors):
+            print("  %-12s mu* %10.4g  S1 %6.3f +- %5.3f  ST %6.3f +- %5.3f"
+                  % (factor, morris.mu_star[i, j], indices.first[i, j], indices.first_error[i, j],
+                     indices.total[i, j], indices.total_error[i, j]))
+
+
 if __name__ == '__main__':
     # perturbation_simulation()
+    # perturbation_branch_simulation()
     # ablation_simulation()
     # sensitivity_simulation_for_kxe0()
     # sensitivity_simulation_for_gamma()
+    # parameter_sweep_simulation()
+    # replication_simulation()
+    # stability_boundary_simulation()
+    # global_sensitivity_simulation()
     sensitivity_simulation_for_update_rate()
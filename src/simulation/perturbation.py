@@ -0,0 +1,264 @@
+import json
+import numpy as np
+
+# the state a perturbation can change
+PERTURBATION_TARGETS = ("totalBalance", "exchangeCoefficient", "blockReward", "miningExpense")
+
+# the ways a perturbation changes its target
+PERTURBATION_OPERATIONS = ("scale", "set", "add")
+
+
+# declarative schedule of perturbations, precompiled into a timeline sorted by round
+# An event is a dict with the keys
+#   round   the round at whose end the event happens (as the perturbations of the original model)
+#   target  one of PERTURBATION_TARGETS
+#   op      one of PERTURBATION_OPERATIONS, "scale" by default
+#   value   the factor, the new value or the increment
+#   every   the period of a repeated event, and repeat the number of repetitions (1 by default)
+#   ramp    the number of rounds a "scale" or "add" event is spread over, e.g. a gradual regime change
+# Changing blockReward or miningExpense also changes its rate, so a regime change persists under R-prop/C-prop.
+class PerturbationSchedule:
+
+    def __init__(self, events=()):
+
+        self.events = [self.__normalize(event) for event in events]
+
+        # the compiled timeline, one entry for every single change
+        rounds, targets, operations, values = [], [], [], []
+        for event in self.events:
+            starts = event["round"] + event["every"] * np.arange(event["repeat"])
+            steps = np.arange(event["ramp"])
+            if event["ramp"] > 1:
+                value = event["value"] ** (1.0 / event["ramp"]) if event["op"] == "scale" \
+                    else event["value"] / event["ramp"]
+            else:
+                value = event["value"]
+            event_rounds = (starts[:, np.newaxis] + steps[np.newaxis, :]).ravel()
+            rounds.append(event_rounds)
+            targets.append(np.full(len(event_rounds), PERTURBATION_TARGETS.index(event["target"])))
+            operations.append(np.full(len(event_rounds), PERTURBATION_OPERATIONS.index(event["op"])))
+            values.append(np.full(len(event_rounds), value, dtype=np.float64))
+
+        # a stable sort keeps the order of events given for the same round
+        rounds = np.concatenate(rounds) if rounds else np.empty(0, dtype=np.int64)
+        order = np.argsort(rounds, kind="stable")
+        self.rounds = rounds[order].astype(np.int64)
+        self.targets = np.concatenate(targets)[order] if targets else np.empty(0, dtype=np.int64)
+        self.operations = np.concatenate(operations)[order] if operations else np.empty(0, dtype=np.int64)
+        self.values = np.concatenate(values)[order] if values else np.empty(0)
+
+        # python lists for the scalar simulation, which reads single entries,
+        # and the range of changes due at every round with changes
+        self.roundList = self.rounds.tolist()
+        self.slices = due_slices(self.roundList)
+
+    def __len__(self):
+
+        return len(self.rounds)
+
+    @staticmethod
+    def __normalize(event):
+
+        event = dict(event)
+        event.setdefault("op", "scale")
+        event.setdefault("every", 0)
+        event.setdefault("repeat", 1)
+        event.setdefault("ramp", 1)
+        if event["target"] not in PERTURBATION_TARGETS:
+            raise ValueError("unknown perturbation target: %s" % event["target"])
+        if event["op"] not in PERTURBATION_OPERATIONS:
+            raise ValueError("unknown perturbation operation: %s" % event["op"])
+        if event["ramp"] > 1 and event["op"] == "set":
+            raise ValueError("a set perturbation cannot be ramped")
+        if event["repeat"] > 1 and event["every"] < event["ramp"]:
+            raise ValueError("repeated perturbations must not overlap")
+        return event
+
+    @classmethod
+    def preset(cls, perturbation_type):
+
+        # the original perturbation types
+        # 1 indicates instant decrease/increase in total supply at rounds 150000 and 300000
+        # 2 indicates instant increase/decrease in exchange coefficient at rounds 150000 and 300000
+        # else indicates doing nothing
+        if perturbation_type == 1:
+            return cls([dict(round=150000, target="totalBalance", value=0.975),
+                        dict(round=300000, target="totalBalance", value=1.025)])
+        elif perturbation_type == 2:
+            return cls([dict(round=150000, target="exchangeCoefficient", value=1.025),
+                        dict(round=300000, target="exchangeCoefficient", value=0.975)])
+        return cls()
+
+    @classmethod
+    def from_file(cls, path):
+
+        # a JSON file with a list of events, or an object with the list as "events"
+        with open(path) as f:
+            content = json.load(f)
+        return cls(content["events"] if isinstance(content, dict) else content)
+
+    @classmethod
+    def build(cls, pt):
+
+        # a schedule from a perturbation type, a list of events, a JSON file or a schedule
+        if isinstance(pt, PerturbationSchedule):
+            return pt
+        if isinstance(pt, str):
+            return cls.from_file(pt)
+        if isinstance(pt, dict):
+            return cls(pt["events"])
+        if isinstance(pt, (list, tuple)):
+            return cls(pt)
+        return cls.preset(pt)
+
+    def to_spec(self):
+
+        # the json-compatible description of this schedule
+        return dict(events=self.events)
+
+    def index_at(self, rnd):
+
+        # the index of the first change happening at round rnd or later
+        return int(np.searchsorted(self.rounds, rnd, side="left"))
+
+    def next_round(self, index):
+
+        # the round of the change at index, -1 if there is none
+        return self.roundList[index] if index < len(self.roundList) else -1
+
+    def apply(self, simulation, rnd):
+
+        # apply all changes due at round rnd to a scalar simulation, in the order they are given
+        # @:return the index of the next change, or None if no change is due at round rnd
+        due = self.slices.get(rnd)
+        if due is None:
+            return None
+        for index in range(*due):
+            apply_change(simulation, int(self.targets[index]), int(self.operations[index]),
+                         float(self.values[index]))
+        return due[1]
+
+
+'''
+the range of indices of the changes at every round of a sorted list of rounds
+@:return a dict mapping each round to (first index, last index + 1)
+'''
+def due_slices(rounds):
+
+    slices = {}
+    for index, rnd in enumerate(rounds):
+        start = slices[rnd][0] if rnd in slices else index
+        slices[rnd] = (start, index + 1)
+    return slices
+
+
+'''
+apply a single change to a scalar simulation
+'''
+def apply_change(simulation, target, operation, value):
+
+    name = PERTURBATION_TARGETS[target]
+    if operation == 0:
+        setattr(simulation, name, getattr(simulation, name) * value)
+    elif operation == 1:
+        setattr(simulation, name, value)
+    else:
+        setattr(simulation, name, getattr(simulation, name) + value)
+
+    # the rate of the block reward and the mining expense follows their new value
+    if target == 2:
+        if operation == 0:
+            simulation.blockRewardRate *= value
+        else:
+            simulation.blockRewardRate = simulation.blockReward / simulation.totalBalance
+    elif target == 3:
+        if operation == 0:
+            simulation.miningExpenseRate *= value
+        else:
+            simulation.miningExpenseRate = simulation.miningExpense / simulation.totalBalance
+
+
+# the timeline of many schedules, one for every member of an ensemble
+# The changes due in a round are applied in steps: step k holds the k-th change of that round of every member,
+# so every member sees its changes in the order of its schedule (which matters, e.g. "add" then "scale"),
+# while a step touches every member at most once and is applied in bulk for each target and operation.
+class EnsembleTimeline:
+
+    def __init__(self, schedules):
+
+        members = np.concatenate([np.full(len(schedule), i) for i, schedule in enumerate(schedules)])
+        rounds = np.concatenate([schedule.rounds for schedule in schedules])
+
+        # the position of every change among the changes of its member in the same round
+        ranks = np.concatenate([np.arange(len(schedule)) - np.array([schedule.slices[rnd][0]
+                                                                     for rnd in schedule.roundList], dtype=np.int64)
+                                for schedule in schedules])
+        order = np.lexsort((ranks, rounds))
+        self.rounds = rounds[order].astype(np.int64)
+        self.members = members[order].astype(np.int64)
+        self.targets = np.concatenate([schedule.targets for schedule in schedules])[order].astype(np.int64)
+        self.operations = np.concatenate([schedule.operations for schedule in schedules])[order].astype(np.int64)
+        self.values = np.concatenate([schedule.values for schedule in schedules])[order]
+
+        # the ranges of the steps of every round with changes
+        steps = due_slices(list(zip(self.rounds.tolist(), ranks[order].tolist())))
+        self.steps = {}
+        for (rnd, _), step in sorted(steps.items()):
+            self.steps.setdefault(rnd, []).append(step)
+
+    def apply(self, ensemble, rnd):
+
+        # apply all changes due at round rnd, step by step, in bulk for every target and operation of a step
+        for index, end in self.steps.get(rnd, ()):
+            members = self.members[index:end]
+            targets = self.targets[index:end]
+            operations = self.operations[index:end]
+            values = self.values[index:end]
+            for target in np.unique(targets):
+                name = PERTURBATION_TARGETS[target]
+                for operation in np.unique(operations[targets == target]):
+                    selected = (targets == target) & (operations == operation)
+                    changed = members[selected]
+                    state = getattr(ensemble, name)
+                    if operation == 0:
+                        state[changed] *= values[selected]
+                    elif operation == 1:
+                        state[changed] = values[selected]
+                    else:
+                        state[changed] += values[selected]
+
+                    # the rate of the block reward and the mining expense follows their new value
+                    if target >= 2:
+                        rate = ensemble.blockRewardRate if target == 2 else ensemble.miningExpenseRate
+                        if operation == 0:
+                            rate[changed] *= values[selected]
+                        else:
+                            rate[changed] = state[changed] / ensemble.totalBalance[changed]
+
+
+# the main function to test
+if __name__ == '__main__':
+
+    from .simulation import Simulation
+    from .ensemble import SimulationEnsemble
+
+    # changes due in the same round do not commute, every ensemble member must apply them in schedule order
+    total_balance = 1000000000000
+    schedules = [
+        [dict(round=50, target="totalBalance", op="add", value=1e9),
+         dict(round=50, target="totalBalance", op="scale", value=0.5)],
+        [dict(round=50, target="totalBalance", op="scale", value=0.5),
+         dict(round=50, target="totalBalance", op="add", value=1e9)],
+        [dict(round=50, target="blockReward", op="set", value=0.00005 * total_balance),
+         dict(round=50, target="totalBalance", op="scale", value=0.9),
+         dict(round=60, target="exchangeCoefficient", op="add", value=1e-6, ramp=4)],
+        [],
+    ]
+    arguments = (total_balance, 0.000035 * total_balance, 0.000006 * total_balance, 10, 0.00006 * total_balance)
+    ensemble = SimulationEnsemble(*arguments, rprop=True, pt=schedules, seed=2020, crn=True)
+    ensemble.run(100)
+    for member, schedule in enumerate(schedules):
+        simulation = Simulation(*arguments, False, rprop=True, pt=schedule, seed=2020)
+        simulation.run(100)
+        assert np.allclose(ensemble.result[:, member], simulation.result, rtol=1e-12, atol=0), member
+    print("ensemble timeline matches the schedules of", len(schedules), "simulations")
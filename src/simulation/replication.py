@@ -0,0 +1,233 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .simulation import Simulation
+from .ensemble import SimulationEnsemble
+from .resultSink import RESULT_COLUMNS
+
+
+# streaming quantile estimate of many variables at once, with the P² algorithm of Jain and Chlamtac
+# every variable keeps five markers, whose heights approximate the minimum, the p/2, p and (1+p)/2 quantiles
+# and the maximum; an observation moves the markers by a piecewise-parabolic update, so memory is constant
+# in the number of observations. The variables are the cells of an array of any shape.
+class P2Quantile:
+
+    def __init__(self, shape, p):
+
+        self.p = p
+        self.count = 0
+        # marker heights and actual positions (1-based), with the cells of shape flattened
+        self.heights = np.zeros((int(np.prod(shape)), 5))
+        self.positions = np.tile(np.arange(1.0, 6.0), (len(self.heights), 1))
+        self.shape = tuple(shape)
+        # desired positions and their increments, the same for all cells
+        self.desired = np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5])
+        self.increments = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def update(self, values):
+
+        x = np.asarray(values, dtype=np.float64).reshape(-1)
+        q = self.heights
+        n = self.positions
+
+        # the first five observations are kept as they are, and become the sorted markers
+        if self.count < 5:
+            q[:, self.count] = x
+            self.count += 1
+            if self.count == 5:
+                q.sort(axis=1)
+            return
+        self.count += 1
+
+        # the cell k with q[k] <= x < q[k + 1], extreme observations move the outer markers
+        np.minimum(q[:, 0], x, out=q[:, 0])
+        np.maximum(q[:, 4], x, out=q[:, 4])
+        k = (x[:, np.newaxis] >= q[:, 1:4]).sum(axis=1)
+        n += np.arange(5) > k[:, np.newaxis]
+        self.desired += self.increments
+
+        # adjust the three middle markers that are off their desired position
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[:, i]
+            move = ((d >= 1) & (n[:, i + 1] - n[:, i] > 1)) | ((d <= -1) & (n[:, i - 1] - n[:, i] < -1))
+            if not move.any():
+                continue
+            s = np.sign(d[move])
+            qm, qi, qp = q[move, i - 1], q[move, i], q[move, i + 1]
+            nm, ni, np_ = n[move, i - 1], n[move, i], n[move, i + 1]
+
+            # the parabolic prediction, or the linear one if it leaves the neighbouring markers
+            parabolic = qi + s / (np_ - nm) * ((ni - nm + s) * (qp - qi) / (np_ - ni)
+                                               + (np_ - ni - s) * (qi - qm) / (ni - nm))
+            linear = np.where(s > 0, qi + (qp - qi) / (np_ - ni), qi - (qm - qi) / (nm - ni))
+            q[move, i] = np.where((qm < parabolic) & (parabolic < qp), parabolic, linear)
+            n[move, i] += s
+
+    def value(self):
+
+        # the estimated quantile of every cell, exact while there are at most five observations
+        if self.count == 0:
+            return np.full(self.shape, np.nan)
+        if self.count <= 5:
+            return np.quantile(self.heights[:, :self.count], self.p, axis=1).reshape(self.shape)
+        return self.heights[:, 2].reshape(self.shape)
+
+
+# per-round statistics of replicated simulation results, accumulated one replication at a time
+# mean and variance are updated with Welford's algorithm and quantiles with P² estimators,
+# so the memory is O(rounds) however many replications are added
+# results of an ensemble have a member shape, e.g. (members,), between the rounds and the columns
+class ReplicationStatistics:
+
+    def __init__(self, rounds, columns=(1, 2, 3), quantiles=(0.05, 0.5, 0.95), member_shape=()):
+
+        # the rounds of the results, and the result columns with statistics
+        self.rounds = np.asarray(rounds)
+        self.columns = tuple(columns)
+        shape = (len(self.rounds),) + tuple(member_shape) + (len(self.columns),)
+
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.quantiles = {p: P2Quantile(shape, p) for p in quantiles}
+
+    def update(self, result):
+
+        # add one replication, a result array of [round, totalBalance, bidPrice. txFee] rows
+        values = np.asarray(result)[..., self.columns]
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+        for estimator in self.quantiles.values():
+            estimator.update(values)
+
+    def column(self, name):
+
+        # the index of a named column (see RESULT_COLUMNS) in the statistics
+        return self.columns.index(RESULT_COLUMNS.index(name))
+
+    def variance(self):
+
+        # the sample variance of every round and column
+        return self.m2 / (self.count - 1) if self.count > 1 else np.zeros_like(self.m2)
+
+    def std(self):
+
+        return np.sqrt(self.variance())
+
+    def standard_error(self):
+
+        # the standard error of the mean
+        return self.std() / np.sqrt(max(self.count, 1))
+
+    def quantile(self, p):
+
+        return self.quantiles[p].value()
+
+    def band(self, name, width=1.0, quantiles=None):
+
+        # the (lower, upper) band of a named column, for draw_multiple
+        # mean ± width * std, or the range between two estimated quantiles, e.g. quantiles=(0.05, 0.95)
+        i = self.column(name)
+        if quantiles is not None:
+            return self.quantile(quantiles[0])[..., i], self.quantile(quantiles[1])[..., i]
+        spread = width * self.std()[..., i]
+        return self.mean[..., i] - spread, self.mean[..., i] + spread
+
+
+'''
+run one replication in a worker process
+@:return the result of the simulation
+'''
+def run_replication(parameters, seed, total_round):
+
+    simulation = Simulation(**dict(parameters, tt=False, horizon=total_round, seed=seed))
+    simulation.run(total_round)
+    return np.asarray(simulation.result)
+
+
+'''
+run replications of a Simulation configuration with independent seeds, and accumulate per-round statistics
+replications are added in the order of their seeds, so that the statistics do not depend on the scheduling
+@:param parameters the Simulation keyword arguments, e.g. dict(tb=..., br=..., me=..., bw=..., tf=..., rprop=True)
+@:param total_round the number of rounds of every replication
+@:param replications the number of replications R
+@:param seed the root seed, every replication gets a seed spawned from it
+@:param max_workers the number of worker processes, 1 to run in this process, all cores if None
+@:param progress an optional callable progress(done, total), called whenever a replication is added
+@:return a ReplicationStatistics
+'''
+def run_replications(parameters, total_round, replications, seed=None, max_workers=None, columns=(1, 2, 3),
+                     quantiles=(0.05, 0.5, 0.95), progress=None):
+
+    return replicate(run_replication, (parameters,), (total_round,), replications, seed, max_workers,
+                     columns, quantiles, progress)
+
+
+'''
+run one replication of a comparison in a worker process, as an ensemble with common random numbers
+@:return the result of the ensemble, with the columns other than the round replaced by their difference
+         to the reference member
+'''
+def run_paired_replication(parameters, seed, total_round, reference=0):
+
+    ensemble = SimulationEnsemble(**dict(parameters, horizon=total_round, seed=seed, crn=True))
+    ensemble.run(total_round)
+    result = np.array(ensemble.result)
+    result[..., 1:] -= result[:, [reference], 1:]
+    return result
+
+
+'''
+run replications of a comparison of configurations with common random numbers, and accumulate per-round
+statistics of the paired differences to a reference configuration
+in every replication all configurations share their random draws (see SimulationEnsemble with crn=True),
+so the noise cancels in the differences and far fewer replications give the same confidence
+@:param parameters the SimulationEnsemble keyword arguments, with one value per configuration in
+                   the compared arguments, e.g. dict(tb=..., br=..., me=..., bw=..., tf=..., rprop=[False, True])
+@:param reference the index of the reference configuration
+@:return a ReplicationStatistics with member shape (configurations,), the statistics of the reference are 0
+see run_replications for the other arguments
+'''
+def run_paired_replications(parameters, total_round, replications, seed=None, reference=0, max_workers=None,
+                            columns=(1, 2, 3), quantiles=(0.05, 0.5, 0.95), progress=None):
+
+    return replicate(run_paired_replication, (parameters,), (total_round, reference), replications, seed,
+                     max_workers, columns, quantiles, progress)
+
+
+'''
+run replications of task(*leading, seed, *trailing) and accumulate their results in order
+@:return a ReplicationStatistics
+'''
+def replicate(task, leading, trailing, replications, seed, max_workers, columns, quantiles, progress):
+
+    seeds = np.random.SeedSequence(seed).spawn(replications)
+    statistics = None
+
+    def add(result):
+        nonlocal statistics
+        if statistics is None:
+            rounds = result[(slice(None),) + (0,) * (result.ndim - 1)]
+            statistics = ReplicationStatistics(rounds, columns, quantiles, result.shape[1:-1])
+        statistics.update(result)
+        if progress is not None:
+            progress(statistics.count, replications)
+
+    workers = max_workers or os.cpu_count() or 1
+    if workers == 1:
+        for replication_seed in seeds:
+            add(task(*leading, replication_seed, *trailing))
+        return statistics
+
+    # at most two replications per worker are in flight, which bounds the memory of finished results
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for replication_seed in seeds:
+            futures.append(executor.submit(task, *leading, replication_seed, *trailing))
+            if len(futures) >= 2 * workers:
+                add(futures.pop(0).result())
+        while futures:
+            add(futures.pop(0).result())
+    return statistics
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+# growable row buffer for simulation results
+# rows are written into a preallocated array, and the array doubles its capacity when it is full,
+# so that appending a row costs amortized O(1) instead of copying the whole history every round
+class ResultBuffer:
+
+    def __init__(self, width, capacity=1024, dtype=np.float64):
+
+        # the shape of a single row, e.g. 4 for [round, totalBalance, bidPrice, txFee]
+        self.rowShape = tuple(np.atleast_1d(width))
+
+        # the preallocated storage, only the first self.size rows are valid
+        self.data = np.empty((max(int(capacity), 1),) + self.rowShape, dtype=dtype)
+
+        # the number of valid rows
+        self.size = 0
+
+        # information about the result besides its rows, e.g. why and when a simulation stopped early
+        self.annotations = {}
+
+    def __len__(self):
+
+        return self.size
+
+    def reserve(self, capacity):
+
+        # grow the storage to hold at least capacity rows, valid rows are kept
+        if capacity <= self.data.shape[0]:
+            return
+        data = np.empty((int(capacity),) + self.rowShape, dtype=self.data.dtype)
+        data[:self.size] = self.data[:self.size]
+        self.data = data
+
+    def append(self, row):
+
+        # double the capacity if the buffer is full
+        if self.size == self.data.shape[0]:
+            self.reserve(2 * self.data.shape[0])
+        self.data[self.size] = row
+        self.size += 1
+
+    def next_row(self):
+
+        # append an uninitialized row and return it, so that it can be filled in place
+        if self.size == self.data.shape[0]:
+            self.reserve(2 * self.data.shape[0])
+        self.size += 1
+        return self.data[self.size - 1]
+
+    def next_rows(self, count):
+
+        # append count uninitialized rows and return them, so that they can be filled in place
+        if self.size + count > self.data.shape[0]:
+            self.reserve(max(2 * self.data.shape[0], self.size + count))
+        self.size += count
+        return self.data[self.size - count:self.size]
+
+    def extend(self, rows):
+
+        # append a block of rows at once
+        count = len(rows)
+        if self.size + count > self.data.shape[0]:
+            self.reserve(max(2 * self.data.shape[0], self.size + count))
+        self.data[self.size:self.size + count] = rows
+        self.size += count
+
+    def view(self):
+
+        # the valid rows, without copying
+        return self.data[:self.size]
+
+    def shrink(self):
+
+        # release the unused capacity, e.g. when a run is finished
+        self.data = self.data[:self.size].copy()
+
+    def close(self):
+
+        # a finished in-memory result keeps its rows, the same call closes a ResultSink
+        self.shrink()
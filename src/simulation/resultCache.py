@@ -0,0 +1,322 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import numpy as np
+from .simulation import Simulation
+from .convergence import ConvergenceDetector
+from .perturbation import PerturbationSchedule
+from .statHelper import seed_description
+from .resultSink import ResultSink, ResultReader, write_json
+
+# the version of the simulation model, part of every cache key
+# it must be changed whenever a change of the model changes the result of a simulation with the same
+# parameters and seed, so that results of the former model are not served any more
+MODEL_VERSION = "2"
+
+# Simulation arguments that do not change the result, and are not part of a cache key
+UNCACHED_ARGUMENTS = ("self", "tt", "horizon", "seed", "sink")
+
+
+'''
+convert a value to a json-compatible value with a single representation, e.g. np.float64(1.0) to 1.0
+'''
+def canonical(value):
+
+    if isinstance(value, dict):
+        return {str(name): canonical(item) for name, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [canonical(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, PerturbationSchedule):
+        return canonical(value.to_spec())
+    return value
+
+
+'''
+the json-compatible description of a seed, an unseeded simulation is not reproducible and cannot be cached
+@:param seed an int or a numpy SeedSequence
+'''
+def canonical_seed(seed):
+
+    if seed is None:
+        raise ValueError("only simulations with a seed can be cached")
+    if isinstance(seed, np.random.SeedSequence):
+        return seed_description(seed)
+    return int(seed)
+
+
+'''
+the json-compatible description of the Simulation keyword arguments that decide a result
+the arguments are completed with their defaults, so that leaving out an argument and passing its default
+give the same description; arguments that do not change the result (tt, horizon, seed, sink) are left out
+@:raise ValueError if a bid model or fee model has been used by a simulation before
+@:param parameters the Simulation keyword arguments, e.g. dict(tb=..., br=..., me=..., bw=..., tf=..., rprop=True)
+'''
+def simulation_arguments(parameters):
+
+    arguments = inspect.signature(Simulation.__init__).bind(None, **parameters)
+    arguments.apply_defaults()
+    arguments = {name: value for name, value in arguments.arguments.items() if name not in UNCACHED_ARGUMENTS}
+
+    # a perturbation schedule, a bid model and a fee model are described by their parameters, which include
+    # their seeds; a model whose random stream has advanced (it ran before) does not match its parameters any more
+    pt = arguments["pt"]
+    arguments["pt"] = pt if isinstance(pt, (int, np.integer)) else PerturbationSchedule.build(pt).to_spec()
+    for model in ("bid_model", "fee_model"):
+        if arguments[model] is not None:
+            if getattr(arguments[model], "used", False):
+                raise ValueError("the %s has been used by a simulation before, pass a new one" % model)
+            arguments[model] = arguments[model].parameters
+    return canonical(arguments)
+
+
+'''
+the seed of a simulation derived from a root seed and its parameters, independent of the position of the
+simulation in a sweep, so that the results of a sweep can be reused when points are added to its grid
+@:param root the root seed, an int, a numpy SeedSequence or None
+@:param parameters the Simulation keyword arguments
+@:return a numpy SeedSequence
+'''
+def parameter_seed(root, parameters):
+
+    root = root if isinstance(root, np.random.SeedSequence) else np.random.SeedSequence(root)
+    text = json.dumps(simulation_arguments(parameters), sort_keys=True, separators=(",", ":"))
+    digest = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    return np.random.SeedSequence(root.entropy, spawn_key=tuple(root.spawn_key) + (digest,))
+
+
+'''
+the cache key of a simulation
+@:param parameters the Simulation keyword arguments, see simulation_arguments
+@:param total_round the number of rounds
+@:param seed the seed of the simulation, an int or a numpy SeedSequence
+@:param convergence optional ConvergenceDetector keyword arguments the simulation is stopped with
+@:param version the model version, MODEL_VERSION by default
+@:return a sha256 hex digest
+'''
+def cache_key(parameters, total_round, seed, convergence=None, version=MODEL_VERSION):
+
+    description = dict(parameters=simulation_arguments(parameters), rounds=int(total_round),
+                       seed=canonical_seed(seed), convergence=convergence, version=version)
+    text = json.dumps(canonical(description), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# content-addressed on-disk cache of simulation results
+# Every result is stored as the output of a ResultSink in a directory named by its cache key, and loaded
+# lazily as a memory-mapped ResultReader. An index.json file keeps the size and the last access time of
+# every entry; when the entries exceed max_bytes, the least recently used ones are evicted.
+# Entries are written to a temporary directory first and renamed when complete, so that an interrupted run
+# leaves no partial entry. The index is not locked, concurrent writers may lose each other's access times,
+# but never the entries themselves (an entry missing from the index is picked up again by refresh).
+class ResultCache:
+
+    def __init__(self, directory, max_bytes=1 << 32):
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.maxBytes = int(max_bytes)
+        self.indexPath = os.path.join(directory, "index.json")
+        self.entries = {}
+        self.refresh()
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def __contains__(self, key):
+
+        return key in self.entries and os.path.isdir(self.__path(key))
+
+    def __path(self, key):
+
+        return os.path.join(self.directory, key)
+
+    def __save(self):
+
+        write_json(self.indexPath, dict(version=MODEL_VERSION, entries=self.entries))
+
+    def refresh(self):
+
+        # read the index, and add the complete entries it does not know about, e.g. written by another process
+        self.entries = {}
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                self.entries = json.load(f).get("entries", {})
+        for key in os.listdir(self.directory):
+            if key.endswith(".partial"):
+                continue
+            if key not in self.entries and os.path.exists(os.path.join(self.__path(key), "meta.json")):
+                self.entries[key] = dict(bytes=self.__size(key), lastAccess=0.0)
+        self.entries = {key: entry for key, entry in self.entries.items() if os.path.isdir(self.__path(key))}
+
+    def __size(self, key):
+
+        path = self.__path(key)
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def key(self, parameters, total_round, seed, convergence=None):
+
+        return cache_key(parameters, total_round, seed, convergence)
+
+    def size(self):
+
+        # the bytes of all entries
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def get(self, key):
+
+        # the cached result of a key as a ResultReader, None on a miss
+        if key not in self:
+            return None
+        self.entries[key]["lastAccess"] = time.time()
+        self.__save()
+        return ResultReader(self.__path(key))
+
+    def put(self, key, result, parameters=None, annotations=None):
+
+        # store a result array of [round, totalBalance, bidPrice. txFee] rows under key
+        # @:return the stored result as a ResultReader
+        result = np.asarray(result)
+        sink = ResultSink(self.__path(key) + ".partial", parameters, capacity=len(result),
+                          chunk_rows=len(result), member_shape=result.shape[1:-1])
+        sink.annotations.update(annotations or {})
+        sink.extend(result)
+        sink.close()
+        return self.__commit(key)
+
+    def simulate(self, parameters, total_round, seed, convergence=None):
+
+        # the result of a simulation, from the cache or by running it and storing the result
+        # the rows are streamed to disk while the simulation runs, so a miss costs no memory for the result
+        # @:param convergence optional ConvergenceDetector keyword arguments to stop the simulation early
+        # @:return a ResultReader, with the stop reason and round in its annotations (None if it did not stop)
+        key = self.key(parameters, total_round, seed, convergence)
+        result = self.get(key)
+        if result is not None:
+            return result
+
+        # the entry has the same parameters and annotations as an entry stored by run_sweep
+        arguments = simulation_arguments(parameters)
+        sink = ResultSink(self.__path(key) + ".partial", capacity=total_round + 1)
+        simulation = Simulation(**dict(parameters, tt=False, horizon=total_round, seed=seed, sink=sink))
+        sink.parameters = arguments
+        simulation.run(total_round, None if convergence is None else ConvergenceDetector(**convergence))
+        sink.annotations.update(stopReason=simulation.stopReason, stopRound=simulation.stopRound)
+        simulation.close()
+        return self.__commit(key)
+
+    def __commit(self, key):
+
+        # move a complete entry in place, a concurrent writer of the same key may have been faster
+        partial = self.__path(key) + ".partial"
+        if os.path.isdir(self.__path(key)):
+            shutil.rmtree(partial)
+        else:
+            os.replace(partial, self.__path(key))
+        self.entries[key] = dict(bytes=self.__size(key), lastAccess=time.time())
+        self.evict(keep=key)
+        return ResultReader(self.__path(key))
+
+    def evict(self, keep=None):
+
+        # remove the least recently used entries until the cache fits into max_bytes, except the entry keep
+        total = self.size()
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["lastAccess"]):
+            if total <= self.maxBytes:
+                break
+            if key != keep:
+                total -= self.entries[key]["bytes"]
+                self.__remove(key)
+        self.__save()
+
+    def __remove(self, key):
+
+        shutil.rmtree(self.__path(key), ignore_errors=True)
+        self.entries.pop(key, None)
+
+    def invalidate(self, key):
+
+        # remove the entry of a key, e.g. a result produced by a faulty model
+        # @:return True if there was an entry
+        found = key in self.entries
+        self.__remove(key)
+        self.__save()
+        return found
+
+    def invalidate_where(self, **parameters):
+
+        # remove all entries whose simulation parameters include the given values, e.g. invalidate_where(gamma=1)
+        # @:return the number of removed entries
+        parameters = canonical(parameters)
+        removed = 0
+        for key in list(self.entries):
+            stored = canonical(ResultReader(self.__path(key)).parameters)
+            if all(name in stored and stored[name] == value for name, value in parameters.items()):
+                self.__remove(key)
+                removed += 1
+        self.__save()
+        return removed
+
+    def clear(self):
+
+        # remove all entries
+        for key in list(self.entries):
+            self.__remove(key)
+        self.__save()
+
+
+if __name__ == '__main__':
+
+    import tempfile
+    from .auction import AuctionEngine
+    from .sweep import run_sweep
+    from .ledger import TokenLedger, SyntheticTraffic, LedgerFeeModel
+
+    # bid models with different seeds or cost factors have different keys, and a used model is refused
+    total_balance = 1000000000000
+    base = dict(tb=total_balance, br=0.00005 * total_balance, me=0.000002 * total_balance, bw=10,
+                tf=0.00006 * total_balance)
+    engines = [AuctionEngine(200, 10, cost_spread=0.5, seed=1), AuctionEngine(200, 10, cost_spread=0.5, seed=2),
+               AuctionEngine(200, 10, cost_factors=np.ones(200), seed=1),
+               AuctionEngine(200, 10, cost_factors=np.full(200, 2.0), seed=1)]
+    engines += engines[0].spawn(2)
+    assert len({cache_key(dict(base, bid_model=engine), 100, 2020) for engine in engines}) == len(engines)
+    assert len({parameter_seed(2020, dict(base, bid_model=engine)).spawn_key for engine in engines}) == len(engines)
+    simulation = Simulation(**dict(base, tt=False, seed=2020, bid_model=engines[0]))
+    simulation.run(10)
+    try:
+        cache_key(dict(base, bid_model=engines[0]), 100, 2020)
+        raise AssertionError("a used bid model was cached")
+    except ValueError:
+        pass
+    print("bid model keys:", len(engines))
+
+    # fee models with different ledgers or traffic seeds have different keys
+    fee_models = [LedgerFeeModel(TokenLedger.from_supply(1000, total_balance, concentration, seed=ledger_seed),
+                                 SyntheticTraffic(100, seed=traffic_seed))
+                  for concentration, ledger_seed, traffic_seed in ((1.0, 1, 1), (1.0, 2, 1), (1.0, 1, 2), (0.0, 1, 1))]
+    assert len({cache_key(dict(base, fee_model=model), 100, 2020) for model in fee_models}) == len(fee_models)
+    print("fee model keys:", len(fee_models))
+
+    # an entry of simulate that stopped early is served to a sweep with NaN after its stop, and both writers
+    # annotate the stop, also of a run that did not stop
+    directory = tempfile.mkdtemp()
+    try:
+        cache = ResultCache(directory)
+        convergence = dict(window=500, tolerance=0.5)
+        stored = cache.simulate(base, 50000, parameter_seed(2020, base), convergence)
+        stopped = len(stored)
+        assert stopped < 50001 and stored.annotations["stopReason"] is not None
+        points, results, stops = run_sweep(base, [{}], 50000, seed=2020, convergence=convergence, cache=cache)
+        assert np.array_equal(results[0, :stopped], np.asarray(stored)) and np.isnan(results[0, stopped:]).all()
+        assert stops[0] == (stored.annotations["stopReason"], stored.annotations["stopRound"])
+        running = cache.simulate(base, 1000, 2020, dict(window=500, tolerance=1e-12))
+        assert running.annotations == dict(stopReason=None, stopRound=None)
+        print("mixed writers: stopped at row", stopped)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,268 @@
+import json
+import os
+import numpy as np
+from .resultBuffer import ResultBuffer
+
+# the columns of a simulation result
+RESULT_COLUMNS = ("round", "totalBalance", "bidPrice", "txFee")
+
+# the per-window statistics kept by a decimating sink
+WINDOW_STATISTICS = ("min", "mean", "max")
+
+
+'''
+write a JSON file atomically, so that a reader never sees a partial header
+'''
+def write_json(path, content):
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(content, f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+
+
+# output sink that streams simulation rows to a directory of memory-mapped .npy files, one per column,
+# with a small meta.json header holding the run parameters.
+# Rows are collected in a small in-memory chunk and flushed to disk when it is full, so the memory of a run
+# stays bounded however long it is. With decimation k > 1, only every k-th row is kept, together with the
+# min/mean/max of every column over each window of k rows.
+# A sink has the same interface as ResultBuffer, so it can replace the result buffer of a Simulation.
+class ResultSink:
+
+    def __init__(self, directory, parameters=None, decimation=1, capacity=1 << 16, chunk_rows=1 << 16,
+                 member_shape=()):
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.parameters = dict(parameters or {})
+        # information about the result besides its rows, e.g. why and when a simulation stopped early
+        self.annotations = {}
+        self.decimation = int(decimation)
+        self.memberShape = tuple(member_shape)
+
+        # rows not flushed yet, a row has one value for each member and column
+        self.rowShape = self.memberShape + (len(RESULT_COLUMNS),)
+        self.pending = ResultBuffer(self.rowShape, chunk_rows)
+        self.chunkRows = max(int(chunk_rows), self.decimation)
+
+        # the number of rows streamed (size), and the number of rows and windows stored on disk
+        self.size = 0
+        self.storedRows = 0
+        self.storedWindows = 0
+        # a closed sink is complete, its output is only read any more
+        self.closed = False
+
+        # memory-mapped files, the capacity grows by doubling when a run is longer than expected
+        self.capacity = max(int(capacity) // self.decimation, 1)
+        self.files = {}
+        for name in self.__file_names():
+            self.files[name] = np.lib.format.open_memmap(self.__path(name), mode="w+", dtype=np.float64,
+                                                         shape=(self.capacity,) + self.memberShape)
+        self.__write_header(False)
+
+    def __len__(self):
+
+        return self.size
+
+    def __file_names(self):
+
+        names = list(RESULT_COLUMNS)
+        if self.decimation > 1:
+            names += [column + "." + statistic for column in RESULT_COLUMNS for statistic in WINDOW_STATISTICS]
+        return names
+
+    def __path(self, name):
+
+        return os.path.join(self.directory, name + ".npy")
+
+    def __write_header(self, complete):
+
+        write_json(os.path.join(self.directory, "meta.json"), {
+            "parameters": self.parameters,
+            "annotations": self.annotations,
+            "columns": list(RESULT_COLUMNS),
+            "memberShape": list(self.memberShape),
+            "decimation": self.decimation,
+            "streamedRows": self.size,
+            "rows": self.storedRows,
+            "windows": self.storedWindows,
+            "complete": complete,
+        })
+
+    def __grow(self, needed):
+
+        # double the capacity of all files, the files are copied once
+        capacity = max(2 * self.capacity, needed)
+        for name in self.__file_names():
+            old = self.files[name]
+            new = np.lib.format.open_memmap(self.__path(name) + ".grow", mode="w+", dtype=np.float64,
+                                            shape=(capacity,) + self.memberShape)
+            new[:self.capacity] = old
+            new.flush()
+            del old
+            os.replace(self.__path(name) + ".grow", self.__path(name))
+            self.files[name] = new
+        self.capacity = capacity
+
+    def __store(self, rows, final=False):
+
+        # store complete windows of rows, and a partial window only at the end of the run
+        k = self.decimation
+        windows = len(rows) // k if not final else -(-len(rows) // k)
+        if windows == 0:
+            return 0
+        if self.storedRows + windows > self.capacity:
+            self.__grow(self.storedRows + windows)
+
+        kept = rows[:windows * k:k] if k > 1 else rows
+        for i, column in enumerate(RESULT_COLUMNS):
+            self.files[column][self.storedRows:self.storedRows + windows] = kept[..., i]
+
+        if k > 1:
+            complete = len(rows) // k
+            body = rows[:complete * k].reshape((complete, k) + self.rowShape)
+            for i, column in enumerate(RESULT_COLUMNS):
+                target = slice(self.storedWindows, self.storedWindows + complete)
+                self.files[column + ".min"][target] = body[..., i].min(axis=1)
+                self.files[column + ".mean"][target] = body[..., i].mean(axis=1)
+                self.files[column + ".max"][target] = body[..., i].max(axis=1)
+                if windows > complete:
+                    tail = rows[complete * k:, ..., i]
+                    self.files[column + ".min"][self.storedWindows + complete] = tail.min(axis=0)
+                    self.files[column + ".mean"][self.storedWindows + complete] = tail.mean(axis=0)
+                    self.files[column + ".max"][self.storedWindows + complete] = tail.max(axis=0)
+            self.storedWindows += windows
+
+        self.storedRows += windows
+        return min(windows * k, len(rows))
+
+    def flush(self, final=False):
+
+        # write the pending rows to disk, rows of an incomplete window stay pending until the run ends
+        if self.closed:
+            return
+        rows = self.pending.view()
+        written = self.__store(rows, final)
+        remaining = len(rows) - written
+        if remaining:
+            rows[:remaining] = rows[written:].copy()
+        self.pending.size = remaining
+        for name in self.__file_names():
+            self.files[name].flush()
+        self.__write_header(final)
+
+    def close(self):
+
+        # flush all rows, including a last partial window, and mark the output as complete
+        if self.closed:
+            return
+        self.flush(final=True)
+        self.files = {}
+        self.closed = True
+
+    def reserve(self, capacity):
+
+        # the disk capacity grows on demand, nothing to do in advance
+        pass
+
+    def __make_room(self, count):
+
+        # rows returned by next_row(s) are filled by the caller before the next call, so they are flushed then
+        if self.pending.size + count > self.chunkRows:
+            self.flush()
+
+    def append(self, row):
+
+        self.__make_room(1)
+        self.pending.append(row)
+        self.size += 1
+
+    def next_row(self):
+
+        self.__make_room(1)
+        self.size += 1
+        return self.pending.next_row()
+
+    def next_rows(self, count):
+
+        self.__make_room(count)
+        self.size += count
+        return self.pending.next_rows(count)
+
+    def extend(self, rows):
+
+        self.next_rows(len(rows))[:] = rows
+
+    def view(self):
+
+        # flush the pending rows, and read the stored result lazily
+        self.flush()
+        return ResultReader(self.directory)
+
+
+# lazy reader of the output of a ResultSink
+# reader[:, i] returns column i as a read-only memory map, so a plot reads only what it draws;
+# for an ensemble output reader[:, member, i] works the same as on the in-memory result
+class ResultReader:
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.parameters = self.meta["parameters"]
+        self.annotations = self.meta.get("annotations", {})
+        self.decimation = self.meta["decimation"]
+        self.columns = self.meta["columns"]
+        self.shape = (self.meta["rows"],) + tuple(self.meta["memberShape"]) + (len(self.columns),)
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    def column(self, name, statistic=None):
+
+        # a column, or for a decimated output one of the per-window statistics min, mean and max
+        name = name if statistic is None else name + "." + statistic
+        rows = self.meta["rows"] if statistic is None else self.meta["windows"]
+        return np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r")[:rows]
+
+    def __getitem__(self, key):
+
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) == len(self.shape) and isinstance(key[-1], (int, np.integer)):
+            return self.column(self.columns[key[-1]])[key[:-1]]
+
+        # any other selection needs all columns
+        return np.stack([self.column(name) for name in self.columns], axis=-1)[key]
+
+    def __array__(self, dtype=None, copy=None):
+
+        result = np.stack([self.column(name) for name in self.columns], axis=-1)
+        return result if dtype is None else result.astype(dtype)
+
+
+'''
+open the output of a ResultSink lazily
+@:param directory the output directory of the sink
+'''
+def load_result(directory):
+
+    return ResultReader(directory)
+
+
+# the main function to test
+if __name__ == '__main__':
+
+    import tempfile
+    from .simulation import Simulation
+
+    # the result of a streamed simulation is readable after the simulation (and its sink) is closed
+    directory = tempfile.mkdtemp()
+    simulation = Simulation(1000000000000, 35000000, 6000000, 10, 60000000, False, seed=2020,
+                            sink=ResultSink(directory, chunk_rows=1000))
+    simulation.run(2500)
+    simulation.close()
+    result = simulation.result
+    assert len(result) == 2501 and result[-1, 0] == 2500
+    assert np.array_equal(np.asarray(result), np.asarray(load_result(directory)))
+    print("closed sink result:", result.shape)
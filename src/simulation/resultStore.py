@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+import numpy as np
+from .simulation import Simulation
+from .convergence import ConvergenceDetector
+from .resultCache import canonical
+from .resultSink import RESULT_COLUMNS, ResultSink, ResultReader, write_json
+
+# the fields of every run in the index besides its parameters and annotations
+#   run          the id of the run, the name of its directory
+#   rows         the number of stored rows
+#   firstRound   the round of the first stored row
+#   lastRound    the round of the last stored row
+#   final.<col>  the last stored value of every column of RESULT_COLUMNS, e.g. final.totalBalance
+RUN_FIELDS = ("run", "rows", "firstRound", "lastRound") + tuple("final." + column for column in RESULT_COLUMNS)
+
+
+'''
+the boolean mask of the values of an index field that match a condition
+@:param values the values of the field for every run, a numpy array
+@:param condition a value for equality, a (low, high) tuple for low <= value <= high (None for an open end),
+                  a list or set of accepted values, or a function from the values to a mask
+'''
+def match(values, condition):
+
+    if callable(condition):
+        return np.asarray(condition(values), dtype=bool)
+    if isinstance(condition, tuple):
+        low, high = condition
+        with np.errstate(invalid="ignore"):
+            mask = np.ones(len(values), dtype=bool) if low is None else values >= low
+            return mask if high is None else mask & (values <= high)
+    if isinstance(condition, (list, set)):
+        accepted = [canonical(value) for value in condition]
+        return np.array([value in accepted for value in values], dtype=bool)
+    condition = canonical(condition)
+    if values.dtype == object:
+        return np.array([value == condition for value in values], dtype=bool)
+    return values == condition
+
+
+'''
+the column of an index field over all runs, numeric if all runs have a number (or a bool), otherwise of objects
+runs without the field have NaN (numeric) or None
+'''
+def field_column(entries, name):
+
+    values = [entry.get(name) for entry in entries]
+    if all(isinstance(value, (int, float, bool)) or value is None for value in values) and \
+            any(value is not None for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+# persistent store of many simulation runs with their parameters, for queries across runs
+# Every run is the output of a ResultSink in its own directory (one memory-mapped .npy file per column), and an
+# index.json file keeps the parameters, annotations, round range and final row of all runs. Queries on
+# parameters and final values are answered from the index alone, as vectorized comparisons over its columns;
+# a round range is read from every selected run by a binary search on its round column, so only the pages
+# of the requested rows are read from disk.
+#   runs = store.select(gamma=(1, None), rprop=True)
+#   store.final("totalBalance", runs)
+#   store.window(140000, 160000, "totalBalance", runs)
+# A store has a single writer at a time; runs are written to a temporary directory and renamed when complete.
+class ResultStore:
+
+    def __init__(self, directory):
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.indexPath = os.path.join(directory, "index.json")
+        self.entries = []
+        self.nextRun = 0
+        self.columns = {}
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                index = json.load(f)
+            self.entries = index["runs"]
+            self.nextRun = index["nextRun"]
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def __path(self, run):
+
+        return os.path.join(self.directory, "%08d" % run)
+
+    def __save(self):
+
+        write_json(self.indexPath, dict(nextRun=self.nextRun, runs=self.entries))
+        self.columns = {}
+
+    def column(self, name):
+
+        # the values of an index field for all runs, built once after every change of the index
+        if name not in self.columns:
+            self.columns[name] = field_column(self.entries, name)
+        return self.columns[name]
+
+    def fields(self):
+
+        # the names of all index fields, parameters and annotations of any run included
+        return sorted({name for entry in self.entries for name in entry})
+
+    def __register(self, run, annotations=None, save=True):
+
+        # add a complete run directory to the index, which is written unless save is False
+        reader = ResultReader(self.__path(run) + ".partial")
+        reader.annotations.update(canonical(annotations or {}))
+        rounds = reader.column("round")
+        entry = dict(canonical(reader.parameters), **canonical(reader.annotations))
+        entry.update(run=run, rows=len(reader), firstRound=float(rounds[0]) if len(reader) else None,
+                     lastRound=float(rounds[-1]) if len(reader) else None)
+        for column in RESULT_COLUMNS:
+            entry["final." + column] = float(reader.column(column)[-1]) if len(reader) else None
+
+        # annotations given later are written into the header of the run as well
+        if annotations:
+            reader.meta["annotations"] = reader.annotations
+            write_json(os.path.join(reader.directory, "meta.json"), reader.meta)
+        os.replace(self.__path(run) + ".partial", self.__path(run))
+        self.entries.append(entry)
+        if save:
+            self.__save()
+        else:
+            self.columns = {}
+        return run
+
+    def __new_run(self):
+
+        run = self.nextRun
+        self.nextRun += 1
+        return run
+
+    def add(self, result, parameters=None, annotations=None, decimation=1, save=True):
+
+        # store a result, an array of [round, totalBalance, bidPrice. txFee] rows or a finished Simulation
+        # @:param parameters the parameters of the run, taken from the simulation if None
+        # @:param annotations further information about the run, e.g. dict(scenario="ablation")
+        # @:param save False to write the index later (by the next call that saves it), for adding many runs
+        # @:return the id of the run
+        if isinstance(result, Simulation):
+            parameters = result.parameters if parameters is None else parameters
+            annotations = dict(result.resultBuffer.annotations, **(annotations or {}))
+            result = result.result
+        result = np.asarray(result)
+        if result.ndim != 2:
+            raise ValueError("a run has rows of %s, use add_members for an ensemble" % (RESULT_COLUMNS,))
+
+        run = self.__new_run()
+        chunk_rows = 1 << 16
+        sink = ResultSink(self.__path(run) + ".partial", canonical(parameters or {}), decimation,
+                          capacity=len(result), chunk_rows=chunk_rows)
+        for start in range(0, len(result), chunk_rows):
+            sink.extend(result[start:start + chunk_rows])
+        sink.close()
+        return self.__register(run, annotations, save)
+
+    def add_members(self, result, parameters, annotations=None, decimation=1):
+
+        # store every member of an ensemble result of shape (rounds, members, 4) as a run of its own
+        # @:param parameters a dict of the parameters of the members, each one a value shared by all members or
+        #                    a sequence with a value for every member, as the arguments of SimulationEnsemble
+        # @:return the ids of the runs
+        result = np.asarray(result)
+        members = result.shape[1]
+        runs = []
+        for member in range(members):
+            member_parameters = {name: value[member] if isinstance(value, (list, tuple, np.ndarray)) else value
+                                 for name, value in parameters.items()}
+            member_annotations = {name: value[member] if isinstance(value, (list, tuple, np.ndarray)) else value
+                                  for name, value in (annotations or {}).items()}
+            runs.append(self.add(result[:, member], member_parameters, member_annotations, decimation, save=False))
+        self.__save()
+        return runs
+
+    def simulate(self, parameters, total_round, seed=None, convergence=None, decimation=1, annotations=None):
+
+        # run a simulation that streams its rows into the store, without holding its result in memory
+        # @:param convergence optional ConvergenceDetector keyword arguments to stop the simulation early
+        # @:return the id of the run
+        run = self.__new_run()
+        sink = ResultSink(self.__path(run) + ".partial", decimation=decimation,
+                          capacity=total_round + 1)
+        simulation = Simulation(**dict(parameters, tt=False, horizon=total_round, seed=seed, sink=sink))
+        simulation.run(total_round, None if convergence is None else ConvergenceDetector(**convergence))
+        simulation.close()
+        return self.__register(run, annotations)
+
+    def select(self, **conditions):
+
+        # the ids of the runs whose index fields match all conditions, see match
+        # e.g. select(gamma=(1, None), rprop=True, scenario=["ablation", "sweep"])
+        mask = np.ones(len(self.entries), dtype=bool)
+        for name, condition in conditions.items():
+            mask &= match(self.column(name), condition)
+        return self.column("run")[mask].astype(np.int64)
+
+    def __rows(self, runs):
+
+        # the index rows of runs, all runs if None; run ids are increasing, so a binary search finds them
+        if runs is None:
+            return np.arange(len(self.entries))
+        runs = np.atleast_1d(np.asarray(runs, dtype=np.int64))
+        ids = self.column("run")
+        rows = np.minimum(np.searchsorted(ids, runs), max(len(ids) - 1, 0))
+        if len(runs) and (len(ids) == 0 or np.any(ids[rows] != runs)):
+            raise KeyError("unknown runs %s" % (np.setdiff1d(runs, ids),))
+        return rows
+
+    def values(self, name, runs=None):
+
+        # the values of an index field for runs, all runs if None
+        return self.column(name)[self.__rows(runs)]
+
+    def final(self, column="totalBalance", runs=None):
+
+        # the last stored value of a column for runs, read from the index
+        return self.values("final." + column, runs)
+
+    def parameters(self, run):
+
+        return self.entries[int(self.__rows([run])[0])]
+
+    def reader(self, run):
+
+        # the stored result of a run, read lazily
+        return ResultReader(self.__path(run))
+
+    def window(self, first_round, last_round, column="totalBalance", runs=None):
+
+        # the rows of every run with first_round <= round <= last_round, of one column
+        # only the rows in the range are read, found by a binary search on the memory-mapped round column
+        # @:return a list of (rounds, values) arrays, one pair for every run
+        windows = []
+        for run in self.values("run", runs).astype(np.int64):
+            reader = self.reader(run)
+            rounds = reader.column("round")
+            start = int(np.searchsorted(rounds, first_round, side="left"))
+            stop = int(np.searchsorted(rounds, last_round, side="right"))
+            windows.append((np.array(rounds[start:stop]), np.array(reader.column(column)[start:stop])))
+        return windows
+
+    def at_round(self, round_number, column="totalBalance", runs=None):
+
+        # the value of a column at the last stored row up to round_number for every run, NaN before the first row
+        values = np.full(len(self.__rows(runs)), np.nan)
+        for i, run in enumerate(self.values("run", runs).astype(np.int64)):
+            reader = self.reader(run)
+            row = int(np.searchsorted(reader.column("round"), round_number, side="right")) - 1
+            if row >= 0:
+                values[i] = reader.column(column)[row]
+        return values
+
+    def remove(self, runs):
+
+        # remove runs from the store
+        runs = set(int(run) for run in np.atleast_1d(runs))
+        for run in runs:
+            shutil.rmtree(self.__path(run), ignore_errors=True)
+        self.entries = [entry for entry in self.entries if entry["run"] not in runs]
+        self.__save()
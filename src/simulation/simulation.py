@@ -1,12 +1,44 @@
 import numpy as np
 from .statHelper import *
-from .draw import *
+from .resultBuffer import ResultBuffer
+from .telemetry import Telemetry, PrintSink, clock
+from .perturbation import PerturbationSchedule
 import math
+import json
 
 # class for aucMint simulation
 class Simulation:
 
-    def __init__(self, tb, br, me, bw, tf, tt=True, cprop=False, rprop=False, pt=0, gamma=0.5, ur=1/15000):
+    # the state of a simulation is fixed, which keeps attribute access in the round loop cheap
+    __slots__ = ("totalBalance", "blockReward", "blockRewardRate", "miningExpense", "miningExpenseRate",
+                 "bidWinner", "negbinSampling", "transactionFeePredict", "exchangeCoefficient", "updateRate",
+                 "gamma", "exCoeffConstant", "sampler", "round", "traceTag", "telemetry", "update_mining_cost_tag",
+                 "update_block_reward_tag", "perturbationSpec", "perturbationSchedule", "bidModel",
+                 "feeModel", "stopReason", "stopRound", "resultBuffer", "parameters")
+
+    # the number of rounds simulated at once by run, which bounds the memory of pre-drawn noise
+    runChunk = 4096
+
+    # the scalar state saved in a checkpoint, besides the sampler, the result and the parameters
+    checkpointFields = ("totalBalance", "blockReward", "blockRewardRate", "miningExpense", "miningExpenseRate",
+                        "bidWinner", "negbinSampling", "transactionFeePredict", "exchangeCoefficient", "updateRate",
+                        "gamma", "exCoeffConstant", "round", "update_mining_cost_tag",
+                        "update_block_reward_tag", "perturbation_type", "stopReason", "stopRound")
+
+    def __init__(self, tb, br, me, bw, tf, tt=True, cprop=False, rprop=False, pt=0, gamma=0.5, ur=1/15000,
+                 horizon=None, seed=None, negbin=False, sink=None, bid_model=None, fee_model=None):
+
+        # the perturbations, a perturbation type or a PerturbationSchedule (see perturbation_type)
+        self.perturbation_type = pt
+
+        # the constructor parameters, recorded with streamed results
+        self.parameters = dict(tb=tb, br=br, me=me, bw=bw, tf=tf, tt=bool(tt), cprop=cprop, rprop=rprop,
+                               pt=self.perturbationSpec, gamma=gamma, ur=ur, negbin=negbin,
+                               seed=seed if seed is None or isinstance(seed, int) else repr(seed))
+        if bid_model is not None:
+            self.parameters["bid_model"] = bid_model.parameters
+        if fee_model is not None:
+            self.parameters["fee_model"] = fee_model.parameters
 
         # system total balance
         self.totalBalance = tb
@@ -22,6 +54,20 @@ class Simulation:
         # the number of bid winners
         self.bidWinner = bw
 
+        # the model clearing the auction of a round, e.g. an AuctionEngine with many heterogeneous bidders
+        # a bid model is called with the simulation and returns an AuctionOutcome of the round,
+        # None to derive a single bid price from the average mining cost of bidWinner * 20 bidders
+        self.bidModel = bid_model
+
+        # the model of the transaction fee of the next round, e.g. a LedgerFeeModel replaying token traffic
+        # a fee model is called with the simulation and the expected fee and returns the fee,
+        # None to draw the fee from a normal distribution around the expected fee
+        self.feeModel = fee_model
+
+        # True to draw the sum of all sampled mining costs as a single negative binomial variate,
+        # which keeps the sampling cost of a round independent of the number of bid winners
+        self.negbinSampling = negbin
+
         # the transaction fee predicted from total balance,
         self.transactionFeePredict = tf
 
@@ -35,43 +81,167 @@ class Simulation:
         self.gamma = gamma
         self.exCoeffConstant = self.exchangeCoefficient / math.pow(self.totalBalance, self.gamma)
 
+        # the random sampler of this simulation, each simulation owns an independent stream
+        # seed can be an int, a numpy SeedSequence, or a RandomSampler (e.g. one spawned from a parent sampler)
+        self.sampler = seed if isinstance(seed, RandomSampler) else RandomSampler(seed)
+
         # simulation round
         # initialized as 1
         self.round = 1
 
         # if simulation needs to be traced
-        self.traceTag = tt
+        # tt=True traces to the console every 1000 rounds, a Telemetry object gives other sinks and timing
+        self.telemetry = None
+        self.set_telemetry(tt)
         # True if use C-prop, False to use C-const
         self.update_mining_cost_tag = cprop
         # True if use R-prop, False to use R-const
         self.update_block_reward_tag = rprop
 
-        # the perturbation type
-        self.perturbation_type = pt
+        # why and at which round run stopped early, see ConvergenceDetector, None while not stopped
+        self.stopReason = None
+        self.stopRound = None
 
         # simulation result
         # [round, totalBalance, bidPrice. txFee]
-        self.result = np.array([
-            [0, self.totalBalance, 0, self.transactionFeePredict]
-        ])
+        # if the number of rounds (horizon) is known, the whole result is preallocated
+        # with a ResultSink as sink, rows are streamed to disk instead of being kept in memory
+        if sink is None:
+            self.resultBuffer = ResultBuffer(4, 1024 if horizon is None else horizon + 1)
+        else:
+            self.resultBuffer = sink
+            sink.parameters.update(self.parameters)
+        self.resultBuffer.append([0, self.totalBalance, 0, self.transactionFeePredict])
+
+    @property
+    def result(self):
+
+        # all rows recorded so far, as an array of [round, totalBalance, bidPrice. txFee]
+        # (a lazy ResultReader if the result is streamed to a sink)
+        return self.resultBuffer.view()
+
+    @property
+    def perturbation_type(self):
+
+        # the perturbation type, or the json-compatible description of a perturbation schedule
+        return self.perturbationSpec
+
+    @perturbation_type.setter
+    def perturbation_type(self, pt):
+
+        # pt is a perturbation type (see PerturbationSchedule.preset), a PerturbationSchedule,
+        # a list of perturbation events, or the path of a JSON file of events
+        self.perturbationSchedule = PerturbationSchedule.build(pt)
+        self.perturbationSpec = pt if isinstance(pt, (int, np.integer)) else self.perturbationSchedule.to_spec()
+
+    def set_telemetry(self, tt):
+
+        # attach a Telemetry, True for the console trace, False or None to disable tracing
+        if tt is True:
+            tt = Telemetry([PrintSink()])
+        self.telemetry = tt or None
+        self.traceTag = self.telemetry is not None
+
+    def close(self):
+
+        # finish the result, a sink writes its remaining rows to disk
+        self.resultBuffer.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+    def save_checkpoint(self, path):
+
+        # save the state, the random sampler and the result so far to a compressed .npz file
+        # a simulation loaded from it continues with exactly the same rounds as this one
+        sampler_state, sampler_blocks = self.sampler.get_state()
+        state = dict(fields={name: getattr(self, name) for name in self.checkpointFields},
+                     parameters=self.parameters, sampler=sampler_state)
+        np.savez_compressed(path, state=json.dumps(state, default=lambda value: value.item()),
+                            result=np.asarray(self.result),
+                            **{"block_" + name: block for name, block in sampler_blocks.items()})
+
+    @classmethod
+    def load_checkpoint(cls, path, horizon=None, sink=None, tt=False, bid_model=None, fee_model=None):
+
+        # restore a simulation saved by save_checkpoint
+        # @:param horizon the number of rounds still to run, to preallocate the result
+        # @:param sink an optional ResultSink receiving the restored result and all further rounds
+        # @:param tt the tracing of the restored simulation, see set_telemetry
+        # @:param bid_model the bid model of the restored simulation, bid models are not saved in a checkpoint
+        # @:param fee_model the fee model of the restored simulation, fee models are not saved either
+        with np.load(path) as checkpoint:
+            state = json.loads(str(checkpoint["state"]))
+            result = checkpoint["result"]
+            blocks = {key[len("block_"):]: checkpoint[key] for key in checkpoint.files if key.startswith("block_")}
+
+        simulation = cls.__new__(cls)
+        simulation.stopReason = simulation.stopRound = None
+        for name, value in state["fields"].items():
+            setattr(simulation, name, value)
+        simulation.parameters = state["parameters"]
+        simulation.sampler = RandomSampler.from_state(state["sampler"], blocks)
+        simulation.bidModel = bid_model
+        simulation.feeModel = fee_model
+        simulation.set_telemetry(tt)
+        if sink is None:
+            simulation.resultBuffer = ResultBuffer(4, len(result) + (horizon or 1024))
+        else:
+            simulation.resultBuffer = sink
+            sink.parameters.update(simulation.parameters)
+        simulation.resultBuffer.extend(result)
+        if simulation.stopReason is not None:
+            simulation.resultBuffer.annotations.update(stopReason=simulation.stopReason,
+                                                       stopRound=simulation.stopRound)
+        return simulation
+
+    def fork(self, n, keep_result=True):
+
+        # fork n branches continuing from the current state, e.g. what-if scenarios after a shared warm-up
+        # every branch draws from its own random stream spawned from this simulation's sampler,
+        # its perturbation_type or other settings can be changed before it runs
+        # a bid model or fee model with a spawn method (as AuctionEngine) is spawned for the branches as well
+        # @:param keep_result True to copy the result so far into every branch, False to start empty results
+        bid_models = [self.bidModel] * n if self.bidModel is None else self.bidModel.spawn(n)
+        fee_models = [self.feeModel] * n if self.feeModel is None else self.feeModel.spawn(n)
+        branches = []
+        for sampler, bid_model, fee_model in zip(self.sampler.spawn(n), bid_models, fee_models):
+            branch = Simulation.__new__(Simulation)
+            for name in self.checkpointFields:
+                setattr(branch, name, getattr(self, name))
+            branch.parameters = dict(self.parameters)
+            branch.sampler = sampler
+            branch.bidModel = bid_model
+            branch.feeModel = fee_model
+            branch.set_telemetry(None)
+            branch.resultBuffer = ResultBuffer(4)
+            if keep_result:
+                branch.resultBuffer.extend(np.asarray(self.result))
+            branches.append(branch)
+        return branches
 
     def single_round(self):
 
-        # the bid price of this round
-        bid_price = self.__calculate_bid()
+        # rounds with phase timing take a separate, instrumented path
+        if self.telemetry is not None and self.telemetry.timing:
+            self.__timed_round()
+            return
 
-        # information for this round
-        round_info = np.array([[self.round, self.totalBalance, bid_price, self.transactionFeePredict]])
+        # the bid price of this round, and the tokens minted and burnt by its liquidation
+        if self.bidModel is None:
+            bid_price = self.__calculate_bid()
+            minted, burnt = self.blockReward, self.bidWinner * bid_price
+        else:
+            bid_price, _, minted, burnt = self.bidModel(self)[:4]
 
         # data tracing
-        if self.traceTag:
+        if self.telemetry is not None:
             self.trace_result(bid_price)
 
-        # concatenate self.result with info of this round
-        self.result = np.concatenate((self.result, round_info), axis=0)
+        # append info of this round to self.result
+        self.resultBuffer.append((self.round, self.totalBalance, bid_price, self.transactionFeePredict))
 
         # update totalBalance, blockReward, miningCost and exchangeCoefficient for the next round, optional
-        self.__update_total_balance(bid_price)
+        self.__update_total_balance(minted, burnt)
         if self.update_block_reward_tag:
             self.__update_block_reward_from_total_balance()
         if self.update_mining_cost_tag:
@@ -82,18 +252,209 @@ class Simulation:
         self.transactionFeePredict = self.__update_predict_transaction_fee_from_total_balance()
 
         # make perturbations
-        self.__make_perturbations(self.perturbation_type)
+        self.__make_perturbations()
 
         # update round number
         self.round += 1
 
+    def __timed_round(self):
+
+        # the same round as single_round, with the time of every phase recorded by telemetry
+        start = clock()
+        if self.bidModel is None:
+            mining_cost = self.__sample_mining_cost()
+            sampled = clock()
+            bid_price = self.__bid_from_mining_cost(mining_cost)
+            minted, burnt = self.blockReward, self.bidWinner * bid_price
+        else:
+            # a bid model samples and bids at once, which is all timed as bidding
+            sampled = start
+            bid_price, _, minted, burnt = self.bidModel(self)[:4]
+        bid = clock()
+
+        self.trace_result(bid_price)
+        self.resultBuffer.append((self.round, self.totalBalance, bid_price, self.transactionFeePredict))
+
+        recorded = clock()
+        self.__update_total_balance(minted, burnt)
+        if self.update_block_reward_tag:
+            self.__update_block_reward_from_total_balance()
+        if self.update_mining_cost_tag:
+            self.__update_mining_cost_from_total_balance()
+        balance = clock()
+        self.__update_exchange_coefficient_from_total_balance()
+        coefficient = clock()
+        self.transactionFeePredict = self.__update_predict_transaction_fee_from_total_balance()
+        fee = clock()
+        self.__make_perturbations()
+        perturbation = clock()
+
+        self.telemetry.add_phase_times((sampled - start + fee - coefficient, bid - sampled, balance - recorded,
+                                        coefficient - balance, perturbation - fee))
+        self.round += 1
+
+    def run(self, n_rounds, detector=None):
+
+        # simulate n_rounds rounds in a tight loop, with the same result as calling single_round n_rounds times
+        # the state is held in locals, noise is taken from the sampler in chunks and rows are written in blocks
+        # phase timing needs the instrumented single_round, other telemetry is recorded once per chunk,
+        # and a bid model clears and a fee model collects every round by itself
+        # @:param detector an optional ConvergenceDetector observing the total balance of every round,
+        #                  the run stops as soon as it decides, see stopReason and stopRound
+        if detector is not None and detector.status[0]:
+            return
+        if detector is not None:
+            detector.relax(self.updateRate)
+        telemetry = self.telemetry
+        if self.bidModel is not None or self.feeModel is not None or telemetry is not None and telemetry.timing:
+            for _ in range(n_rounds):
+                rnd, total_balance = self.round, self.totalBalance
+                self.single_round()
+                if detector is not None and len(detector.update(rnd, [total_balance])):
+                    self.__stop(detector)
+                    return
+            return
+        record = telemetry is not None
+
+        self.resultBuffer.reserve(len(self.resultBuffer) + n_rounds)
+        sampler = self.sampler
+        sample_times = self.bidWinner * 20
+        bid_winner = self.bidWinner
+        yield_rate = 1.05
+        gamma = self.gamma
+        update_rate = self.updateRate
+        ex_coeff_constant = self.exCoeffConstant
+        block_reward_rate = self.blockRewardRate
+        mining_expense_rate = self.miningExpenseRate
+        update_block_reward = self.update_block_reward_tag
+        update_mining_cost = self.update_mining_cost_tag
+        negbin = self.negbinSampling
+        power = math.pow
+
+        # the state of the simulation
+        total_balance = self.totalBalance
+        block_reward = self.blockReward
+        mining_expense = self.miningExpense
+        exchange_coefficient = self.exchangeCoefficient
+        fee = self.transactionFeePredict
+        rnd = self.round
+
+        # the perturbations of this simulation, only one integer compare per round until the next one is due
+        schedule = self.perturbationSchedule
+        next_shock = schedule.next_round(schedule.index_at(rnd))
+
+        done = 0
+        while done < n_rounds:
+            chunk = min(self.runChunk, n_rounds - done)
+            # a chunk ends with a perturbation, which may change the mining expense the noise is drawn for,
+            # and with the window of a detector, which may stop the run
+            if next_shock >= rnd:
+                chunk = min(chunk, next_shock - rnd + 1)
+            if detector is not None:
+                chunk = min(chunk, detector.rounds_to_window_end())
+
+            # noise of this chunk
+            normals = sampler.normalStream.take(chunk).tolist()
+            costs = None if update_mining_cost else sampler.geometric_means(
+                mining_expense, sample_times, chunk, negbin).tolist()
+
+            rounds = []
+            balances = []
+            bids = []
+            fees = []
+            mining_expenses = []
+            block_rewards = []
+            coefficients = []
+            for i in range(chunk):
+
+                # the bid price of this round
+                if costs is None:
+                    mining_cost = sampler.geometric_mean(mining_expense, sample_times, negbin)
+                else:
+                    mining_cost = costs[i]
+                bid_price = ((block_reward + fee) / bid_winner - mining_cost) / yield_rate
+
+                rounds.append(rnd)
+                balances.append(total_balance)
+                bids.append(bid_price)
+                fees.append(fee)
+                if record:
+                    mining_expenses.append(mining_expense)
+                    block_rewards.append(block_reward)
+                    coefficients.append(exchange_coefficient)
+
+                # update totalBalance, blockReward, miningCost and exchangeCoefficient for the next round
+                total_balance += block_reward
+                total_balance -= (bid_winner * bid_price)
+                if update_block_reward:
+                    block_reward = block_reward_rate * total_balance
+                if update_mining_cost:
+                    mining_expense = mining_expense_rate * total_balance
+                exchange_coefficient += (ex_coeff_constant * power(total_balance, gamma)
+                                         - exchange_coefficient) * update_rate
+
+                # update transaction fee for the next round
+                expected_fee = total_balance * exchange_coefficient
+                fee = expected_fee + expected_fee / 40 * normals[i]
+
+                # make perturbations
+                if rnd == next_shock:
+                    self.totalBalance = total_balance
+                    self.blockReward = block_reward
+                    self.miningExpense = mining_expense
+                    self.exchangeCoefficient = exchange_coefficient
+                    next_shock = schedule.next_round(schedule.apply(self, rnd))
+                    total_balance = self.totalBalance
+                    block_reward = self.blockReward
+                    block_reward_rate = self.blockRewardRate
+                    mining_expense = self.miningExpense
+                    mining_expense_rate = self.miningExpenseRate
+                    exchange_coefficient = self.exchangeCoefficient
+
+                rnd += 1
+
+            rows = self.resultBuffer.next_rows(chunk)
+            rows[:, 0] = rounds
+            rows[:, 1] = balances
+            rows[:, 2] = bids
+            rows[:, 3] = fees
+            if record:
+                telemetry.record_many(np.column_stack([rounds, balances, fees, mining_expenses, block_rewards,
+                                                       bids, coefficients]))
+            done += chunk
+            if detector is not None and len(detector.update_many(rounds, balances)):
+                break
+
+        self.totalBalance = total_balance
+        self.blockReward = block_reward
+        self.miningExpense = mining_expense
+        self.exchangeCoefficient = exchange_coefficient
+        self.transactionFeePredict = fee
+        self.round = rnd
+        if detector is not None and detector.status[0]:
+            self.__stop(detector)
+
+    def __stop(self, detector):
+
+        # record why and when the run stopped, with the result
+        self.stopReason = detector.reason(0)
+        self.stopRound = int(detector.stopRound[0])
+        self.resultBuffer.annotations.update(stopReason=self.stopReason, stopRound=self.stopRound)
+
     def __calculate_bid(self):
 
+        return self.__bid_from_mining_cost(self.__sample_mining_cost())
+
+    def __sample_mining_cost(self):
+
         # time of sampling
         sample_times = self.bidWinner * 20
 
         # sample mining cost from geometric distribution
-        mining_cost = sample_from_geometric_distribution(self.miningExpense, sample_times)
+        return sample_from_geometric_distribution(self.miningExpense, sample_times, self.sampler,
+                                                  self.negbinSampling)
+
+    def __bid_from_mining_cost(self, mining_cost):
 
         # the expected yield rate of bidders
         yield_rate = 1.05
@@ -101,22 +462,24 @@ class Simulation:
         # bid price for a single bidder
         return ((self.blockReward + self.transactionFeePredict) / self.bidWinner - mining_cost) / yield_rate
 
-    def __update_total_balance(self, bid_price):
+    def __update_total_balance(self, minted, burnt):
 
         # in each round, total balance will increase the amount of block reward (minted)
-        self.totalBalance += self.blockReward
+        self.totalBalance += minted
 
         # in each round, token for bid will burnt
-        self.totalBalance -= (self.bidWinner * bid_price)
+        self.totalBalance -= burnt
 
     def __update_predict_transaction_fee_from_total_balance(self):
 
         # calc the predicted tx fee for the next round
         # calculate the expected tx fee from total balance, with Exchange equation of exchange
         expected_fee = self.totalBalance * self.exchangeCoefficient
+        if self.feeModel is not None:
+            return self.feeModel(self, expected_fee)
 
         # sample from nor distribution
-        return sample_from_norm_distribution(expected_fee, expected_fee / 40)
+        return sample_from_norm_distribution(expected_fee, expected_fee / 40, self.sampler)
     
     def __update_block_reward_from_total_balance(self):
 
@@ -135,39 +498,19 @@ class Simulation:
         self.exchangeCoefficient += (self.exCoeffConstant * math.pow(self.totalBalance, self.gamma)
                                    - self.exchangeCoefficient) * self.updateRate
 
-    def __make_perturbations(self, perturbation_type):
-
-        # perturbation type decides which kind of perturbation will be deployed
-        # 1 indicates instant increase/decrease in total supply
-        # 2 indicates instant increase/decrease in exchange coefficient
-        # else indicates doing nothing
-        if perturbation_type == 1:
-            if self.round == 150000:
-                self.totalBalance *= 0.975
-            elif self.round == 300000:
-                self.totalBalance *= 1.025
-
-        elif perturbation_type == 2:
-            if self.round == 150000:
-                self.exchangeCoefficient *= 1.025
-            elif self.round == 300000:
-                self.exchangeCoefficient *= 0.975
-        else:
-            pass
+    def __make_perturbations(self):
+
+        # apply the perturbations of the schedule due at the end of this round, if any
+        self.perturbationSchedule.apply(self, self.round)
 
     def trace_result(self, bid_price):
 
-        if self.round % 1000 == 0:
-            print("====================================")
-            print("Simulation Round: ", self.round)
-            print("Total balance: ", self.totalBalance, self.totalBalance / self.totalBalance)
-            print("Tx Fee: ", self.transactionFeePredict, self.transactionFeePredict / self.totalBalance)
-            print("Mining cost: ", self.miningExpense, self.miningExpense / self.totalBalance)
-            print("Block Reward: ", self.blockReward, self.blockReward / self.totalBalance)
-            print("Bid Price: ", bid_price, bid_price / self.totalBalance)
-            print("Exchange Coefficient: ", self.exchangeCoefficient)
-            print("====================================")
+        # record the state of this round, telemetry emits it to its sinks every interval rounds
+        self.telemetry.record((self.round, self.totalBalance, self.transactionFeePredict, self.miningExpense,
+                               self.blockReward, bid_price, self.exchangeCoefficient))
 
     def draw_time_series(self):
 
-        draw_all(self.result)
+        # plotting is optional, matplotlib is only imported when a simulation is drawn
+        from .draw import draw_all
+        return draw_all(self.result)
@@ -0,0 +1,166 @@
+from collections import namedtuple
+import numpy as np
+from .ensemble import SimulationEnsemble
+from .convergence import ConvergenceDetector
+
+# the parameters a stability boundary can be searched for
+#   gamma         the exponent of the exchange coefficient (gamma)
+#   ur            the update rate of the exchange coefficient (updateRate)
+#   kex0          the initial exchange coefficient, tf / tb
+#   reward_ratio  the ratio of block reward to mining expense, br / me
+STABILITY_PARAMETERS = ("gamma", "ur", "kex0", "reward_ratio")
+
+# the result of a stability boundary search
+#   parameter  the searched parameter
+#   stable     the end of the final bracket where the total balance converges
+#   unstable   the end of the final bracket where it diverges or does not converge within max_rounds
+#   boundary   the estimate of the boundary, the middle of the bracket (geometric middle on a log scale)
+#   probes     the number of probe runs
+#   rounds     the number of rounds simulated by all probes together
+#   history    a (value, status, stopRound) tuple for every probe, status as in ConvergenceDetector
+StabilityBoundary = namedtuple("StabilityBoundary",
+                               ("parameter", "stable", "unstable", "boundary", "probes", "rounds", "history"))
+
+# the default test of the probe runs, see ConvergenceDetector
+# no probe is stationary before 3 / ur rounds, when the exchange coefficient has relaxed, and the spread of
+# 4 window means of 5000 rounds must be within 0.1%, so that a slowly drifting supply is not taken as converged
+DEFAULT_CONVERGENCE = dict(window=5000, tolerance=1e-3, patience=3, divergence_factor=10.0, relaxations=3.0)
+
+
+'''
+the SimulationEnsemble keyword arguments of a probe, one member for every value of the searched parameter
+@:param base the SimulationEnsemble keyword arguments shared by all probes,
+            e.g. dict(tb=..., br=..., me=..., bw=..., tf=...)
+@:param parameter a name of STABILITY_PARAMETERS
+@:param values the values of the parameter
+'''
+def probe_arguments(base, parameter, values):
+
+    values = np.asarray(values, dtype=np.float64)
+    if parameter == "kex0":
+        return dict(base, tf=list(values * base["tb"]))
+    if parameter == "reward_ratio":
+        return dict(base, br=list(values * base["me"]))
+    if parameter in ("gamma", "ur"):
+        return dict(base, **{parameter: list(values)})
+    raise ValueError("unknown stability parameter %r, expected one of %s" % (parameter, STABILITY_PARAMETERS))
+
+
+# adaptive search of the value of a parameter where the total balance stops converging
+# A probe runs a SimulationEnsemble with one member for each probed value, and every member is stopped as soon
+# as a ConvergenceDetector decides that its total balance is stationary or diverged; a member still undecided
+# after max_rounds counts as unstable. Every iteration probes `sections` values evenly spaced in the current
+# bracket at once and keeps the subinterval where the outcome first changes, so the bracket shrinks by a factor
+# sections + 1 per probe (sections=1 is plain bisection). The members of a probe share their random numbers
+# (crn=True), so that neighbouring values differ by their parameter and not by their noise.
+# A single boundary in [low, high] is assumed; with several, the one closest to low is found.
+class StabilitySearch:
+
+    def __init__(self, base, parameter, low, high, sections=4, max_rounds=300000, convergence=None, seed=None,
+                 scale="linear"):
+
+        if parameter not in STABILITY_PARAMETERS:
+            raise ValueError("unknown stability parameter %r, expected one of %s"
+                             % (parameter, STABILITY_PARAMETERS))
+        if scale not in ("linear", "log"):
+            raise ValueError("scale must be 'linear' or 'log'")
+        self.base = dict(base)
+        self.parameter = parameter
+        self.low = low
+        self.high = high
+        self.sections = int(sections)
+        self.maxRounds = int(max_rounds)
+        self.convergence = dict(DEFAULT_CONVERGENCE, **(convergence or {}))
+        self.seed = seed
+        self.scale = scale
+
+        # every probed value with its outcome, and the rounds simulated so far
+        self.history = []
+        self.probes = 0
+        self.rounds = 0
+
+    def probe(self, values):
+
+        # run one probe of the values, all members are stopped as soon as they are decided
+        # @:return the status of every value, 1 for stationary, 2 for diverged and 0 for undecided
+        ensemble = SimulationEnsemble(**probe_arguments(self.base, self.parameter, values), seed=self.seed,
+                                      crn=True)
+        detector = ConvergenceDetector(ensemble.members, **self.convergence)
+
+        # a diverging member runs into overflows and invalid powers before it is stopped
+        with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+            ensemble.run(self.maxRounds, detector)
+
+        stop_round = np.where(detector.status > 0, detector.stopRound, self.maxRounds)
+        self.history += [(float(value), int(status), int(rnd))
+                         for value, status, rnd in zip(values, detector.status, stop_round)]
+        self.probes += 1
+        self.rounds += int(stop_round.sum())
+        return detector.status
+
+    def __points(self, low, high, count):
+
+        if self.scale == "log":
+            return np.geomspace(low, high, count)
+        return np.linspace(low, high, count)
+
+    def __middle(self, low, high):
+
+        return np.sqrt(low * high) if self.scale == "log" else (low + high) / 2
+
+    def search(self, resolution=None, max_iterations=20):
+
+        # narrow the bracket [low, high] until its width is at most resolution
+        # @:param resolution the absolute width of the final bracket, or on a log scale its ratio (e.g. 1.01),
+        #                    1 / 1000 of the initial bracket if None
+        # @:return a StabilityBoundary
+        # @:raise ValueError if both ends of the initial bracket have the same stability
+        if resolution is None:
+            resolution = (self.high / self.low) ** (1 / 1000) if self.scale == "log" \
+                else abs(self.high - self.low) / 1000
+
+        # the first probe includes both ends of the bracket, to know which side is stable
+        points = self.__points(self.low, self.high, self.sections + 2)
+        stable = self.probe(points) == 1
+        if stable[0] == stable[-1]:
+            raise ValueError("the total balance is %s at both ends of [%g, %g], there is no boundary to search"
+                             % ("stable" if stable[0] else "unstable", self.low, self.high))
+        low_stable = bool(stable[0])
+
+        for iteration in range(max_iterations + 1):
+
+            # the first change of stability from the low end
+            i = int(np.argmax(stable != low_stable))
+            low, high = points[i - 1], points[i]
+            width = high / low if self.scale == "log" else high - low
+            if width <= resolution or iteration == max_iterations:
+                break
+
+            # probe the interior of the new bracket, its ends are known
+            interior = self.__points(low, high, self.sections + 2)[1:-1]
+            points = np.concatenate([[low], interior, [high]])
+            stable = np.concatenate([[low_stable], self.probe(interior) == 1, [not low_stable]])
+
+        stable_end, unstable_end = (low, high) if low_stable else (high, low)
+        return StabilityBoundary(self.parameter, float(stable_end), float(unstable_end),
+                                 float(self.__middle(low, high)), self.probes, self.rounds, list(self.history))
+
+
+'''
+search the stability boundary of several parameters, each one with the others at their base values
+@:param base the SimulationEnsemble keyword arguments shared by all probes
+@:param brackets a dict mapping names of STABILITY_PARAMETERS to (low, high) or (low, high, scale) brackets,
+                 e.g. dict(ur=(0.5, 4), kex0=(1e-6, 1e-2, "log"))
+@:param resolution the resolution of every search, see StabilitySearch.search
+@:return a dict mapping every parameter to its StabilityBoundary
+'''
+def find_stability_boundaries(base, brackets, resolution=None, sections=4, max_rounds=300000, convergence=None,
+                              seed=None):
+
+    boundaries = {}
+    for parameter, bracket in brackets.items():
+        low, high = bracket[:2]
+        scale = bracket[2] if len(bracket) > 2 else "linear"
+        search = StabilitySearch(base, parameter, low, high, sections, max_rounds, convergence, seed, scale)
+        boundaries[parameter] = search.search(resolution)
+    return boundaries
@@ -1,14 +1,248 @@
+import hashlib
 import numpy as np
-from scipy.stats import geom, norm
 import math
 
 
+# a stream of standard variates, drawn from its own generator in large blocks
+# taking n variates always returns the same values, no matter how the takes are grouped
+class VariateStream:
+
+    def __init__(self, generator, draw, block_size, initial_size=None):
+
+        # the generator owned by this stream
+        self.generator = generator
+
+        # draw(generator, size) returns a block of variates
+        self.draw = draw
+
+        # the maximum size of a refilled block
+        # blocks start from initial_size and double on every refill until they reach block_size
+        self.blockSize = block_size
+        self.initialSize = block_size if initial_size is None else initial_size
+        self.nextSize = self.initialSize
+
+        # the current block and the index of the next unused variate in it
+        self.block = np.empty(0)
+        self.cursor = 0
+
+    def restart(self, draw):
+
+        # switch to another distribution, the unused variates of the current block are dropped
+        self.draw = draw
+        self.block = np.empty(0)
+        self.cursor = 0
+        self.nextSize = self.initialSize
+
+    def refill(self):
+
+        self.block = self.draw(self.generator, self.nextSize)
+        self.nextSize = min(2 * self.nextSize, self.blockSize)
+
+    def get_state(self):
+
+        # the state of this stream, as (json-compatible dict, unused variates of the current block)
+        return dict(generator=self.generator.bit_generator.state, cursor=0, nextSize=self.nextSize), \
+            np.array(self.block[self.cursor:])
+
+    def set_state(self, state, block):
+
+        self.generator.bit_generator.state = state["generator"]
+        self.nextSize = state["nextSize"]
+        self.block = np.array(block)
+        self.cursor = state["cursor"]
+
+    def take(self, n):
+
+        # fast path, the current block has enough variates
+        if self.cursor + n <= len(self.block):
+            self.cursor += n
+            return self.block[self.cursor - n:self.cursor]
+
+        # use up the current block, then refill lazily until n variates are collected
+        parts = [self.block[self.cursor:]]
+        remaining = n - len(parts[0])
+        while remaining > 0:
+            self.refill()
+            self.cursor = min(remaining, len(self.block))
+            parts.append(self.block[:self.cursor])
+            remaining -= self.cursor
+        return np.concatenate(parts)
+
+    def take_one(self):
+
+        # take a single variate as a python float
+        if self.cursor == len(self.block):
+            self.refill()
+            self.cursor = 0
+        self.cursor += 1
+        return float(self.block[self.cursor - 1])
+
+
+'''
+seeded sampler backed by numpy.random.Generator, for all random draws of a simulation
+standard exponential, standard normal and negative binomial variates are pre-drawn in blocks from independent streams,
+so that sampling in a round is an array index instead of a scipy call
+@:param seed an int, a numpy SeedSequence, or None for fresh entropy
+@:param block_size the number of variates drawn when a block is refilled
+'''
+class RandomSampler:
+
+    def __init__(self, seed=None, block_size=65536):
+
+        # the root of all streams of this sampler
+        self.seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.blockSize = block_size
+
+        # independent streams for mining cost (exponential) and transaction fee (normal) noise
+        exponential_seed, normal_seed, negative_binomial_seed = self.seedSequence.spawn(3)
+        self.exponentialStream = VariateStream(np.random.default_rng(exponential_seed),
+                                               lambda g, size: g.standard_exponential(size), block_size)
+        self.normalStream = VariateStream(np.random.default_rng(normal_seed),
+                                          lambda g, size: g.standard_normal(size), block_size)
+
+        # stream for the sum of geometric mining costs, its blocks are drawn for a fixed (N, p),
+        # and start small so that a p changing every round (C-prop) does not waste whole blocks
+        self.negativeBinomialStream = VariateStream(np.random.default_rng(negative_binomial_seed),
+                                                    None, block_size, initial_size=1)
+        self.negativeBinomialKey = None
+
+    def spawn(self, n):
+
+        # n child samplers with independent streams, e.g. one for each simulation
+        return [RandomSampler(seed, self.blockSize) for seed in self.seedSequence.spawn(n)]
+
+    def get_state(self):
+
+        # the full state of this sampler, as (json-compatible dict, dict of unused block variates)
+        # restoring it continues every stream exactly where it stopped
+        state = dict(entropy=self.seedSequence.entropy, spawnKey=list(self.seedSequence.spawn_key),
+                     childrenSpawned=self.seedSequence.n_children_spawned, blockSize=self.blockSize,
+                     negativeBinomialKey=self.negativeBinomialKey)
+        blocks = {}
+        for name, stream in self.__streams():
+            state[name], blocks[name] = stream.get_state()
+        return state, blocks
+
+    @classmethod
+    def from_state(cls, state, blocks):
+
+        seed = np.random.SeedSequence(state["entropy"], spawn_key=tuple(state["spawnKey"]))
+        sampler = cls(seed, state["blockSize"])
+        # spawn the children spawned before, so that later spawns do not repeat them
+        seed.spawn(state["childrenSpawned"] - seed.n_children_spawned)
+        for name, stream in sampler.__streams():
+            stream.set_state(state[name], blocks[name])
+        if state["negativeBinomialKey"] is not None:
+            N, p = state["negativeBinomialKey"]
+            sampler.negativeBinomialKey = (N, p)
+            sampler.negativeBinomialStream.draw = lambda g, size: g.negative_binomial(N, p, size)
+        return sampler
+
+    def __streams(self):
+
+        return [("exponential", self.exponentialStream), ("normal", self.normalStream),
+                ("negativeBinomial", self.negativeBinomialStream)]
+
+    def geometric_mean(self, e, N, negbin=False):
+
+        if negbin:
+            return self.geometric_mean_from_sum(e, N)
+
+        # a geometric variate on {1, 2, ...} with parameter p is floor(E / -log(1 - p)) + 1,
+        # where E is a standard exponential variate
+        p = 1.0 / e
+        scale = -math.log1p(-p)
+
+        while True:
+
+            # sample N bids from geometric distribution
+            r = np.floor(self.exponentialStream.take(N) / scale) + 1
+
+            # calculate the average of all N sampled data point
+            feedback = math.floor(r.mean())
+
+            # ensure that feedback is positive, or sample feedback again
+            if feedback > 0:
+                break
+
+        return feedback
+
+    def geometric_means(self, e, N, n, negbin=False):
+
+        # n feedbacks of geometric_mean(e, N) at once, the same values as n successive calls
+        # every geometric variate is at least 1, so the positivity retry of a single call never happens
+        if negbin:
+            return np.floor(self.geometric_sum(e, N, n) / N)
+
+        p = 1.0 / e
+        scale = -math.log1p(-p)
+        r = np.floor(self.exponentialStream.take(n * N).reshape(n, N) / scale) + 1
+        return np.floor(r.mean(axis=1))
+
+    def geometric_sum(self, e, N, n):
+
+        # n sums of N geometric variates on {1, 2, ...}, each drawn as a single variate
+        # the sum is N plus the number of failures before N successes, i.e. N + NegativeBinomial(N, p)
+        p = 1.0 / e
+        if self.negativeBinomialKey != (N, p):
+            self.negativeBinomialKey = (N, p)
+            self.negativeBinomialStream.restart(lambda g, size: g.negative_binomial(N, p, size))
+        return N + self.negativeBinomialStream.take(n)
+
+    def geometric_mean_from_sum(self, e, N):
+
+        # the same floor and positivity-retry semantics as geometric_mean, with O(1) cost in N
+        while True:
+
+            # calculate the average of N geometric variates from their sum
+            feedback = math.floor(self.geometric_sum(e, N, 1)[0] / N)
+
+            # ensure that feedback is positive, or sample feedback again
+            if feedback > 0:
+                break
+
+        return feedback
+
+    def norm(self, loc, scale):
+
+        return loc + scale * self.normalStream.take_one()
+
+
+'''
+the json-compatible description of a numpy SeedSequence, e.g. to record the seed of a model with its parameters
+'''
+def seed_description(seed_sequence):
+
+    return dict(entropy=str(seed_sequence.entropy), spawn_key=[int(key) for key in seed_sequence.spawn_key])
+
+
+'''
+a sha256 hex digest of the contents of arrays, e.g. to record the cost factors of many bidders with the parameters
+'''
+def array_digest(*arrays):
+
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
 '''
 sample from geometric distribution
-@:param e the expectation of geometric distribution 
+@:param e the expectation of geometric distribution
 @:param N the number of data point to be sampled and calculate average
+@:param sampler an optional RandomSampler, scipy is used if sampler is None
+@:param negbin True to draw the sum of N samples as a single negative binomial variate (needs a sampler)
 '''
-def sample_from_geometric_distribution(e, N):
+def sample_from_geometric_distribution(e, N, sampler=None, negbin=False):
+
+    if sampler is not None:
+        return sampler.geometric_mean(e, N, negbin)
+
+    # scipy is only needed without a sampler, and is slow to import
+    from scipy.stats import geom
 
     # geometry distribution parameter
     p = 1.0 / e
@@ -32,14 +266,51 @@ def sample_from_geometric_distribution(e, N):
 sample from norm distribution
 @:param loc the expectation of norm distribution
 @:param scale the scale of norm distribution
+@:param sampler an optional RandomSampler, scipy is used if sampler is None
 '''
-def sample_from_norm_distribution(loc, scale):
+def sample_from_norm_distribution(loc, scale, sampler=None):
+
+    if sampler is not None:
+        return sampler.norm(loc, scale)
+
+    from scipy.stats import norm
 
     return norm.rvs(loc=loc, scale=scale, size=1)[0]
 
 
+'''
+check that the per-sample and the negative binomial sampler yield the same distribution
+as the scipy reference sampler, with two-sample Kolmogorov-Smirnov tests
+@:param e the expectation of geometric distribution
+@:param N the number of data point to be sampled and calculate average
+@:param size the number of feedbacks drawn from every sampler
+@:param seed the seed of the RandomSampler under test
+@:return the KS test result of (direct vs scipy, negbin vs scipy, negbin vs direct)
+'''
+def compare_geometric_samplers(e, N, size=2000, seed=None):
+
+    from scipy.stats import ks_2samp
+
+    sampler = RandomSampler(seed)
+    reference = np.array([sample_from_geometric_distribution(e, N) for _ in range(size)])
+    direct = np.array([sampler.geometric_mean(e, N) for _ in range(size)])
+    negbin = np.array([sampler.geometric_mean(e, N, negbin=True) for _ in range(size)])
+    return ks_2samp(direct, reference), ks_2samp(negbin, reference), ks_2samp(negbin, direct)
+
+
 # the main function to test
 if __name__ == '__main__':
 
     print(sample_from_geometric_distribution(1000000, 10))
     print(sample_from_norm_distribution(0, 1))
+
+    sampler = RandomSampler(2020)
+    print(sample_from_geometric_distribution(1000000, 10, sampler))
+    print(sample_from_geometric_distribution(1000000, 10, sampler, negbin=True))
+    print(sample_from_norm_distribution(0, 1, sampler))
+
+    # the distribution of the negative binomial sampler should match the per-sample one
+    for e, N in [(6000000, 200), (5, 200), (3, 7)]:
+        for result in compare_geometric_samplers(e, N, seed=2020):
+            print("KS statistic: %.4f, p-value: %.4f" % (result.statistic, result.pvalue))
+            assert result.pvalue > 0.001
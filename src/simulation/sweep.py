@@ -0,0 +1,150 @@
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from .simulation import Simulation
+from .convergence import ConvergenceDetector
+from .resultCache import parameter_seed, simulation_arguments
+
+
+'''
+expand a parameter grid into a list of Simulation keyword arguments
+@:param grid a dict mapping Simulation argument names to lists of values (cartesian product),
+             or a list of such dicts of single values (taken as they are)
+@:return a list of dicts, one for each job
+'''
+def expand_grid(grid):
+
+    if isinstance(grid, dict):
+        names = list(grid.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+    return [dict(point) for point in grid]
+
+
+'''
+print the progress of a sweep to stderr, can be passed to run_sweep as progress
+'''
+def print_progress(done, total):
+
+    sys.stderr.write("\rSweep progress: %d / %d" % (done, total))
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+'''
+run a parameter sweep of Simulation over a process pool
+every job runs a Simulation with its own seed derived from the root seed and its parameters (see parameter_seed),
+so that a sweep is reproducible no matter how jobs are scheduled, a point gives the same result in any grid, and
+a cache does not change the results; results are written by the workers into shared memory
+@:param base the Simulation keyword arguments shared by all jobs, e.g. dict(tb=..., br=..., me=..., bw=..., tf=...)
+@:param grid the varying Simulation keyword arguments, see expand_grid, e.g. dict(gamma=[0.5, 1], rprop=[False, True])
+@:param total_round the number of rounds of every job
+@:param seed the root seed of the sweep
+@:param max_workers the maximum number of worker processes, all cores if None
+@:param chunk_size the number of jobs sent to a worker at once, chosen from the number of workers if None
+@:param progress an optional callable progress(done, total), called whenever a chunk finishes
+@:param convergence optional ConvergenceDetector keyword arguments, e.g. dict(window=5000, tolerance=1e-4),
+                    to stop every job as soon as its total balance is stationary or diverged
+@:param cache an optional ResultCache, jobs found in it are loaded instead of run, and finished jobs are stored,
+              so that extending a grid only runs the new points
+@:return (points, results, stops), where points are the keyword arguments of every job,
+         results is an array of shape (jobs, total_round + 1, 4) holding every Simulation.result,
+         and stops is a (stopReason, stopRound) pair for every job, (None, None) for a job that was not stopped;
+         the rows of results after a stop are NaN
+'''
+def run_sweep(base, grid, total_round, seed=None, max_workers=None, chunk_size=None, progress=None,
+              convergence=None, cache=None):
+
+    points = expand_grid(grid)
+    jobs = [dict(base, **point) for point in points]
+
+    # one independent seed for every job, the same for the same parameters
+    root = np.random.SeedSequence(seed)
+    seeds = [parameter_seed(root, job) for job in jobs]
+
+    # the result of all jobs, shared with the workers
+    shape = (len(jobs), total_round + 1, 4)
+    memory = SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+
+    try:
+        # the jobs found in the cache are copied into the results, only the others are run
+        done = 0
+        stops = [None] * len(jobs)
+        pending = list(range(len(jobs)))
+        if cache is not None:
+            results = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+            keys = [cache.key(job, total_round, job_seed, convergence) for job, job_seed in zip(jobs, seeds)]
+            pending = []
+            for index, key in enumerate(keys):
+                cached = cache.get(key)
+                if cached is None:
+                    pending.append(index)
+                    continue
+                # an entry of ResultCache.simulate ends at its stop, the rows after it are NaN as in run_chunk
+                cached_result = np.asarray(cached)
+                results[index, :len(cached_result)] = cached_result
+                results[index, len(cached_result):] = np.nan
+                stops[index] = (cached.annotations.get("stopReason"), cached.annotations.get("stopRound"))
+                done += 1
+            del results
+            if progress is not None and done:
+                progress(done, len(jobs))
+
+        workers = max_workers or os.cpu_count() or 1
+        if chunk_size is None:
+            chunk_size = max(1, len(pending) // (4 * workers))
+        chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_chunk, memory.name, shape, chunk,
+                                       [jobs[i] for i in chunk], [seeds[i] for i in chunk], total_round,
+                                       convergence)
+                       for chunk in chunks]
+            for future in as_completed(futures):
+                for index, stop in future.result():
+                    stops[index] = stop
+                    done += 1
+                if progress is not None:
+                    progress(done, len(jobs))
+
+        # copy the results out, so that the shared memory can be released
+        results = np.ndarray(shape, dtype=np.float64, buffer=memory.buf).copy()
+    finally:
+        memory.close()
+        memory.unlink()
+
+    # store the new results, rows after a stop are NaN as in the returned results
+    if cache is not None:
+        for index in pending:
+            reason, stop_round = stops[index]
+            cache.put(keys[index], results[index], simulation_arguments(jobs[index]),
+                      dict(stopReason=reason, stopRound=stop_round))
+    return points, results, stops
+
+
+'''
+run a chunk of sweep jobs in a worker process, and write their results into the shared memory
+@:return a list of (index, (stopReason, stopRound)) of the finished jobs
+'''
+def run_chunk(memory_name, shape, indices, jobs, seeds, total_round, convergence=None):
+
+    # workers share the resource tracker of the sweep process, which unlinks the memory at the end
+    memory = SharedMemory(name=memory_name)
+    results = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+    stops = []
+    try:
+        for index, job, seed in zip(indices, jobs, seeds):
+            simulation = Simulation(**dict(job, tt=False, horizon=total_round, seed=seed))
+            simulation.run(total_round, None if convergence is None else ConvergenceDetector(**convergence))
+            result = simulation.result
+            results[index, :len(result)] = result
+            results[index, len(result):] = np.nan
+            stops.append((index, (simulation.stopReason, simulation.stopRound)))
+    finally:
+        # the array must be released before the memory can be closed
+        del results
+        memory.close()
+    return stops
@@ -0,0 +1,168 @@
+import json
+import time
+import numpy as np
+
+# the state recorded by telemetry in every round
+TELEMETRY_FIELDS = ("round", "totalBalance", "transactionFee", "miningExpense", "blockReward", "bidPrice",
+                    "exchangeCoefficient")
+
+# the phases of a round timed by telemetry
+TELEMETRY_PHASES = ("sampling", "bid", "balance", "coefficient", "perturbation")
+
+# the clock used for phase timing
+clock = time.perf_counter
+
+
+# fixed-size ring buffer holding the state of the most recent rounds
+class StateRing:
+
+    def __init__(self, size, width=len(TELEMETRY_FIELDS)):
+
+        self.data = np.zeros((max(int(size), 1), width))
+        # the total number of rows written, the next row goes to written % size
+        self.written = 0
+
+    def append(self, row):
+
+        self.data[self.written % len(self.data)] = row
+        self.written += 1
+
+    def extend(self, rows):
+
+        # append many rows at once, only the last len(self.data) of them are kept
+        # the rows dropped at once count as written, the kept rows take the positions they would have had
+        rows = np.asarray(rows)
+        kept = rows[-len(self.data):]
+        indices = (self.written + len(rows) - len(kept) + np.arange(len(kept))) % len(self.data)
+        self.data[indices] = kept
+        self.written += len(rows)
+
+    def recent(self):
+
+        # the recorded rows, from the oldest to the newest
+        if self.written <= len(self.data):
+            return self.data[:self.written].copy()
+        return np.roll(self.data, -(self.written % len(self.data)), axis=0)
+
+
+# sink printing a record in the format of the original console trace
+class PrintSink:
+
+    def emit(self, record):
+
+        total_balance = record["totalBalance"]
+        print("====================================")
+        print("Simulation Round: ", record["round"])
+        print("Total balance: ", total_balance, total_balance / total_balance)
+        print("Tx Fee: ", record["transactionFee"], record["transactionFee"] / total_balance)
+        print("Mining cost: ", record["miningExpense"], record["miningExpense"] / total_balance)
+        print("Block Reward: ", record["blockReward"], record["blockReward"] / total_balance)
+        print("Bid Price: ", record["bidPrice"], record["bidPrice"] / total_balance)
+        print("Exchange Coefficient: ", record["exchangeCoefficient"])
+        print("====================================")
+
+    def close(self):
+
+        pass
+
+
+# sink writing every record as a line of JSON, to a path or an open file
+class JsonLinesSink:
+
+    def __init__(self, target):
+
+        self.ownsFile = isinstance(target, str)
+        self.file = open(target, "a", buffering=1 << 16) if self.ownsFile else target
+
+    def emit(self, record):
+
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+
+        if self.ownsFile:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+# sink calling a function with every record
+class CallbackSink:
+
+    def __init__(self, callback):
+
+        self.callback = callback
+
+    def emit(self, record):
+
+        self.callback(record)
+
+    def close(self):
+
+        pass
+
+
+# structured instrumentation of a simulation
+# every round's state goes to a fixed-size ring buffer, every interval rounds a record is emitted to all sinks,
+# and with timing enabled the time of every phase of a round is accumulated.
+# A simulation without telemetry does not pay for any of it.
+class Telemetry:
+
+    def __init__(self, sinks=(), interval=1000, ring_size=1024, timing=False):
+
+        # sinks have an emit(record) method, plain callables are accepted as well
+        self.sinks = [sink if hasattr(sink, "emit") else CallbackSink(sink) for sink in sinks]
+        self.interval = interval
+        self.ring = StateRing(ring_size)
+
+        # accumulated seconds and the number of timed rounds for every phase
+        self.timing = timing
+        self.phaseTimes = dict.fromkeys(TELEMETRY_PHASES, 0.0)
+        self.timedRounds = 0
+
+    def record(self, state):
+
+        # record the state of a round, a sequence of TELEMETRY_FIELDS
+        self.ring.append(state)
+        if state[0] % self.interval == 0:
+            self.emit(state)
+
+    def record_many(self, states):
+
+        # record the states of many rounds at once, with shape (rounds, len(TELEMETRY_FIELDS))
+        states = np.asarray(states)
+        self.ring.extend(states)
+        for state in states[states[:, 0] % self.interval == 0]:
+            self.emit(state)
+
+    def emit(self, state):
+
+        record = dict(zip(TELEMETRY_FIELDS, (float(value) for value in state)))
+        record["round"] = int(record["round"])
+        for sink in self.sinks:
+            sink.emit(record)
+
+    def add_phase_times(self, times):
+
+        # add the durations of the phases of one round, in the order of TELEMETRY_PHASES
+        for phase, duration in zip(TELEMETRY_PHASES, times):
+            self.phaseTimes[phase] += duration
+        self.timedRounds += 1
+
+    def phase_summary(self):
+
+        # the mean time per round and the share of the round time of every phase
+        total = sum(self.phaseTimes.values()) or 1.0
+        rounds = self.timedRounds or 1
+        return {phase: dict(perRound=seconds / rounds, share=seconds / total)
+                for phase, seconds in self.phaseTimes.items()}
+
+    def recent(self):
+
+        # the state of the most recent rounds, one row of TELEMETRY_FIELDS per round
+        return self.ring.recent()
+
+    def close(self):
+
+        for sink in self.sinks:
+            sink.close()